@@ -0,0 +1,408 @@
+"""
+Acquisition core of the C & T monitor.
+
+It reads the Arduino frames, measures the currents with the three Keithleys
+and writes every sample on the output data file. It has no Qt dependency, so
+it is used both by the GUI (through GetData) and by headless_monitor.py.
+
+The samples are published in batches: structured arrays whose fields are
+the channels of channels.py, in the order of the columns of the data file.
+"""
+import time
+import serial
+import pyvisa as visa
+from datetime import datetime
+import numpy as np
+
+import channels
+import frame_parser
+import binary_frames
+import link_health
+import smu_broker
+
+
+# Default configuration of the setup << CHANGE WHEN NEEDED
+DATA_DIRECTORY = "/home/labb2/ardu_dew_point/data/"
+ARDUINO_PORT = "/dev/ttyUSB0"
+ARDUINO_BAUDRATE = 115200
+SMU_PSUB = "TCPIP0::169.254.91.1::inst0::INSTR" # keithley1
+SMU_PWELL = "TCPIP0::169.254.91.2::inst0::INSTR" # keithley2
+SMU_HV = "TCPIP0::169.254.91.3::inst0::INSTR" # keithley3
+
+
+def data_file_name(directory=DATA_DIRECTORY,station=None):
+    """
+    Returns the name of a new data file, built from the actual time:
+    directory/time-and-dew-point-YYYYMMDD-HHMM.dat
+    or directory/time-and-dew-point-STATION-YYYYMMDD-HHMM.dat if the name
+    of the station is given.
+    """
+    actual_time = f"{datetime.now()}"
+    wrd = actual_time.split()
+    wrd2 = wrd[1].split(":")
+    wrd1 = wrd[0].split("-")
+    dat = "".join(wrd1)
+    tim = "".join(wrd2[:-1])
+    ff = "-".join([dat,tim])
+    if station is not None:
+        ff = "-".join([station,ff])
+    file = "time-and-dew-point-{0}.dat".format(ff)
+    return directory+file
+
+
+def format_sample(sample):
+    """Returns the line of the output data file for a sample (one value per channel)."""
+    return " ".join(str(x) for x in sample)+"\n"
+
+
+def format_batch(batch):
+    """Returns the lines of the output data file for a batch of samples."""
+    return "".join(format_sample(sample) for sample in batch.tolist())
+
+
+def measure_current(inst):
+    inst.write("smu.measure.read()") # saving without append, it overwrites old values
+    inst.write("print(smu.measure.read())")
+    response = inst.read()
+    response = float(response)
+    return response
+
+
+# Source range, measurement range, current limit and overprotection of each role
+SMU_SETTINGS = {
+    "psub": ("2.000000e+01","1.000000e-02","3.000000e-03","smu.PROTECT_20V"),
+    "pwell": ("2.000000e+01","1.000000e-02","3.000000e-03","smu.PROTECT_20V"),
+    "hv": ("2.000000e+02","1.000000e-03","3.000000e-04","smu.PROTECT_40V"),
+}
+
+
+def configure_smu(inst,role):
+    """Configures a Keithley for its role: voltage source, current measurement"""
+    source_range,measure_range,ilimit,protect = SMU_SETTINGS[role]
+    inst.write("smu.source.func = smu.FUNC_DC_VOLTAGE") # Source function --> voltage
+    inst.write("smu.source.range = "+source_range)
+    inst.write("smu.source.autorange = smu.OFF")
+    inst.write("smu.measure.range = "+measure_range)
+    inst.write("smu.measure.autorange = smu.OFF")
+    inst.write("smu.source.ilimit.level = "+ilimit)
+    inst.write("smu.source.autodelay = smu.OFF")
+    inst.write("smu.source.protect.level = "+protect)
+    inst.write("smu.source.readback = smu.ON")
+    inst.write("smu.measure.func = smu.FUNC_DC_CURRENT") # Measure function --> current
+
+
+def configure_keithleys(psub=SMU_PSUB,pwell=SMU_PWELL,hv=SMU_HV,rm=None):
+    """
+    Opens and configures the three Keithleys, with the resource manager rm
+    (a new pyvisa.ResourceManager if None).
+    It returns the resource manager and the instruments of psub (keithley1),
+    pwell (keithley2) and HV (keithley3).
+    """
+    if rm is None:
+        rm = visa.ResourceManager()
+    keithley1 = rm.open_resource(psub)
+    keithley2 = rm.open_resource(pwell)
+    keithley3 = rm.open_resource(hv)
+
+    configure_smu(keithley2,"pwell")
+    configure_smu(keithley1,"psub")
+    configure_smu(keithley3,"hv")
+
+    return rm,keithley1,keithley2,keithley3
+
+
+def smu_alive(inst):
+    """True if the session of a Keithley answers to *IDN?"""
+    try:
+        return bool(inst.query("*IDN?").strip())
+    except Exception: # VISA errors, closed sessions
+        return False
+
+
+class Acquisition:
+    """
+    Serial/SMU acquisition and persistence pipeline.
+
+    Every new batch of samples is written on the output data file and then
+    passed to each callable of the sinks list (e.g. the bridge of GetData or
+    the clients of the headless monitor). The sinks that have a flush()
+    method are flushed after each poll of the serial port, and the ones that
+    have a run_closed() method are called when the output data file is
+    closed (e.g. run_catalog.RunRecorder).
+
+    Parameters:
+    - directory (str): directory of the output data file;
+    - port (str): serial port of the Arduino;
+    - currents (bool): default = True, if False the Keithleys are not used
+    and the currents are saved as 0;
+    - smu_addresses (tuple of str): VISA addresses of psub, pwell and HV;
+    - station (str): default = None, name of the station, added to the
+    name of the output data file;
+    - binary (bool): default = False, the Arduino sends binary frames
+    (see binary_frames.py) instead of ASCII lines;
+    - chip (str): default = None, chip under test (see stations.CHIPS);
+    - resource_manager: default = None, VISA resource manager of the
+    Keithleys, e.g. smu_simulator.SimulatedResourceManager (a new
+    pyvisa.ResourceManager if None);
+    """
+
+    def __init__(self,directory=DATA_DIRECTORY,port=ARDUINO_PORT,currents=True,
+                 smu_addresses=(SMU_PSUB,SMU_PWELL,SMU_HV),station=None,binary=False,chip=None,
+                 resource_manager=None):
+        self.station = station
+        self.chip = chip
+        self.smu_addresses = smu_addresses
+        self.port = port
+
+        # Data file
+        self.filename = data_file_name(directory,station)
+        self.output_data_file = open(self.filename,"w")
+
+        # Initialization of the serial port for communication with Arduino
+        self.Arduino = serial.Serial(port,ARDUINO_BAUDRATE, timeout=0.01)
+
+        # Initialization of the Keithleys for current measuring
+        self.rm = None
+        self.keithley1 = self.keithley2 = self.keithley3 = None
+        if currents:
+            self.rm,self.keithley1,self.keithley2,self.keithley3 = configure_keithleys(*smu_addresses,rm=resource_manager)
+
+        self.parser = binary_frames.BinaryFrameParser() if binary else frame_parser.FrameParser()
+        self.schema = channels.SCHEMA
+        self.sinks = []
+        self.active = False # flag for exit procedure management
+        self.currents = currents # flag for currents measuring management
+        self.n_currents_changes = 0 # pauses and resumes of the user (see interlock.py)
+        self.currents_scheduled = False # True if the currents are read by a smu_scheduler.SmuScheduler
+        self.n_samples = 0
+        self.starttime = time.time()
+        self.last_currents = {role: 0. for role in channels.SMU_ROLES} # [A]
+        self.last_frame_time = None # time of the last frame published [s]
+        # All the commands to the Keithleys (readings, ramps, interlock) go
+        # through the broker, one thread for each Keithley (see smu_broker.py)
+        self.broker = smu_broker.SmuBroker(lambda role: self.smus()[role])
+        self.profiles = {} # speed profile of each role, see smu_profiles.py
+        # Health of the serial port and of the Keithleys (see link_health.py)
+        self.health = {name: link_health.LinkHealth(name) for name in ["arduino"]+list(channels.SMU_ROLES)}
+        self.outages = [] # reports of the outages ended
+
+    def smus(self):
+        """Returns the Keithley of each role"""
+        return {"hv": self.keithley3,"pwell": self.keithley2,"psub": self.keithley1}
+
+    def pause_currents(self):
+        """Suspends the readings of the Keithleys, their sessions stay open"""
+        self.currents = False
+        self.n_currents_changes += 1
+
+    def resume_currents(self):
+        """Resumes the readings of the Keithleys"""
+        self.currents = self.rm is not None
+        self.n_currents_changes += 1
+
+    def reconnect_keithleys(self,roles=channels.SMU_ROLES):
+        """
+        Checks the session of the Keithley of each role and reopens and
+        configures only the broken ones (all of them if the Keithleys were
+        never opened).
+        It returns the state of each role: "ok", "reopened" (its speed
+        profile must be set again) or the error of the reopening.
+        """
+        if self.rm is None:
+            self.rm = visa.ResourceManager()
+        addresses = dict(zip(["psub","pwell","hv"],self.smu_addresses))
+        attributes = {"psub": "keithley1","pwell": "keithley2","hv": "keithley3"}
+        states = {}
+        for role in roles:
+            def reopen(inst,role=role):
+                # Executed by the thread of the Keithley in the broker: no other command meanwhile
+                if inst is not None and smu_alive(inst):
+                    return "ok"
+                if inst is not None:
+                    try:
+                        inst.close()
+                    except Exception: # already invalid
+                        pass
+                inst = self.rm.open_resource(addresses[role])
+                configure_smu(inst,role)
+                setattr(self,attributes[role],inst)
+                return "reopened"
+            try:
+                states[role] = self.broker.call(role,reopen,smu_broker.RAMP)
+            except Exception as err: # VISA errors: the other Keithleys are still checked
+                states[role] = f"error: {err}"
+        return states
+
+    def measure_role(self,role):
+        """
+        Returns the current of the Keithley of a role [A]. It raises
+        link_health.LinkDown while the Keithley waits to be reconnected
+        (see supervisor.py).
+        """
+        health = self.health[role]
+        if not health.up:
+            raise link_health.LinkDown(health.status())
+        try:
+            return self.broker.call(role,measure_current,smu_broker.MONITOR)
+        except Exception as err:
+            self.link_failed(role,err)
+            raise
+
+    def measure_currents(self):
+        """
+        Returns the current of each SMU role [A], or the last values if the
+        currents are off or read at a fixed rate by a smu_scheduler.SmuScheduler.
+        The last value of a Keithley is kept while it cannot be read.
+        """
+        if self.currents and not self.currents_scheduled:
+            currents = dict(self.last_currents)
+            for role in channels.SMU_ROLES:
+                try:
+                    currents[role] = self.measure_role(role)
+                except Exception: # VISA errors, the link is marked down
+                    pass
+            self.last_currents = currents
+        return self.last_currents
+
+    def mark_gap(self,text):
+        """Writes a comment line on the data file, e.g. the start or the end of an outage"""
+        if not self.output_data_file.closed:
+            self.output_data_file.write("# "+text+"\n")
+            self.output_data_file.flush()
+
+    def link_failed(self,name,err):
+        """Marks a link down, the start of the outage is written on the data file"""
+        if self.health[name].failed(err):
+            self.mark_gap(f"gap {name} start t={time.time()-self.starttime:.3f} s: {err}")
+            prefix = f"{self.station}: " if self.station else ""
+            print(f"{prefix}{name} link lost ({err}), reconnecting")
+
+    def link_recovered(self,name,recovery=0.):
+        """Marks a link up again, the end of the outage is written on the data file and reported"""
+        report = self.health[name].recovered(recovery)
+        if report is None:
+            return
+        self.mark_gap(f"gap {name} end t={time.time()-self.starttime:.3f} s: outage {report['outage']:.3f} s, "
+                      f"recovery {report['recovery']:.3f} s, {report['retries']} retries")
+        self.outages.append(report)
+        print(link_health.format_outage(report,self.station))
+
+    def links_down(self):
+        """Returns the status of the links that are down"""
+        return [health.status() for health in self.health.values() if not health.up]
+
+    def reopen_serial(self):
+        """Reopens the serial port and resynchronizes the stream of frames"""
+        try:
+            self.Arduino.close()
+        except (serial.SerialException,OSError): # already broken
+            pass
+        self.Arduino = serial.Serial(self.port,ARDUINO_BAUDRATE, timeout=0.01)
+        self.Arduino.reset_input_buffer() # stale bytes
+        self.parser.reset() # partial frame
+        self.last_frame_time = None
+
+    def recover_serial(self):
+        """Reopens the serial port if its retry is due, it returns True if the port is up again"""
+        health = self.health["arduino"]
+        if not health.retry_due():
+            return False
+        start = time.monotonic()
+        try:
+            self.reopen_serial()
+        except (serial.SerialException,OSError) as err:
+            health.retry_failed(err)
+            return False
+        self.link_recovered("arduino",time.monotonic()-start)
+        return True
+
+    def publish(self,batch):
+        """Writes the batch of samples on the output data file and passes it to the sinks."""
+        if not self.output_data_file.closed:
+            self.output_data_file.write(format_batch(batch))
+        self.n_samples += len(batch)
+        for sink in self.sinks:
+            sink(batch)
+
+    def poll(self):
+        """
+        Reads all the bytes available on the serial port and publishes the
+        samples of the complete frames. It returns the number of new samples.
+        The currents are measured once for all the frames of a read, so a
+        backlog of frames is recovered in one step (see frame_times for
+        their times). If the serial port fails
+        it is reopened at the next polls, with backoff (see link_health.py).
+        """
+        n = 0
+        if not self.health["arduino"].up:
+            self.recover_serial()
+            return 0
+        try:
+            waiting = self.Arduino.inWaiting()
+            data = self.Arduino.read(waiting) if waiting > 0 else b""
+        except (serial.SerialException,OSError) as err: # e.g. USB unplugged: reconnect with backoff
+            self.link_failed("arduino",err)
+            return 0
+        if data: # Do not do anything if there are no characters to read
+            frames = self.parser.feed(data)
+            if len(frames):
+                self.publish(self.schema.evaluate(frames,self.frame_times(len(frames)),self.measure_currents()))
+                n = len(frames)
+        self.flush()
+        return n
+
+    def frame_times(self,n):
+        """
+        Times of the n frames of a read [s]: the frames waiting on the serial
+        port arrived since the previous ones (e.g. a backlog after a stall),
+        so their times are spread evenly over that interval, the last one at
+        the time of the read.
+        """
+        now = time.time()-self.starttime
+        previous = self.last_frame_time
+        self.last_frame_time = now
+        if previous is None or n == 1:
+            return now
+        return previous+(now-previous)*np.arange(1,n+1)/n
+
+    def flush(self):
+        """Flushes the sinks that collect the samples (e.g. sample_bridge.SampleBridge)"""
+        for sink in self.sinks:
+            if hasattr(sink,"flush"):
+                sink.flush()
+
+    def run(self,idle=0.05):
+        """
+        Acquisition loop, it runs until stop() is called.
+        When there is nothing to read it sleeps for idle seconds instead of
+        polling the serial port continuously.
+        """
+        self.start()
+        try:
+            while self.active:
+                if self.poll() == 0:
+                    time.sleep(idle)
+        finally:
+            self.close()
+
+    def start(self):
+        """Resets the starting time and sets the active flag"""
+        self.starttime = time.time() # starting time
+        self.last_frame_time = None
+        self.active = True
+
+    def stop(self):
+        """Method to safely stop the acquisition loop"""
+        self.active = False
+
+    def close(self):
+        """Closes the output data file, the serial port and the broker of the Keithleys"""
+        self.output_data_file.close()
+        for sink in self.sinks:
+            if hasattr(sink,"run_closed"):
+                try:
+                    sink.run_closed()
+                except Exception as err: # e.g. catalog locked: the instruments must be closed anyway
+                    print(f"{sink.__class__.__name__}: {err!r}")
+        self.Arduino.close()
+        self.broker.close()
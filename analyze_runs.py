@@ -0,0 +1,351 @@
+"""
+Batch analysis of archived runs (the time-and-dew-point-*.dat files).
+
+The runs are analysed in parallel by a pool of processes, one run per task;
+each data file is memory-mapped and parsed in chunks of whole lines by the
+C parser of NumPy, the comment lines (e.g. the gaps of the links, see
+link_health.py) are skipped; the runs converted to columns (see
+run_columns.py) are read from their columns instead, without parsing.
+Then the run is reduced with vectorized NumPy to the rows of two summary
+tables:
+- runs: duration, samples, gaps, minimum dew point margin, time below a
+temperature, violations of the interlock rules (episodes and time, see
+interlock.default_rules), thermal time constants, correlation of the
+currents with T_NTC;
+- channels: extrema, mean and standard deviation of every channel.
+
+    python analyze_runs.py data/ --jobs 8 --output campaign
+
+prints the runs table and writes campaign-runs.csv and campaign-channels.csv.
+"""
+import io
+import os
+import re
+import sys
+import csv
+import glob
+import mmap
+import time
+import argparse
+import warnings
+import concurrent.futures
+
+import numpy as np
+
+import channels
+import interlock
+import run_columns
+
+
+# Bytes of a data file parsed at once
+CHUNK_SIZE = 1<<24
+# Channels of the time constants and of the currents
+TAU_CHANNELS = ["T_NTC","T_cold","T_hot"]
+CURRENTS = ["I_HV","I_pwell","I_psub"]
+# Temperature of the time spent below [*C] << CHANGE WHEN NEEDED
+COLD_LIMIT = -20.
+# Intervals longer than GAP_FACTOR times the median interval are gaps, not counted in the times
+GAP_FACTOR = 10
+# Minimum change of a temperature for its time constant [*C]
+STEP_MIN = 1.
+
+FILE_PATTERN = "time-and-dew-point-*.dat"
+NAME_RE = re.compile(r"time-and-dew-point-(?:(?P<station>.+)-)?(?P<date>\d{8})-(?P<time>\d{4})\.(dat|cols)$")
+COMMENT_RE = re.compile(rb"^#[^\n]*",re.M)
+
+
+def run_info(path):
+    """Returns (station, start "YYYY-MM-DD HH:MM") from the name of a data file"""
+    match = NAME_RE.search(os.path.basename(path))
+    if match is None:
+        return None,None
+    d,t = match["date"],match["time"]
+    return match["station"],f"{d[:4]}-{d[4:6]}-{d[6:]} {t[:2]}:{t[2:]}"
+
+
+def run_name(path):
+    """Name of the data file of a run (also for its columns)"""
+    name = os.path.basename(os.path.normpath(path))
+    if name.endswith(run_columns.COLUMNS_SUFFIX):
+        name = name[:-len(run_columns.COLUMNS_SUFFIX)]+".dat"
+    return name
+
+
+def run_size(path):
+    """Bytes of a data file, or of the columns of a run"""
+    if os.path.isdir(path):
+        return sum(entry.stat().st_size for entry in os.scandir(path))
+    return os.path.getsize(path)
+
+
+def parse_chunk(data,n_columns):
+    """Parses lines of a data file, it returns (rows, number of bad lines)"""
+    try:
+        with warnings.catch_warnings(): # chunk of comments only
+            warnings.simplefilter("ignore",UserWarning)
+            rows = np.loadtxt(io.BytesIO(data),dtype=np.float64,comments="#",ndmin=2)
+        if rows.size == 0 or rows.shape[1] == n_columns:
+            return rows.reshape(-1,n_columns),0
+    except ValueError:
+        pass
+    # Slow path: some lines are malformed, they are skipped
+    rows = []
+    n_bad = 0
+    for line in data.splitlines():
+        if not line.strip() or line.startswith(b"#"):
+            continue
+        try:
+            values = [float(x) for x in line.split()]
+        except ValueError:
+            values = None
+        if values is None or len(values) != n_columns:
+            n_bad += 1
+            continue
+        rows.append(values)
+    return np.array(rows,dtype=np.float64).reshape(-1,n_columns),n_bad
+
+
+def load_run(path,schema=channels.SCHEMA,chunk_size=CHUNK_SIZE):
+    """
+    Reads a data file (or the columns of a run), it returns (samples,
+    comment lines, number of bad lines). A last line without newline (file
+    still being written) is ignored.
+    """
+    if os.path.isdir(path):
+        samples,meta = run_columns.load_samples(path,schema)
+        lines = [line for _,line in meta["lines"] if line.endswith("\n") and line.strip()]
+        comments = [line.rstrip("\n") for line in lines if line.startswith("#")]
+        return samples,comments,len(lines)-len(comments)
+    n_columns = len(schema.names)
+    with open(path,"rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return np.empty(0,dtype=schema.dtype),[],0
+        with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+            end = mm.rfind(b"\n")+1
+            comments = [m.group().decode(errors="replace") for m in COMMENT_RE.finditer(mm,0,end)]
+            parts = []
+            n_bad = 0
+            pos = 0
+            while pos < end:
+                stop = end if pos+chunk_size >= end else mm.find(b"\n",pos+chunk_size)+1
+                rows,bad = parse_chunk(mm[pos:stop],n_columns)
+                parts.append(rows)
+                n_bad += bad
+                pos = stop
+    rows = np.concatenate(parts) if parts else np.empty((0,n_columns))
+    return schema.from_rows(rows),comments,n_bad
+
+
+def sample_durations(t):
+    """Time represented by each sample [s]: interval to the next one, 0 across the gaps"""
+    if len(t) < 2:
+        return np.zeros(len(t))
+    dt = np.diff(t)
+    dt[dt > GAP_FACTOR*np.median(dt)] = 0.
+    dt[dt < 0] = 0.
+    return np.append(dt,0.)
+
+
+def episodes(mask):
+    """Number of runs of True in mask"""
+    if len(mask) == 0:
+        return 0
+    return int(mask[0])+int(np.count_nonzero(mask[1:] & ~mask[:-1]))
+
+
+def time_constant(t,y,edge=None):
+    """
+    Time constant of the largest change of a temperature in the run [s]:
+    time from leaving the initial value (5% of the change) to reaching 63%
+    of the change, NaN if the temperature changes by less than STEP_MIN.
+    """
+    n = len(y)
+    if n < 20:
+        return np.nan
+    edge = edge or max(n//100,10)
+    y0 = np.median(y[:edge])
+    y1 = np.median(y[-edge:])
+    change = y1-y0
+    if abs(change) < STEP_MIN:
+        return np.nan
+    progress = (y-y0)/change
+    started = progress > 0.05
+    reached = progress >= 1-np.exp(-1)
+    if not reached.any():
+        return np.nan
+    i1 = int(np.argmax(reached))
+    i0 = int(np.argmax(started[:i1+1]))
+    return t[i1]-t[i0]
+
+
+def correlation(x,y):
+    """Pearson coefficient and slope of y against x on the samples with y != 0 (currents off)"""
+    valid = np.isfinite(x) & np.isfinite(y) & (y != 0)
+    if np.count_nonzero(valid) < 10:
+        return np.nan,np.nan
+    x = x[valid]
+    y = y[valid]
+    if x.std() == 0 or y.std() == 0:
+        return np.nan,np.nan
+    r = np.corrcoef(x,y)[0,1]
+    slope = np.polyfit(x,y,1)[0]
+    return r,slope
+
+
+def analyze_run(path,cold_limit=COLD_LIMIT,mode="cooling"):
+    """
+    Reduces a run to its summary, it returns (row of the runs table, rows of the channels table).
+
+    Parameters:
+    - path (str): data file of the run;
+    - cold_limit (float): default = COLD_LIMIT, temperature of the time spent below [*C];
+    - mode (str): default = "cooling", mode of the interlock rules (see interlock.default_rules);
+    """
+    samples,comments,n_bad = load_run(path)
+    station,start = run_info(path)
+    t = samples["time"]
+    durations = sample_durations(t)
+    row = {"file": run_name(path),"station": station,"start": start,
+           "samples": len(samples),"bad_lines": n_bad,
+           "gaps": sum(1 for c in comments if c.startswith("# gap") and " start " in c),
+           "duration": float(t[-1]-t[0]) if len(t) else 0.,
+           "covered": float(durations.sum())}
+
+    rules = interlock.default_rules(mode)
+    margin = next(rule for rule in rules if rule.name == "dew point margin")
+    row["min_margin"] = float(samples[margin.channel].min()) if len(samples) else np.nan
+    cold = samples["T_NTC"] < cold_limit
+    row["time_below"] = float(durations[cold].sum())
+    for rule in rules:
+        bad = rule.violations(samples)
+        key = rule.name.replace(" ","_")
+        row[f"{key}_episodes"] = episodes(bad)
+        row[f"{key}_time"] = float(durations[bad].sum())
+
+    for name in TAU_CHANNELS:
+        row[f"tau_{name}"] = float(time_constant(t,samples[name]))
+    for name in CURRENTS:
+        r,slope = correlation(samples["T_NTC"],samples[name])
+        row[f"r_{name}"] = float(r)
+        row[f"slope_{name}"] = float(slope) # [unit of the current/*C]
+
+    channel_rows = []
+    for name in channels.SCHEMA.names[1:]:
+        values = samples[name]
+        if len(values) == 0:
+            continue
+        i_min = int(np.nanargmin(values)) if not np.isnan(values).all() else 0
+        i_max = int(np.nanargmax(values)) if not np.isnan(values).all() else 0
+        channel_rows.append({"file": row["file"],"channel": name,"unit": channels.SCHEMA.unit(name),
+                             "min": float(values[i_min]),"t_min": float(t[i_min]),
+                             "max": float(values[i_max]),"t_max": float(t[i_max]),
+                             "mean": float(np.nanmean(values)),"std": float(np.nanstd(values))})
+    return row,channel_rows
+
+
+def analyze_task(path,cold_limit,mode):
+    """Task of the pool: the errors are returned, a bad file does not stop the batch"""
+    start = time.perf_counter()
+    try:
+        row,channel_rows = analyze_run(path,cold_limit,mode)
+    except Exception as err:
+        return {"file": run_name(path),"error": repr(err)},[],0.
+    return row,channel_rows,time.perf_counter()-start
+
+
+def find_runs(paths,columns=True):
+    """
+    Runs of the paths: data files, directories or glob patterns. The
+    columns of a run (see run_columns.py) are used instead of its data
+    file, unless columns is False (only the data files are returned).
+    The files of a directory are the ones named as runs (NAME_RE).
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path) and not path.rstrip("/\\").endswith(run_columns.COLUMNS_SUFFIX):
+            found = glob.glob(os.path.join(path,FILE_PATTERN))+glob.glob(os.path.join(path,FILE_PATTERN[:-4]+run_columns.COLUMNS_SUFFIX))
+            files += [f for f in found if NAME_RE.search(os.path.basename(f))]
+        elif glob.has_magic(path):
+            files += glob.glob(path)
+        elif os.path.exists(path):
+            files.append(path)
+        else:
+            print(path,"not found")
+    files = [os.path.normpath(f) for f in files]
+    if not columns:
+        return sorted(set(f for f in files if not os.path.isdir(f)))
+    converted = set(f for f in files if os.path.exists(os.path.join(f,run_columns.META_NAME)))
+    files = [f for f in files if f in converted or (not os.path.isdir(f) and run_columns.columns_path(f) not in converted
+                                                      and not os.path.exists(os.path.join(run_columns.columns_path(f),run_columns.META_NAME)))]
+    return sorted(set(files))
+
+
+def write_table(filename,rows):
+    keys = []
+    for row in rows:
+        keys += [k for k in row if k not in keys]
+    with open(filename,"w",newline="") as f:
+        writer = csv.DictWriter(f,keys)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def format_value(value):
+    if value is None:
+        return ""
+    if isinstance(value,float):
+        return f"{value:.4g}"
+    return str(value)
+
+
+def print_table(rows,keys):
+    table = [keys]+[[format_value(row.get(k,"")) for k in keys] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(keys))]
+    for line in table:
+        print("  ".join(value.rjust(w) for value,w in zip(line,widths)))
+
+
+def main():
+    # Parse arguments from terminal
+    parser = argparse.ArgumentParser(description="Summary tables of many runs, analysed in parallel.")
+    parser.add_argument('paths', nargs='+', help="Data files, directories (all the %s files) or glob patterns." % FILE_PATTERN)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="Processes of the pool (default is the number of cores).")
+    parser.add_argument('--cold-limit', type=float, default=COLD_LIMIT, help="Temperature of the time spent below in *C (default is %g)." % COLD_LIMIT)
+    parser.add_argument('--mode', choices=["cooling","heating"], default="cooling", help="Mode of the interlock rules (default is cooling).")
+    parser.add_argument('--output', default=None, help="Prefix of the CSV files of the tables (OUTPUT-runs.csv, OUTPUT-channels.csv).")
+
+    args = parser.parse_args()
+    files = find_runs(args.paths)
+    if not files:
+        print("No data files found")
+        return 1
+    size = sum(run_size(f) for f in files)
+    print(f"Analysing {len(files)} runs ({size/1e6:.1f} MB) with {args.jobs} processes")
+
+    start = time.perf_counter()
+    runs = []
+    channel_rows = []
+    busy = 0.
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+        n = len(files)
+        results = pool.map(analyze_task,files,[args.cold_limit]*n,[args.mode]*n,chunksize=max(1,n//(4*args.jobs)))
+        for row,rows,duration in results:
+            if "error" in row:
+                print(f"{row['file']}: {row['error']}")
+                continue
+            runs.append(row)
+            channel_rows += rows
+            busy += duration
+    elapsed = time.perf_counter()-start
+
+    print_table(runs,["file","station","start","samples","duration","gaps","min_margin","time_below",
+                      "dew_point_margin_episodes","tau_T_NTC","r_I_HV","slope_I_HV"])
+    print(f"{len(runs)} runs in {elapsed:.2f} s ({size/1e6/elapsed:.1f} MB/s, speed-up {busy/elapsed:.1f})")
+    if args.output is not None:
+        write_table(args.output+"-runs.csv",runs)
+        write_table(args.output+"-channels.csv",channel_rows)
+        print("Tables saved on",args.output+"-runs.csv","and",args.output+"-channels.csv")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
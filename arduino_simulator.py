@@ -0,0 +1,130 @@
+"""
+Simulator of the Arduino of the cold box, to test the monitor without
+hardware. It writes ASCII ("inizio: ...") or binary frames (see
+binary_frames.py) on a pseudo-terminal, whose name is printed at start:
+
+    python arduino_simulator.py --binary --rate 50
+    python headless_monitor.py --port /dev/pts/N --binary --no-currents
+
+Frames can be corrupted or dropped on purpose to test the parsers.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import numpy as np
+
+import binary_frames
+
+
+class ColdBoxModel:
+    """
+    Very simple model of the cold box: the cold side of the Peltier
+    relaxes towards a set point, the NTC of the chip follows it and
+    the dew point drifts slowly.
+
+    Parameters:
+    - t_set (float): default = -25, set point of the cold side [*C];
+    - tau (float): default = 300, time constant of the cold side [s];
+    - noise (float): default = 0.05, noise of the sensors [*C];
+    - seed (int): default = None, seed of the random generator;
+    """
+
+    def __init__(self,t_set=-25.,tau=300.,noise=0.05,seed=None):
+        self.t_set = t_set
+        self.tau = tau
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.tcold = 20.
+        self.dp = -40.
+
+    def frames(self,n,dt):
+        """Returns n frames (shape (n,7)) spaced by dt seconds"""
+        out = np.empty((n,7))
+        for i in range(n):
+            self.tcold += (self.t_set-self.tcold)*dt/self.tau
+            self.dp += self.rng.normal(0,0.01)
+            out[i,2] = self.tcold
+            out[i,3] = 20.+0.2*(20.-self.tcold) # hot side
+            out[i,1] = self.tcold+2. # T_NTC
+            out[i,0] = self.dp
+        out[:,:4] += self.rng.normal(0,self.noise,(n,4))
+        out[:,4] = out[:,3]-out[:,2] # T_hot - T_cold
+        out[:,5] = out[:,1]-out[:,2] # T_NTC - T_cold
+        out[:,6] = out[:,2]-out[:,0] # T_cold - dew point
+        return out
+
+
+def encode_ascii(frames):
+    """Encodes the frames as the ASCII lines of the Arduino"""
+    return "".join("inizio: "+" ".join("%.2f" % v for v in row)+"\r\n" for row in frames).encode()
+
+
+class ArduinoSimulator:
+    """
+    Generates the byte stream of the Arduino.
+
+    Parameters:
+    - binary (bool): default = False, binary frames instead of ASCII lines;
+    - corrupt (float): default = 0, probability of corrupting a byte of a frame;
+    - drop (float): default = 0, probability of dropping a frame;
+    - model (ColdBoxModel): default = None, a new ColdBoxModel;
+    """
+
+    def __init__(self,binary=False,corrupt=0.,drop=0.,model=None):
+        self.binary = binary
+        self.corrupt = corrupt
+        self.drop = drop
+        self.model = model if model is not None else ColdBoxModel()
+        self.seq = 0
+
+    def stream(self,n,dt=0.25):
+        """Returns the bytes of n frames spaced by dt seconds"""
+        frames = self.model.frames(n,dt)
+        chunks = []
+        for row in frames:
+            if self.binary:
+                data = binary_frames.encode_frames(row,self.seq)
+            else:
+                data = encode_ascii([row])
+            self.seq += 1
+            if random.random() < self.drop:
+                continue
+            if random.random() < self.corrupt:
+                data = bytearray(data)
+                data[random.randrange(len(data))] ^= 0xFF
+                data = bytes(data)
+            chunks.append(data)
+        return b"".join(chunks)
+
+
+def main():
+    # Parse arguments from terminal
+    parser = argparse.ArgumentParser(description="Simulator of the Arduino of the cold box.")
+    parser.add_argument('--binary', action='store_true', help="Send binary frames instead of ASCII lines.")
+    parser.add_argument('--rate', type=float, default=4, help="Frames per second (default is 4).")
+    parser.add_argument('--corrupt', type=float, default=0., help="Probability of corrupting a frame (default is 0).")
+    parser.add_argument('--drop', type=float, default=0., help="Probability of dropping a frame (default is 0).")
+
+    args = parser.parse_args()
+
+    master,slave = os.openpty()
+    print("Simulated Arduino on",os.ttyname(slave))
+    sim = ArduinoSimulator(args.binary,args.corrupt,args.drop)
+    dt = 1/args.rate
+    next_time = time.monotonic()
+    try:
+        while True:
+            os.write(master,sim.stream(1,dt))
+            next_time += dt
+            time.sleep(max(0,next_time-time.monotonic()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+asyncio acquisition engine, alternative to the loop of Acquisition.run.
+
+The Arduino reader, the three SMU pollers and the persistence sink are
+separate tasks, so a slow instrument does not stall the others:
+- the Arduino is read asynchronously (add_reader on the file descriptor of
+the serial port, or a thread of the executor where it is not available);
+- every Keithley has its own single thread executor, each reading has a
+timeout and the pollers update the last currents independently;
+- the frames of each read of the Arduino make a batch of samples with the
+last currents, which is written and passed to the sinks by the persistence task.
+When the currents are read at a fixed rate by a smu_scheduler.SmuScheduler
+the pollers are not started and the samples take the currents of the scheduler.
+
+The serial port, the Keithleys and the data file are the ones of an
+acquisition.Acquisition. In the GUI the engine runs on the thread of GetData
+(--engine asyncio) and the samples reach the Qt event loop through the
+dataBatch signal.
+"""
+import time
+import asyncio
+import concurrent.futures
+
+import channels
+import link_health
+
+
+class AsyncAcquisition:
+    """
+    Parameters:
+    - acq (acquisition.Acquisition): serial port, Keithleys and data file;
+    - smu_period (float): default = 1, seconds between two readings of a Keithley;
+    - smu_timeout (float): default = 5, timeout of a reading of a Keithley;
+    - frame_timeout (float): default = 30, a warning is printed if no
+    frame arrives from the Arduino for this time;
+    - queue_size (int): default = 10000, maximum number of batches waiting
+    to be written;
+    """
+
+    def __init__(self,acq,smu_period=1.,smu_timeout=5.,frame_timeout=30.,queue_size=10000):
+        self.acq = acq
+        self.smu_period = smu_period
+        self.smu_timeout = smu_timeout
+        self.frame_timeout = frame_timeout
+        self.queue_size = queue_size
+
+        # One executor for each Keithley
+        self.roles = list(channels.SMU_ROLES)
+        self.executors = {role: concurrent.futures.ThreadPoolExecutor(1,thread_name_prefix=role) for role in self.roles}
+        self.currents = dict(acq.last_currents) # [A]
+
+        # Counters
+        self.n_timeouts = {role: 0 for role in self.roles}
+        self.n_errors = {role: 0 for role in self.roles}
+        self.n_frame_timeouts = 0
+        self.n_dropped = 0
+
+        self.loop = None
+        self.tasks = []
+
+    async def read_arduino(self):
+        """
+        Reads the Arduino frames and puts the samples in the queue. If the
+        serial port fails it is reopened with backoff (see link_health.py).
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await self.read_frames(self.acq.Arduino)
+            except OSError as err: # serial errors, e.g. USB unplugged
+                self.acq.link_failed("arduino",err)
+            while not await loop.run_in_executor(None,self.acq.recover_serial):
+                await asyncio.sleep(0.1)
+
+    async def read_frames(self,arduino):
+        """Reads the frames of a serial port until it fails"""
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        try:
+            fd = arduino.fileno()
+            loop.add_reader(fd,ready.set)
+        except (AttributeError,OSError,NotImplementedError,ValueError):
+            fd = None # no selectable file descriptor: read on the executor
+
+        try:
+            while True:
+                try:
+                    if fd is not None:
+                        await asyncio.wait_for(ready.wait(),self.frame_timeout)
+                        ready.clear()
+                        chunk = arduino.read(arduino.in_waiting)
+                    else:
+                        chunk = await asyncio.wait_for(loop.run_in_executor(None,self.read_available),self.frame_timeout)
+                except asyncio.TimeoutError:
+                    self.n_frame_timeouts += 1
+                    print(f"No data from the Arduino for {self.frame_timeout} s")
+                    continue
+                frames = self.acq.parser.feed(chunk)
+                if not len(frames):
+                    continue
+                currents = self.acq.last_currents if self.acq.currents_scheduled else self.currents
+                batch = self.acq.schema.evaluate(frames,self.acq.frame_times(len(frames)),dict(currents))
+                try:
+                    self.queue.put_nowait(batch)
+                except asyncio.QueueFull:
+                    self.n_dropped += len(batch)
+        finally:
+            if fd is not None:
+                loop.remove_reader(fd)
+
+    def read_available(self):
+        """Blocking read of the serial port, used when add_reader is not available"""
+        arduino = self.acq.Arduino
+        data = arduino.read(max(1,arduino.in_waiting))
+        return data+arduino.read(arduino.in_waiting)
+
+    async def poll_smu(self,role):
+        """Measures periodically the current of a Keithley on its own executor"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = time.monotonic()
+            if self.acq.currents:
+                try:
+                    self.currents[role] = await asyncio.wait_for(loop.run_in_executor(self.executors[role],self.acq.measure_role,role),self.smu_timeout)
+                except asyncio.TimeoutError:
+                    self.n_timeouts[role] += 1
+                    print(f"{role}: no answer from the Keithley in {self.smu_timeout} s")
+                except link_health.LinkDown: # waiting to be reconnected (see supervisor.py)
+                    pass
+                except Exception as err: # VISA errors or closed sessions: keep the last value and retry
+                    self.n_errors[role] += 1
+                    print(f"{role}: {err}")
+            await asyncio.sleep(max(0,self.smu_period-(time.monotonic()-start)))
+
+    async def persist(self):
+        """Writes the batches of the queue and passes them to the sinks"""
+        while True:
+            batch = await self.queue.get()
+            if not self.acq.currents_scheduled:
+                self.acq.last_currents = dict(self.currents)
+            self.acq.publish(batch)
+            if self.queue.empty():
+                self.acq.flush()
+
+    async def watch(self):
+        """Ends the engine when the active flag of the acquisition is cleared"""
+        while self.acq.active:
+            await asyncio.sleep(0.1)
+            self.acq.flush() # samples held back while the GUI was behind
+
+    async def run(self):
+        """Runs all the tasks until stop() is called or acq.stop() clears the active flag"""
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.queue_size)
+        self.acq.start()
+        self.tasks = [asyncio.create_task(self.read_arduino(),name="arduino"),
+                      asyncio.create_task(self.persist(),name="persist")]
+        if not self.acq.currents_scheduled:
+            self.tasks += [asyncio.create_task(self.poll_smu(role),name=role) for role in self.roles]
+        watcher = asyncio.create_task(self.watch())
+        try:
+            done,pending = await asyncio.wait(self.tasks+[watcher],return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not watcher and not task.cancelled() and task.exception() is not None:
+                    print(f"Task {task.get_name()} failed: {task.exception()!r}")
+        finally:
+            for task in self.tasks+[watcher]:
+                task.cancel()
+            await asyncio.gather(*self.tasks,watcher,return_exceptions=True)
+            # Write the batches still in the queue
+            while not self.queue.empty():
+                self.acq.publish(self.queue.get_nowait())
+            self.acq.flush()
+            for executor in self.executors.values():
+                executor.shutdown(wait=False,cancel_futures=True)
+            self.acq.close()
+
+    def stop(self):
+        """Stops the engine, it can be called from any thread"""
+        self.acq.stop()
+
+
+async def run_engines(engines):
+    """Runs the engines of many stations in the same event loop"""
+    await asyncio.gather(*[engine.run() for engine in engines])
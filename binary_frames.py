@@ -0,0 +1,122 @@
+"""
+Binary frame protocol of the Arduino, alternative to the ASCII lines
+"inizio: dp tntc tcold thot dhc dcc ddc" (see firmware/binary_frames).
+
+Each frame is 36 bytes, little-endian:
+
+    offset  size  content
+    0       2     sync word 0xA55A (bytes 5A A5)
+    2       2     sequence counter (uint16, wraps around)
+    4       28    7 float32: dew point,T_NTC,T_cold,T_hot,T_hot-T_cold,T_NTC-T_cold,T_cold-dew point
+    32      4     CRC-32 (zlib/IEEE) of bytes 2-31
+
+The frames are decoded in bulk with numpy.frombuffer. A frame is accepted
+only with the sync word and the right CRC: at the first frame that fails,
+the stream is resynchronized on the next sync word after the start of
+that frame (so a short frame does not take the next one with it, and the
+parser does not lock on a sync word inside the values). The frames lost on
+the link are counted from the gaps of the sequence counter.
+"""
+import zlib
+import numpy as np
+
+from frame_parser import FRAME_LENGTH
+
+
+SYNC = 0xA55A
+SYNC_BYTES = SYNC.to_bytes(2,"little")
+FRAME_DTYPE = np.dtype([("sync","<u2"),("seq","<u2"),("values","<f4",(FRAME_LENGTH,)),("crc","<u4")])
+FRAME_SIZE = FRAME_DTYPE.itemsize
+
+
+def encode_frames(values,seq0=0):
+    """
+    Encodes an array of shape (n,FRAME_LENGTH) into binary frames, with
+    sequence counters starting from seq0. Used by the simulator.
+    """
+    values = np.asarray(values,dtype=np.float64).reshape(-1,FRAME_LENGTH)
+    frames = np.zeros(len(values),dtype=FRAME_DTYPE)
+    frames["sync"] = SYNC
+    frames["seq"] = (seq0+np.arange(len(values)))%65536
+    frames["values"] = values
+    raw = frames.view(np.uint8).reshape(-1,FRAME_SIZE)
+    frames["crc"] = [zlib.crc32(row[2:32].tobytes()) for row in raw]
+    return frames.tobytes()
+
+
+def frame_crcs(frames):
+    """CRC-32 of the bytes 2-31 of each frame"""
+    raw = frames.view(np.uint8).reshape(-1,FRAME_SIZE)
+    return np.fromiter((zlib.crc32(row[2:32]) for row in raw),dtype=np.uint32,count=len(frames))
+
+
+class BinaryFrameParser:
+    """
+    Incremental parser of the binary frames, with the same interface of
+    frame_parser.FrameParser.
+
+    Counters:
+    - n_frames: valid frames;
+    - n_malformed: frames with the sync word and a wrong CRC;
+    - n_lost: frames missing from the sequence counter;
+    - n_skipped: bytes discarded while looking for the sync word;
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        self.last_seq = None
+        self.n_frames = 0
+        self.n_malformed = 0
+        self.n_lost = 0
+        self.n_skipped = 0
+
+    def reset(self):
+        """Discards the partial frame and the sequence counter, e.g. after reopening the serial port"""
+        self.buffer = b""
+        self.last_seq = None
+
+    def feed(self,data):
+        """
+        Adds the bytes read from the serial port and returns the values of
+        the complete and valid frames as an array of shape (n,FRAME_LENGTH).
+        """
+        self.buffer += data
+        chunks = []
+        while len(self.buffer) >= FRAME_SIZE:
+            n = len(self.buffer)//FRAME_SIZE
+            frames = np.frombuffer(self.buffer,FRAME_DTYPE,count=n)
+            aligned = frames["sync"] == SYNC
+            aligned[aligned] = frame_crcs(frames[aligned]) == frames["crc"][aligned]
+            if aligned.all():
+                chunks.append(frames)
+                self.buffer = self.buffer[n*FRAME_SIZE:]
+                break
+            # Keep the valid frames and resynchronize after the start of the first bad one
+            k = int(np.argmin(aligned))
+            if k > 0:
+                chunks.append(frames[:k])
+            if frames["sync"][k] == SYNC:
+                self.n_malformed += 1
+            start = k*FRAME_SIZE
+            pos = self.buffer.find(SYNC_BYTES,start+1)
+            if pos < 0:
+                pos = len(self.buffer)-1 # the last byte may be the first of a sync word
+            self.n_skipped += pos-start
+            self.buffer = self.buffer[pos:]
+        if not chunks:
+            return np.empty((0,FRAME_LENGTH))
+        frames = np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+        return self.check(frames)
+
+    def check(self,frames):
+        """Counts the frames lost from the sequence counter of the valid frames"""
+        if len(frames):
+            seq = frames["seq"].astype(np.int64)
+            if self.last_seq is not None:
+                seq = np.concatenate(([self.last_seq],seq))
+            gaps = (np.diff(seq)-1)%65536
+            gaps[gaps >= 32768] = 0 # the counter went back: the Arduino was reset
+            self.n_lost += int(gaps.sum())
+            self.last_seq = int(frames["seq"][-1])
+        self.n_frames += len(frames)
+        return frames["values"].astype(np.float64)
@@ -0,0 +1,225 @@
+"""
+Online statistics of the channels, updated in O(1) for each sample:
+- mean and variance over a rolling window (Welford update with removal of
+the oldest sample);
+- exponentially weighted moving average (EWMA) and variance;
+- rolling minimum and maximum (monotonic queues);
+- slope over the window (least squares with running sums).
+
+Each new sample is also checked against the statistics of the previous
+ones: a spike is a value further than spike_sigma standard deviations
+from the rolling mean, a drift is a slope larger than the limit of the
+channel. The alarms are passed to the callables of the listeners list.
+"""
+import math
+import threading
+from collections import deque
+
+import channels
+
+
+# Default maximum slopes of the leakage currents [unit/s] << CHANGE WHEN NEEDED
+DRIFT_LIMITS = {"I_HV": 0.01,"I_pwell": 0.001,"I_psub": 0.001}
+
+
+class RollingStats:
+    """
+    Statistics of one channel.
+
+    Parameters:
+    - window (int): number of samples of the rolling window;
+    - alpha (float): default = 0.1, weight of the new sample in the EWMA;
+    """
+
+    def __init__(self,window,alpha=0.1):
+        self.window = window
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self.values = deque()
+        self.times = deque()
+        self.n_total = 0
+        # Welford
+        self.mean = 0.
+        self.m2 = 0.
+        # EWMA
+        self.ewma = None
+        self.ewvar = 0.
+        # Monotonic queues of (index, value) for min and max
+        self.minq = deque()
+        self.maxq = deque()
+        # Running sums for the slope, times relative to t0
+        self.t0 = None
+        self.st = self.stt = self.sy = self.sty = 0.
+
+    def update(self,t,x):
+        """Adds the sample (t,x)"""
+        if self.t0 is None:
+            self.t0 = t
+        tr = t-self.t0
+        i = self.n_total
+        self.n_total += 1
+
+        self.values.append(x)
+        self.times.append(tr)
+        n = len(self.values)
+        if n > self.window:
+            # Replace the oldest sample: Welford update with removal
+            xo = self.values.popleft()
+            to = self.times.popleft()
+            n -= 1
+            old_mean = self.mean
+            self.mean += (x-xo)/n
+            self.m2 += (x-xo)*(x-self.mean+xo-old_mean)
+            self.st -= to
+            self.stt -= to*to
+            self.sy -= xo
+            self.sty -= to*xo
+        else:
+            delta = x-self.mean
+            self.mean += delta/n
+            self.m2 += delta*(x-self.mean)
+        self.m2 = max(self.m2,0.) # rounding errors
+        self.st += tr
+        self.stt += tr*tr
+        self.sy += x
+        self.sty += tr*x
+
+        # EWMA
+        if self.ewma is None:
+            self.ewma = x
+        else:
+            diff = x-self.ewma
+            incr = self.alpha*diff
+            self.ewma += incr
+            self.ewvar = (1-self.alpha)*(self.ewvar+diff*incr)
+
+        # Rolling min and max
+        while self.minq and self.minq[-1][1] >= x:
+            self.minq.pop()
+        self.minq.append((i,x))
+        while self.maxq and self.maxq[-1][1] <= x:
+            self.maxq.pop()
+        self.maxq.append((i,x))
+        first = i-len(self.values)+1
+        while self.minq[0][0] < first:
+            self.minq.popleft()
+        while self.maxq[0][0] < first:
+            self.maxq.popleft()
+
+    @property
+    def n(self):
+        return len(self.values)
+
+    @property
+    def std(self):
+        n = len(self.values)
+        return math.sqrt(self.m2/(n-1)) if n > 1 else 0.
+
+    @property
+    def min(self):
+        return self.minq[0][1] if self.minq else math.nan
+
+    @property
+    def max(self):
+        return self.maxq[0][1] if self.maxq else math.nan
+
+    @property
+    def slope(self):
+        """Slope of the least squares line over the window [unit/s]"""
+        n = len(self.values)
+        den = n*self.stt-self.st*self.st
+        if n < 2 or den <= 0:
+            return 0.
+        return (n*self.sty-self.st*self.sy)/den
+
+    def snapshot(self):
+        return {"n": self.n,"mean": self.mean,"std": self.std,"min": self.min,"max": self.max,
+                "slope": self.slope,"ewma": self.ewma if self.ewma is not None else math.nan,
+                "ewstd": math.sqrt(self.ewvar)}
+
+
+class ChannelStats:
+    """
+    Statistics of all the channels, sink of acquisition.Acquisition (it
+    takes the batches of samples).
+
+    Parameters:
+    - window (int): default = 100, samples of the rolling windows;
+    - names (list of str): default = None, channels to follow (all but time if None);
+    - spike_sigma (float): default = 6, a sample further than spike_sigma
+    standard deviations from the rolling mean is a spike;
+    - min_samples (int): default = 20, samples needed before checking for spikes
+    and drifts, at most the window (the checks would never start otherwise);
+    - drift_limits (dict): default = None, maximum absolute slope of each
+    channel [unit/s], no drift check for the channels not in the dict;
+    - alpha (float): default = 0.1, weight of the EWMA;
+    """
+
+    def __init__(self,window=100,names=None,spike_sigma=6.,min_samples=20,drift_limits=None,alpha=0.1):
+        if names is None:
+            names = [name for name in channels.SCHEMA.names if name != "time"]
+        self.names = names
+        self.spike_sigma = spike_sigma
+        self.requested_min_samples = min_samples
+        self.min_samples = min(min_samples,window)
+        self.drift_limits = dict(drift_limits or {})
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.stats = {name: RollingStats(window,alpha) for name in names}
+        self.listeners = [] # called with (channel, kind, time, value, detail)
+        self.drifting = set()
+        self.n_spikes = {name: 0 for name in names}
+        self.n_drifts = {name: 0 for name in names}
+
+    def set_window(self,window):
+        """Changes the rolling window, the statistics restart"""
+        with self.lock:
+            self.min_samples = min(self.requested_min_samples,window)
+            self.stats = {name: RollingStats(window,self.alpha) for name in self.names}
+
+    def __call__(self,batch):
+        alarms = []
+        times = batch["time"].tolist()
+        with self.lock:
+            for name in self.names:
+                st = self.stats[name]
+                limit = self.drift_limits.get(name)
+                for t,x in zip(times,batch[name].tolist()):
+                    # Spike check against the previous samples
+                    if st.n >= self.min_samples:
+                        std = st.std
+                        if std > 0 and abs(x-st.mean) > self.spike_sigma*std:
+                            self.n_spikes[name] += 1
+                            alarms.append((name,"spike",t,x,(x-st.mean)/std))
+                    st.update(t,x)
+                    # Drift check, reported once until the slope is back below the limit
+                    if limit is not None and st.n >= self.min_samples:
+                        slope = st.slope
+                        if abs(slope) > limit:
+                            if name not in self.drifting:
+                                self.drifting.add(name)
+                                self.n_drifts[name] += 1
+                                alarms.append((name,"drift",t,x,slope))
+                        else:
+                            self.drifting.discard(name)
+        for alarm in alarms:
+            for listener in self.listeners:
+                listener(*alarm)
+
+    def snapshot(self,name):
+        """Returns a dict with the statistics of a channel"""
+        with self.lock:
+            snap = self.stats[name].snapshot()
+            snap["drifting"] = name in self.drifting
+            snap["spikes"] = self.n_spikes[name]
+            return snap
+
+
+def format_alarm(channel,kind,t,value,detail):
+    """Text of an alarm of ChannelStats"""
+    unit = channels.SCHEMA.unit(channel)
+    if kind == "spike":
+        return f"{channel} spike at t = {t:.1f} s: {value:.4g} {unit} ({detail:+.1f} sigma)"
+    return f"{channel} drift at t = {t:.1f} s: {detail:+.3g} {unit}/s"
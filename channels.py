@@ -0,0 +1,123 @@
+"""
+Declarative schema of the channels of a sample.
+
+Each channel has a name, a unit, a source and a scale. The source is a
+NumPy expression evaluated over a whole batch of frames at once, in which
+are available:
+- frame[k]: the k-th value of the Arduino frames;
+- smu['hv'], smu['pwell'], smu['psub']: the currents read by the Keithleys [A];
+- time: the time of the samples [s];
+- the channels defined before, by name;
+- abs, sqrt, exp, log, minimum, maximum, where and np.
+The result is multiplied by the scale (e.g. 1e6 for A -> uA).
+
+The order of CHANNELS is the order of the columns of the data files, so
+adding a sensor only means adding a channel here (and increasing the
+length of the Arduino frame if it is a new value of the frame).
+"""
+import numpy as np
+
+
+class Channel:
+    """
+    Parameters:
+    - name (str): name of the channel (a valid Python identifier);
+    - unit (str): unit of the channel, after scaling;
+    - source (str): expression of the channel, see above;
+    - scale (float): default = 1, factor applied to the source;
+    - label (str): default = None, label for plots and widgets (name if None);
+    """
+
+    def __init__(self,name,unit,source,scale=1.,label=None):
+        if not name.isidentifier():
+            raise ValueError(f"Channel name {name!r} is not a valid identifier")
+        self.name = name
+        self.unit = unit
+        self.source = source
+        self.scale = scale
+        self.label = label if label is not None else name
+        self.code = compile(source,f"<channel {name}>","eval")
+
+    def __repr__(self):
+        return f"Channel({self.name!r}, {self.unit!r}, {self.source!r}, scale={self.scale})"
+
+
+CHANNELS = [
+    Channel("time","s","time",label="Time"),
+    Channel("dew_point","*C","frame[0]",label="Dew point"),
+    Channel("T_NTC","*C","frame[1]",label="T_NTC chip"),
+    Channel("T_cold","*C","frame[2]",label="T_cold side Peltier"),
+    Channel("T_hot","*C","frame[3]",label="T_hot  side Peltier"),
+    Channel("dT_hot_cold","*C","abs(frame[4])",label="|T_hot-T_cold|"),
+    Channel("dT_NTC_cold","*C","frame[5]",label="T_NTC-T_cold"),
+    Channel("dT_cold_dp","*C","frame[6]",label="T_cold-Dew point"),
+    Channel("dT_NTC_hot","*C","T_NTC - T_hot",label="T_NTC-T_hot"),
+    Channel("dT_hot_dp","*C","T_hot - dew_point",label="T_hot-Dew point"),
+    Channel("I_HV","uA","smu['hv']",scale=1e6,label="I_HV"),
+    Channel("I_pwell","mA","smu['pwell']",scale=1e3,label="I_pwell"),
+    Channel("I_psub","mA","smu['psub']",scale=1e3,label="I_psub"),
+]
+
+# Functions available in the sources
+FUNCTIONS = {"abs": np.abs,"sqrt": np.sqrt,"exp": np.exp,"log": np.log,
+             "minimum": np.minimum,"maximum": np.maximum,"where": np.where,"np": np}
+
+# Roles of the Keithleys
+SMU_ROLES = ["hv","pwell","psub"]
+
+
+class ChannelSchema:
+    """
+    Evaluates the channels over batches of frames.
+
+    Parameters:
+    - channels (list of Channel): the channels, in the order of the data file;
+    """
+
+    def __init__(self,channels):
+        self.channels = list(channels)
+        self.names = [ch.name for ch in self.channels]
+        if len(set(self.names)) != len(self.names):
+            raise ValueError("Two channels have the same name")
+        self.by_name = {ch.name: ch for ch in self.channels}
+        self.dtype = np.dtype([(name,np.float64) for name in self.names])
+
+    def index(self,name):
+        return self.names.index(name)
+
+    def unit(self,name):
+        return self.by_name[name].unit
+
+    def label(self,name):
+        return self.by_name[name].label
+
+    def evaluate(self,frames,times,currents):
+        """
+        Returns the structured array (dtype) of the samples of the frames.
+
+        Parameters:
+        - frames (array): shape (n,frame length), values of the Arduino;
+        - times (float or array): time of the samples [s];
+        - currents (dict): current of each SMU role [A], a float or an array;
+        """
+        n = len(frames)
+        batch = np.empty(n,dtype=self.dtype)
+        namespace = dict(FUNCTIONS)
+        namespace["frame"] = np.asarray(frames).T
+        namespace["smu"] = currents
+        namespace["time"] = times
+        for ch in self.channels:
+            value = eval(ch.code,namespace)
+            if ch.scale != 1:
+                value = value*ch.scale
+            batch[ch.name] = value
+            namespace[ch.name] = batch[ch.name]
+        return batch
+
+    def from_rows(self,rows):
+        """Converts rows of values (e.g. lines of a data file) into a structured array"""
+        return np.asarray(rows,dtype=np.float64).reshape(-1,len(self.names)).view(self.dtype).ravel()
+
+
+SCHEMA = ChannelSchema(CHANNELS)
+SAMPLE_DTYPE = SCHEMA.dtype
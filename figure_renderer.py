@@ -0,0 +1,115 @@
+"""
+Rendering of the plots of the GUI on a worker thread.
+
+The GUI describes each figure with a plain spec (dicts, lists and NumPy
+arrays, no matplotlib objects) and submits it; a worker thread draws it
+with the Agg backend on a figure of its own and returns the RGBA image,
+which the widget only has to paint. Only the last spec of each figure is
+kept, so a slow rendering skips the intermediate frames instead of
+queueing them and the Qt event loop is never blocked by matplotlib.
+
+Spec of a figure:
+
+    {"size": (w,h) [inch], "dpi": dpi, "axes": [
+        {"title": str, "xlabel": str, "ylabel": str, "xlim": (t0,t1) or None,
+         "lines": [(x, y, color, label)],
+         "bands": [(x, low, high, color)],
+         "hlines": [(y, x0, x1, color, label)]},
+        ...]}
+
+Result: {"image": bytes (RGBA), "width": int, "height": int, "layout":
+[(position of the axes in figure coordinates, xlim, ylim)]}, the layout
+is used by the GUI to map the mouse on the axes (zoom, pan).
+"""
+import threading
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+def render(spec,figure=None):
+    """
+    Draws a spec and returns the result. A figure of a previous call with
+    the same number of axes can be given to be reused.
+    """
+    n_axes = len(spec["axes"])
+    if figure is None or len(figure.axes) != n_axes:
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        figure.subplots(n_axes,1,sharex=False,squeeze=False)
+    figure.set_dpi(spec["dpi"])
+    figure.set_size_inches(*spec["size"])
+
+    for ax,ax_spec in zip(figure.axes,spec["axes"]):
+        ax.cla()
+        ax.grid()
+        for x,y,color,label in ax_spec["lines"]:
+            ax.plot(x,y,color=color,label=label)
+        for x,low,high,color in ax_spec.get("bands",[]):
+            ax.fill_between(x,low,high,color=color,alpha=0.3,linewidth=0)
+        for y,x0,x1,color,label in ax_spec.get("hlines",[]):
+            ax.hlines(y,x0,x1,colors=color,label=label,linestyles="dashed")
+        ax.set_title(ax_spec["title"])
+        ax.set_xlabel(ax_spec["xlabel"])
+        ax.set_ylabel(ax_spec["ylabel"])
+        ax.legend(loc="upper left")
+        if ax_spec.get("xlim") is not None:
+            ax.set_xlim(ax_spec["xlim"])
+    figure.tight_layout()
+    figure.canvas.draw()
+
+    buffer = figure.canvas.buffer_rgba()
+    return figure,{"image": bytes(buffer),"width": buffer.shape[1],"height": buffer.shape[0],
+                   "layout": [(ax.get_position().bounds,ax.get_xlim(),ax.get_ylim()) for ax in figure.axes]}
+
+
+class FigureRenderer:
+    """
+    Worker thread rendering the specs of many figures.
+
+    Parameters:
+    - on_done (callable): called on the worker thread with (key, result)
+    for every rendered spec (e.g. the emit of a Qt signal);
+    """
+
+    def __init__(self,on_done):
+        self.on_done = on_done
+        self.pending = {} # last spec of each figure
+        self.figures = {} # figures of the worker, reused
+        self.condition = threading.Condition()
+        self.active = True
+        self.n_rendered = 0
+        self.n_skipped = 0 # specs replaced by a newer one before being rendered
+        self.thread = threading.Thread(target=self.run,name="renderer",daemon=True)
+        self.thread.start()
+
+    def submit(self,key,spec):
+        """Queues the spec of the figure key, replacing the one not yet rendered"""
+        with self.condition:
+            if key in self.pending:
+                self.n_skipped += 1
+            self.pending[key] = spec
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.active and not self.pending:
+                    self.condition.wait()
+                if not self.active:
+                    return
+                key = next(iter(self.pending))
+                spec = self.pending.pop(key)
+            try:
+                self.figures[key],result = render(spec,self.figures.get(key))
+            except Exception as err: # a bad spec must not stop the worker
+                print(f"Rendering of the figure {key} failed: {err!r}")
+                continue
+            self.n_rendered += 1
+            self.on_done(key,result)
+
+    def close(self):
+        with self.condition:
+            self.active = False
+            self.condition.notify()
+        self.thread.join(5)
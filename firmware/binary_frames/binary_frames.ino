@@ -0,0 +1,60 @@
+// Reference snippet of the binary frame protocol (see binary_frames.py).
+// It replaces the ASCII line
+//   Serial.print("inizio: "); Serial.print(dp); ... Serial.println(ddc);
+// of the Arduino code: call sendFrame() with the same 7 values.
+//
+// Frame (36 bytes, little-endian as the AVR/ARM Arduinos):
+//   uint16 sync = 0xA55A, uint16 seq, float values[7], uint32 crc32 of seq+values
+
+#include <Arduino.h>
+
+const uint16_t FRAME_SYNC = 0xA55A;
+
+struct __attribute__((packed)) Frame {
+  uint16_t sync;
+  uint16_t seq;
+  float values[7]; // dp, tntc, tcold, thot, dhc, dcc, ddc
+  uint32_t crc;
+};
+
+static uint16_t frameSeq = 0;
+
+// CRC-32 (IEEE 802.3, same as zlib.crc32), bitwise to save flash
+uint32_t crc32(const uint8_t *data, size_t len) {
+  uint32_t crc = 0xFFFFFFFF;
+  for (size_t i = 0; i < len; i++) {
+    crc ^= data[i];
+    for (uint8_t b = 0; b < 8; b++) {
+      crc = (crc >> 1) ^ (0xEDB88320 & (-(int32_t)(crc & 1)));
+    }
+  }
+  return ~crc;
+}
+
+void sendFrame(float dp, float tntc, float tcold, float thot, float dhc, float dcc, float ddc) {
+  Frame frame;
+  frame.sync = FRAME_SYNC;
+  frame.seq = frameSeq++;
+  frame.values[0] = dp;
+  frame.values[1] = tntc;
+  frame.values[2] = tcold;
+  frame.values[3] = thot;
+  frame.values[4] = dhc;
+  frame.values[5] = dcc;
+  frame.values[6] = ddc;
+  // CRC of seq and values (bytes 2-31)
+  frame.crc = crc32((const uint8_t *)&frame.seq, sizeof(frame.seq) + sizeof(frame.values));
+  Serial.write((const uint8_t *)&frame, sizeof(frame));
+}
+
+// Example: test pattern at 10 Hz
+void setup() {
+  Serial.begin(115200);
+}
+
+void loop() {
+  float t = millis() / 1000.0;
+  float dp = -40.0, tntc = -20.0 + sin(t), tcold = -25.0, thot = 20.0;
+  sendFrame(dp, tntc, tcold, thot, thot - tcold, tntc - tcold, tcold - dp);
+  delay(100);
+}
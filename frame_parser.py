@@ -0,0 +1,80 @@
+"""
+Incremental parser of the ASCII frames of the Arduino:
+
+    inizio: dp tntc tcold thot dhc dcc ddc
+
+The parser is fed with all the bytes available on the serial port: the
+complete lines are converted together in one NumPy step, the last partial
+line is kept for the next read instead of being lost as a bad frame.
+"""
+import numpy as np
+
+
+FRAME_HEADER = b"inizio:" # CHANGE accordingly to Arduino code!!!
+# Values of a frame: dew point,T_NTC,T_cold,T_hot,T_hot-T_cold,T_NTC-T_cold,T_cold-dew point
+FRAME_LENGTH = 7
+
+
+class FrameParser:
+    """
+    Parameters:
+    - max_line (int): default = 512, a partial line longer than this is
+    discarded (e.g. garbage on the serial port) and counted as malformed;
+
+    Counters:
+    - n_frames: valid frames;
+    - n_malformed: lines starting with the header but with wrong values;
+    - n_other: other lines (e.g. messages printed by the Arduino);
+    """
+
+    def __init__(self,max_line=512):
+        self.max_line = max_line
+        self.buffer = b""
+        self.n_frames = 0
+        self.n_malformed = 0
+        self.n_other = 0
+
+    def reset(self):
+        """Discards the partial line, e.g. after reopening the serial port"""
+        self.buffer = b""
+
+    def feed(self,data):
+        """
+        Adds the bytes read from the serial port and returns the complete
+        frames as an array of shape (n,FRAME_LENGTH).
+        """
+        self.buffer += data
+        if b"\n" not in self.buffer:
+            if len(self.buffer) > self.max_line:
+                self.n_malformed += 1
+                self.buffer = b""
+            return np.empty((0,FRAME_LENGTH))
+        *lines,self.buffer = self.buffer.split(b"\n")
+
+        values = []
+        for line in lines:
+            words = line.split()
+            if not words:
+                continue
+            if words[0] != FRAME_HEADER:
+                self.n_other += 1
+            elif len(words) != FRAME_LENGTH+1:
+                self.n_malformed += 1
+            else:
+                values.append(words[1:])
+        if not values:
+            return np.empty((0,FRAME_LENGTH))
+
+        try:
+            frames = np.array(values,dtype=np.float64)
+        except ValueError:
+            # Some values are not numbers: convert line by line to find them
+            good = []
+            for words in values:
+                try:
+                    good.append([float(w) for w in words])
+                except ValueError:
+                    self.n_malformed += 1
+            frames = np.array(good,dtype=np.float64).reshape(-1,FRAME_LENGTH)
+        self.n_frames += len(frames)
+        return frames
@@ -0,0 +1,295 @@
+"""
+Headless version of the C & T monitor, for unattended runs.
+
+It runs the same serial/SMU acquisition and persistence pipeline of the GUI
+(see acquisition.py) without loading Qt or matplotlib.
+With --serve the samples are also streamed on a local TCP port, so that
+the GUI can attach later with:
+
+    python temp_curr_monitor_new.py --attach localhost:PORT
+
+With --stations many stations (see stations.py) are acquired by the same
+process; the samples of the i-th station are served on PORT+i.
+With --bus the samples are also published on shared memory for the local
+programs (see sample_bus.py), and with --metrics the channels and the
+health of the acquisition are exported for Prometheus (see metrics_exporter.py).
+With --control the station accepts commands (ramps, pause of the currents,
+reconnection of the Keithleys, interlock, stop) from another process, e.g.
+the GUI of temp_curr_monitor_new.py --split (see station_control.py).
+The stacks of all the threads are sampled for --profile seconds when the
+process receives SIGUSR1 (kill -USR1 PID), the capture is written next to
+the data file as a flame graph (see stack_sampler.py).
+"""
+import sys
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import threading
+
+import acquisition
+import async_acquisition
+import channel_stats
+import history_pyramid
+import interlock
+import run_catalog
+import metrics_exporter
+import sample_bus
+import smu_profiles
+import smu_scheduler
+import stack_sampler
+import station_control
+import supervisor
+import stations
+
+
+class SampleServer:
+    """
+    Streams every sample (one line of the data file format) to all the
+    connected clients. Slow or closed clients are dropped.
+
+    Parameters:
+    - port (int): TCP port;
+    - host (str): default = "localhost", interface to listen on;
+    """
+
+    def __init__(self,port,host="localhost"):
+        self.server = socket.create_server((host,port))
+        self.clients = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.accept_loop,daemon=True)
+        self.thread.start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn,addr = self.server.accept()
+            except OSError:
+                break # server closed
+            conn.settimeout(1)
+            print("Client attached:",addr)
+            with self.lock:
+                self.clients.append(conn)
+
+    def __call__(self,batch):
+        line = acquisition.format_batch(batch).encode()
+        with self.lock:
+            for conn in self.clients[:]:
+                try:
+                    conn.sendall(line)
+                except OSError:
+                    print("Client detached")
+                    conn.close()
+                    self.clients.remove(conn)
+
+    def close(self):
+        self.server.close()
+        with self.lock:
+            for conn in self.clients:
+                conn.close()
+            self.clients = []
+
+
+def main():
+    # Parse arguments from terminal
+    parser = argparse.ArgumentParser(description="Headless temperatures and currents monitor.")
+    parser.add_argument('--directory', default=acquisition.DATA_DIRECTORY, help="Directory of the output data file.")
+    parser.add_argument('--port', default=acquisition.ARDUINO_PORT, help="Serial port of the Arduino.")
+    parser.add_argument('--no-currents', action='store_true', help="Do not use the Keithleys.")
+    parser.add_argument('--binary', action='store_true', help="The Arduino sends binary frames (see binary_frames.py).")
+    parser.add_argument('--chip', choices=stations.CHIPS, default=None, help="Chip under test, recorded in the catalog of the runs.")
+    parser.add_argument('--no-catalog', action='store_true', help="Do not add the runs to the catalog of the data directory (see run_catalog.py).")
+    parser.add_argument('--stations', default=None, help="JSON file with the stations to acquire (overrides --directory and --port).")
+    parser.add_argument('--engine', choices=["threads","asyncio"], default="threads", help="Acquisition engine (default is threads).")
+    parser.add_argument('--serve', type=int, default=None, help="TCP port on which the GUI can attach.")
+    parser.add_argument('--bus', nargs='?', const="ctmon", default=None, help="Publish the samples on shared memory named PREFIX-station (default prefix is ctmon, see sample_bus.py).")
+    parser.add_argument('--duration', type=float, default=None, help="Duration of the run in seconds (default is until stopped).")
+    parser.add_argument('--stats-window', type=int, default=100, help="Samples of the rolling statistics of the channels (default is 100).")
+    parser.add_argument('--no-interlock', action='store_true', help="Do not ramp down the voltages when a safety rule is violated (see interlock.py).")
+    parser.add_argument('--profiles', default=None, help="Speed profiles of the Keithleys, e.g. fast or hv=low-noise,psub=fast (see smu_profiles.py).")
+    parser.add_argument('--smu-period', type=float, default=smu_scheduler.SMU_PERIOD, help="Period of the readings of the Keithleys in seconds, on a fixed grid (default is %g, 0 to read them with each frame)." % smu_scheduler.SMU_PERIOD)
+    parser.add_argument('--control', type=int, nargs='?', const=station_control.CONTROL_PORT, default=None, help="TCP port of the commands of the station on localhost, PORT+i for the i-th station (default is %d, see station_control.py)." % station_control.CONTROL_PORT)
+    parser.add_argument('--metrics', type=int, nargs='?', const=metrics_exporter.METRICS_PORT, default=None, help="TCP port of the OpenMetrics endpoint on localhost (default is %d)." % metrics_exporter.METRICS_PORT)
+    parser.add_argument('--profile', type=float, default=stack_sampler.PROFILE_DURATION, help="Seconds of the capture of the stacks started by SIGUSR1, a second SIGUSR1 stops it (default is %g)." % stack_sampler.PROFILE_DURATION)
+    parser.add_argument('--status', type=float, default=600, help="Interval between status prints in seconds (default is 600).")
+
+    args = parser.parse_args()
+    profiles = smu_profiles.parse_profiles(args.profiles) if args.profiles else None
+
+    if args.stations is not None:
+        station_list = stations.load_stations(args.stations)
+    else:
+        station_list = [stations.Station(port=args.port,directory=args.directory,currents=not args.no_currents,
+                                         binary=args.binary,chip=args.chip or stations.CHIPS[0])]
+    acqs = [st.open() for st in station_list]
+    if args.stations is None:
+        acqs[0].chip = args.chip # None in the catalog if unknown
+    for acq in acqs:
+        print("Saving data on",acq.filename)
+
+    # Catalog of the runs of the data directory, updated when the runs are closed
+    recorders = []
+    if not args.no_catalog:
+        for acq in acqs:
+            recorders.append(run_catalog.RunRecorder(acq))
+            acq.sinks.append(recorders[-1])
+
+    # Rolling statistics of the channels, the alarms are printed
+    for acq in acqs:
+        stats = channel_stats.ChannelStats(args.stats_window,drift_limits=channel_stats.DRIFT_LIMITS)
+        prefix = f"{acq.station}: " if acq.station else ""
+        stats.listeners.append(lambda *alarm,prefix=prefix: print(datetime_now(),prefix+channel_stats.format_alarm(*alarm)))
+        acq.sinks.append(stats)
+
+    # History of the runs at several resolutions, saved next to the data files
+    pyramids = []
+    for acq in acqs:
+        pyramid = history_pyramid.HistoryPyramid(path=history_pyramid.pyramid_path(acq.filename))
+        acq.sinks.append(pyramid)
+        pyramids.append(pyramid)
+
+    # Safety interlock of the stations with the Keithleys
+    interlocks = []
+    if not args.no_interlock:
+        for acq in acqs:
+            if acq.currents:
+                safety = interlock.Interlock(acq)
+                acq.sinks.insert(0,safety)
+                safety.start()
+                interlocks.append(safety)
+
+    # Speed profiles of the Keithleys
+    for acq in acqs:
+        if acq.currents:
+            smu_profiles.apply_profiles(acq,profiles)
+
+    # Fixed-rate readings of the Keithleys
+    smu_schedulers = []
+    if args.smu_period > 0:
+        for acq in acqs:
+            if acq.currents:
+                smu = smu_scheduler.SmuScheduler(acq,args.smu_period)
+                smu.sinks += [safety.check_currents for safety in interlocks if safety.acq is acq]
+                smu.start()
+                smu_schedulers.append(smu)
+
+    # Reconnection of the Keithleys that fail
+    supervisors = []
+    for acq in acqs:
+        if acq.currents:
+            supervisors.append(supervisor.SmuSupervisor(acq))
+            supervisors[-1].start()
+
+    servers = []
+    if args.serve is not None:
+        for i,acq in enumerate(acqs):
+            server = SampleServer(args.serve+i)
+            acq.sinks.append(server)
+            servers.append(server)
+            print("Serving samples of",acq.station or "the station","on port",args.serve+i)
+
+    buses = []
+    if args.bus is not None:
+        for acq in acqs:
+            bus = sample_bus.SampleBus(sample_bus.bus_name(args.bus,acq.station))
+            acq.sinks.append(bus)
+            buses.append(bus)
+            print("Publishing samples of",acq.station or "the station","on the shared memory",bus.name)
+
+    exporter = None
+    if args.metrics is not None:
+        exporter = metrics_exporter.MetricsExporter(args.metrics)
+        for acq in acqs:
+            smu = next((s for s in smu_schedulers if s.acq is acq),None)
+            acq.sinks.append(exporter.add(acq,smu))
+        exporter.start()
+        print("Metrics on http://localhost:%d/metrics" % args.metrics)
+
+    scheduler = stations.StationScheduler(acqs)
+
+    # Commands from the GUI
+    controls = []
+    if args.control is not None:
+        for i,acq in enumerate(acqs):
+            control = station_control.StationControl(acq,next((s for s in interlocks if s.acq is acq),None),
+                                                     next((r for r in recorders if r.acq is acq),None),
+                                                     next((s for s in smu_schedulers if s.acq is acq),None),
+                                                     on_stop=scheduler.stop)
+            controls.append(station_control.ControlServer(control,args.control+i))
+            print("Commands of",acq.station or "the station","on port",args.control+i)
+
+    # Stop cleanly with Ctrl+C or kill
+    signal.signal(signal.SIGINT, lambda *_: scheduler.stop())
+    signal.signal(signal.SIGTERM, lambda *_: scheduler.stop())
+
+    # Capture of the stacks on demand
+    captures = []
+    def save_profile(sampler):
+        path = stack_sampler.profile_file_name(acqs[0].filename)
+        sampler.save(path)
+        print(sampler.summary())
+        print(f"{datetime_now()} profile saved on {path}")
+    def toggle_profile(*_):
+        if captures and captures[-1].running():
+            captures[-1].stop_event.set()
+            return
+        print(f"{datetime_now()} profiling for {args.profile:g} s")
+        captures.append(stack_sampler.StackSampler(on_done=save_profile))
+        captures[-1].start(args.profile)
+    if hasattr(signal,"SIGUSR1"):
+        signal.signal(signal.SIGUSR1, toggle_profile)
+
+    if args.engine == "asyncio":
+        engines = [async_acquisition.AsyncAcquisition(acq) for acq in acqs]
+        worker = threading.Thread(target=asyncio.run,args=(async_acquisition.run_engines(engines),))
+    else:
+        worker = threading.Thread(target=scheduler.run)
+    worker.start()
+
+    starttime = time.time()
+    last_status = starttime
+    while worker.is_alive():
+        worker.join(0.5)
+        now = time.time()
+        if args.duration is not None and now-starttime > args.duration:
+            scheduler.stop()
+        if now-last_status > args.status:
+            last_status = now
+            print(f"{datetime_now()} samples: {[acq.n_samples for acq in acqs]}")
+            for acq in acqs:
+                if acq.outages or acq.links_down():
+                    outage = sum(report["outage"] for report in acq.outages)
+                    print(f"{datetime_now()} {acq.station or 'station'}: {len(acq.outages)} outages ({outage:.1f} s), "+", ".join(acq.links_down() or ["all links up"]))
+            for smu in smu_schedulers:
+                print(f"{datetime_now()} {smu.acq.station or 'station'}: {smu.status()}")
+                print(f"{datetime_now()} {smu.acq.station or 'station'}: SMU commands {smu.acq.broker.status()}")
+
+    for sampler in captures:
+        sampler.stop()
+    for smu in smu_schedulers:
+        smu.stop()
+    for supervision in supervisors:
+        supervision.stop()
+    for safety in interlocks:
+        safety.close()
+    for pyramid in pyramids:
+        pyramid.close()
+    for server in servers:
+        server.close()
+    for control in controls:
+        control.close()
+    for bus in buses:
+        bus.close()
+    if exporter is not None:
+        exporter.close()
+    for acq in acqs:
+        print("Acquisition stopped,",acq.n_samples,"samples saved on",acq.filename)
+
+
+def datetime_now():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
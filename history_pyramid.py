@@ -0,0 +1,261 @@
+"""
+Multi-resolution history of a run: for each tier (e.g. 1 s, 10 s, 1 min,
+10 min) the samples are grouped in buckets of fixed duration, and each
+bucket keeps the number of samples and the minimum, maximum and mean of
+every channel. The tiers are updated incrementally: the samples fill the
+buckets of the first tier, each closed bucket of a tier fills the buckets
+of the next one.
+
+The closed buckets are appended to one binary file per tier in a
+directory next to the data file (see pyramid_path), with a meta.json
+describing the columns, so the pyramid of a run can be reopened with
+load_pyramid. Without a path the tiers are kept in memory.
+
+A plot of any time span uses select(): the finest tier with at most
+max_points buckets in the span, so the cost of a redraw does not depend
+on the length of the run.
+"""
+import os
+import json
+import threading
+
+import numpy as np
+
+import channels
+
+
+# Widths of the tiers [s]
+TIERS = [1,10,60,600]
+# Maximum number of points of a plot
+MAX_POINTS = 2000
+
+
+def pyramid_path(filename):
+    """Directory of the pyramid of a data file: the name of the file without .dat, plus -pyramid"""
+    return os.path.splitext(filename)[0]+"-pyramid"
+
+
+def record_dtype(names):
+    """
+    Structured dtype of the buckets: time (start of the bucket), count, then
+    the minimum, the maximum and the mean of every channel.
+    """
+    fields = [("time",np.float64),("count",np.float64)]
+    for suffix in ["min","max","mean"]:
+        fields += [(f"{name}_{suffix}",np.float64) for name in names]
+    return np.dtype(fields)
+
+
+class Tier:
+    """
+    Buckets of a given width.
+
+    Parameters:
+    - width (float): duration of a bucket [s];
+    - names (list of str): the channels;
+    - path (str): default = None, file where the closed buckets are appended
+    (they are kept in memory if None);
+    """
+
+    def __init__(self,width,names,path=None):
+        self.width = width
+        self.names = names
+        self.dtype = record_dtype(names)
+        self.columns = len(self.dtype.names)
+        self.path = path
+        self.n = 0
+        # Open bucket: index, count and accumulators (min, max, sum) of each channel
+        self.open_index = None
+        self.open = None
+        self.pending = []
+        if path is None:
+            self.records = np.empty((1024,self.columns))
+            self.file = None
+        else:
+            self.records = None
+            self.file = open(path,"wb")
+
+    def add(self,times,counts,mins,maxs,sums):
+        """
+        Adds samples (or the buckets of the previous tier) sorted by time.
+        mins, maxs and sums have shape (n,channels). It returns the buckets
+        closed by the new data in the same form, for the next tier.
+        """
+        if len(times) == 0:
+            return None
+        idx = np.floor(np.asarray(times)/self.width).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True,idx[1:] != idx[:-1]])
+        g_idx = idx[starts]
+        g_count = np.add.reduceat(counts,starts)
+        g_min = np.fmin.reduceat(mins,starts,axis=0)
+        g_max = np.fmax.reduceat(maxs,starts,axis=0)
+        g_sum = np.add.reduceat(sums,starts,axis=0)
+
+        closed = []
+        if self.open_index is not None:
+            o_count,o_min,o_max,o_sum = self.open
+            if self.open_index == g_idx[0]:
+                # The first group goes in the open bucket
+                g_count[0] += o_count
+                g_min[0] = np.fmin(g_min[0],o_min)
+                g_max[0] = np.fmax(g_max[0],o_max)
+                g_sum[0] += o_sum
+            else:
+                closed.append((np.array([self.open_index]),np.array([o_count]),o_min[None],o_max[None],o_sum[None]))
+        if len(g_idx) > 1:
+            closed.append((g_idx[:-1],g_count[:-1],g_min[:-1],g_max[:-1],g_sum[:-1]))
+        self.open_index = g_idx[-1]
+        self.open = (g_count[-1],g_min[-1],g_max[-1],g_sum[-1])
+        if not closed:
+            return None
+        c_idx,c_count,c_min,c_max,c_sum = [np.concatenate(parts) for parts in zip(*closed)]
+        c_times = c_idx*self.width
+        self.store(np.column_stack([c_times,c_count,c_min,c_max,c_sum/c_count[:,None]]))
+        return c_times,c_count,c_min,c_max,c_sum
+
+    def finish(self):
+        """Closes the open bucket (end of the run), it returns it like add()"""
+        if self.open_index is None:
+            return None
+        o_count,o_min,o_max,o_sum = self.open
+        t = self.open_index*self.width
+        self.open_index = None
+        self.open = None
+        self.store(np.concatenate([[t,o_count],o_min,o_max,o_sum/o_count])[None])
+        return np.array([t]),np.array([o_count]),o_min[None],o_max[None],o_sum[None]
+
+    def store(self,rows):
+        if self.file is not None:
+            self.pending.append(rows)
+            self.n += len(rows)
+            return
+        if self.n+len(rows) > len(self.records):
+            grown = np.empty((max(2*len(self.records),self.n+len(rows)),self.columns))
+            grown[:self.n] = self.records[:self.n]
+            self.records = grown
+        self.records[self.n:self.n+len(rows)] = rows
+        self.n += len(rows)
+
+    def flush(self):
+        """Appends the closed buckets to the file"""
+        if self.file is not None and self.pending:
+            np.concatenate(self.pending).tofile(self.file)
+            self.pending = []
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+
+    def closed(self):
+        """Returns the closed buckets as a 2D array (a memory map of the file if there is one)"""
+        if self.path is None:
+            return self.records[:self.n]
+        rows = os.path.getsize(self.path)//(8*self.columns)
+        if rows == 0:
+            return np.empty((0,self.columns))
+        return np.memmap(self.path,dtype=np.float64,mode="r",shape=(rows,self.columns))
+
+    def view(self,t0,t1):
+        """Returns the buckets overlapping [t0,t1] (structured array), open bucket included"""
+        closed = self.closed()
+        times = closed[:,0]
+        first = max(np.searchsorted(times,t0,side="right")-1,0)
+        last = np.searchsorted(times,t1,side="right")
+        rows = np.array(closed[first:last])
+        if self.pending:
+            # Closed buckets not yet written on the file
+            pending = np.concatenate(self.pending)
+            pending = pending[(pending[:,0] > t0-self.width) & (pending[:,0] <= t1)]
+            rows = np.vstack([rows,pending])
+        if self.open is not None and self.open_index*self.width <= t1:
+            o_count,o_min,o_max,o_sum = self.open
+            rows = np.vstack([rows,np.concatenate([[self.open_index*self.width,o_count],o_min,o_max,o_sum/o_count])])
+        return np.ascontiguousarray(rows).view(self.dtype).ravel()
+
+
+class HistoryPyramid:
+    """
+    Sink of acquisition.Acquisition that keeps the tiers of a run.
+
+    Parameters:
+    - names (list of str): default = None, channels (all but time if None);
+    - tiers (list of float): default = TIERS, widths of the tiers [s];
+    - path (str): default = None, directory of the files of the tiers
+    (see pyramid_path), in memory if None;
+    """
+
+    def __init__(self,names=None,tiers=TIERS,path=None):
+        if names is None:
+            names = [name for name in channels.SCHEMA.names if name != "time"]
+        self.names = names
+        self.widths = sorted(tiers)
+        self.path = path
+        self.lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path,exist_ok=True)
+            with open(os.path.join(path,"meta.json"),"w") as f:
+                json.dump({"names": names,"tiers": self.widths,"columns": list(record_dtype(names).names)},f)
+        self.tiers = [Tier(w,names,os.path.join(path,f"tier-{w:g}s.bin") if path is not None else None) for w in self.widths]
+        self.last_time = None
+
+    def __call__(self,batch):
+        if not len(batch):
+            return
+        times = batch["time"]
+        values = np.column_stack([batch[name] for name in self.names])
+        with self.lock:
+            rows = (times,np.ones(len(batch)),values,values,values)
+            for tier in self.tiers:
+                rows = tier.add(*rows)
+                if rows is None:
+                    break
+            self.last_time = float(times[-1])
+
+    def flush(self):
+        with self.lock:
+            for tier in self.tiers:
+                tier.flush()
+
+    def close(self):
+        """Closes the open buckets of all the tiers and the files"""
+        with self.lock:
+            rows = None
+            for tier in self.tiers:
+                parts = [part for part in [tier.add(*rows) if rows is not None else None,tier.finish()] if part is not None]
+                rows = tuple(np.concatenate(p) for p in zip(*parts)) if parts else None
+                tier.close()
+
+    def select(self,t0,t1,max_points=MAX_POINTS):
+        """
+        Returns (width,buckets) of the finest tier with at most max_points
+        buckets in [t0,t1], or None if the span is short enough for the
+        samples themselves (less than max_points seconds of the first tier).
+        """
+        span = max(t1-t0,0)
+        if span <= max_points*self.widths[0]:
+            return None
+        for tier in self.tiers:
+            if span/tier.width <= max_points:
+                break
+        with self.lock:
+            return tier.width,tier.view(t0,t1)
+
+
+def load_pyramid(path):
+    """
+    Returns the tiers of a saved pyramid, a dict width: structured array of
+    the buckets (memory maps of the files).
+    """
+    with open(os.path.join(path,"meta.json")) as f:
+        meta = json.load(f)
+    dtype = record_dtype(meta["names"])
+    tiers = {}
+    for w in meta["tiers"]:
+        filename = os.path.join(path,f"tier-{w:g}s.bin")
+        if os.path.getsize(filename) == 0:
+            tiers[w] = np.empty(0,dtype=dtype)
+        else:
+            tiers[w] = np.memmap(filename,dtype=dtype,mode="r")
+    return tiers
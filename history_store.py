@@ -0,0 +1,127 @@
+"""
+History of the samples of a run with bounded memory.
+
+The last samples (the tail) are kept in a NumPy structured array, the
+older ones are appended to a binary file on disk and read back through a
+memory map, so the memory used does not depend on the length of the run:
+the pages of the file are loaded only when a span of the past is accessed
+and can always be dropped by the system.
+
+The samples are accessed by index, as one sequence (store[i], store[a:b],
+store.last(n)), or by time range (store.time_range(t0,t1)).
+"""
+import tempfile
+
+import numpy as np
+
+import channels
+
+
+class HistoryStore:
+    """
+    Parameters:
+    - dtype (numpy.dtype): default = channels.SAMPLE_DTYPE, dtype of the samples;
+    - tail (int): default = 100000, samples kept in memory;
+    - directory (str): default = None, directory of the spill file (the
+    temporary directory if None), the file is deleted by close();
+    """
+
+    def __init__(self,dtype=channels.SAMPLE_DTYPE,tail=100000,directory=None):
+        self.dtype = np.dtype(dtype)
+        self.tail_size = tail
+        self.buffer = np.empty(tail,dtype=self.dtype)
+        self.n_tail = 0
+        self.n_spilled = 0
+        self.file = tempfile.NamedTemporaryFile(prefix="history-",suffix=".bin",dir=directory)
+        self.spilled_map = None
+
+    def __len__(self):
+        return self.n_spilled+self.n_tail
+
+    def append(self,batch):
+        """Adds a batch of samples (structured array of dtype)"""
+        batch = np.asarray(batch,dtype=self.dtype)
+        if len(batch) >= self.tail_size:
+            # Larger than the tail: everything but the last tail samples goes on disk
+            self.spill(self.n_tail)
+            self.write(batch[:-self.tail_size])
+            batch = batch[-self.tail_size:]
+        elif self.n_tail+len(batch) > self.tail_size:
+            # Spill the oldest half of the tail (at least the room needed)
+            self.spill(max(self.tail_size//2,self.n_tail+len(batch)-self.tail_size))
+        self.buffer[self.n_tail:self.n_tail+len(batch)] = batch
+        self.n_tail += len(batch)
+
+    def spill(self,n):
+        """Moves the oldest n samples of the tail to the file"""
+        if n <= 0:
+            return
+        self.write(self.buffer[:n])
+        self.buffer[:self.n_tail-n] = self.buffer[n:self.n_tail]
+        self.n_tail -= n
+
+    def write(self,records):
+        self.file.write(records.tobytes())
+        self.file.flush()
+        self.n_spilled += len(records)
+
+    def spilled(self):
+        """Returns the samples on disk (memory map)"""
+        if self.n_spilled == 0:
+            return np.empty(0,dtype=self.dtype)
+        if self.spilled_map is None or len(self.spilled_map) != self.n_spilled:
+            self.spilled_map = np.memmap(self.file.name,dtype=self.dtype,mode="r",shape=(self.n_spilled,))
+        return self.spilled_map
+
+    def __getitem__(self,key):
+        """Sample i or samples of a slice (the slices are copied in memory)"""
+        n = len(self)
+        if isinstance(key,slice):
+            start,stop,step = key.indices(n)
+            if step != 1:
+                return self[start:stop][::step]
+            stop = max(stop,start)
+            parts = []
+            if start < self.n_spilled:
+                parts.append(np.array(self.spilled()[start:min(stop,self.n_spilled)]))
+            if stop > self.n_spilled:
+                parts.append(self.buffer[max(start-self.n_spilled,0):stop-self.n_spilled].copy())
+            if not parts:
+                return np.empty(0,dtype=self.dtype)
+            return parts[0] if len(parts) == 1 else np.concatenate(parts)
+        if key < 0:
+            key += n
+        if not 0 <= key < n:
+            raise IndexError("history index out of range")
+        if key < self.n_spilled:
+            return np.array(self.spilled()[key])
+        return self.buffer[key-self.n_spilled].copy()
+
+    def last(self,n):
+        """Returns the last n samples"""
+        return self[max(len(self)-n,0):]
+
+    def index(self,t):
+        """Index of the first sample with time >= t (the times grow with the index)"""
+        if self.n_spilled and t <= self.spilled()["time"][-1]:
+            return int(np.searchsorted(self.spilled()["time"],t))
+        return self.n_spilled+int(np.searchsorted(self.buffer["time"][:self.n_tail],t))
+
+    def time_range(self,t0,t1,margin=1):
+        """Returns the samples with t0 <= time <= t1, plus margin samples on each side"""
+        first = max(self.index(t0)-margin,0)
+        last = min(self.index(np.nextafter(t1,np.inf))+margin,len(self))
+        return self[first:last]
+
+    @property
+    def first_time(self):
+        return float(self[0]["time"])
+
+    @property
+    def last_time(self):
+        return float(self[-1]["time"])
+
+    def close(self):
+        """Deletes the spill file"""
+        self.spilled_map = None
+        self.file.close()
@@ -0,0 +1,317 @@
+"""
+Safety interlock of a station.
+
+The rules are checked on every sample, as soon as the batch is published
+by the acquisition (the interlock is one of its sinks). When a rule is
+violated the interlock trips: the monitoring of the currents is suspended
+and a dedicated thread, waiting only for this event, ramps HV, pwell and
+psub down to 0 V with large fast steps.
+
+The ramp-down of a Keithley is a command of the highest priority of the
+broker of the acquisition (see smu_broker.py), so the worst-case reaction
+time is bounded by the command possibly in progress (a reading or a step
+of a ramp, VISA timeout) plus the steps of the ramp-down; the interlock
+measures for every trip:
+- detection: from the time of the sample to the check of the rules;
+- reaction: from the trip to the first step of the ramp-down;
+- safe: from the trip to all the voltages at 0 V;
+and reports them (print and listeners), with a warning if the budget is
+exceeded. The interlock stays tripped until reset() is called.
+
+A watchdog also trips the interlock if no sample arrives for max_silence
+seconds, since the rules cannot be checked. With the fixed-rate readings
+of the Keithleys (see smu_scheduler.py) the rules of the currents are also
+checked at every tick (check_currents is a sink of the scheduler), between
+the frames of the Arduino and during the outages of the serial port.
+"""
+import os
+import math
+import time
+import threading
+
+import numpy as np
+
+import channels
+from smu_broker import INTERLOCK
+
+
+# Limits of the default rules << CHANGE WHEN NEEDED
+DEW_POINT_MARGIN = 2. # minimum T_cold-dew point (T_hot-dew point heating) [*C]
+HV_ILIMIT = 3e-4 # ilimit of the HV Keithley [A], see acquisition.configure_keithleys
+DC_ILIMIT = 3e-3 # ilimit of the pwell and psub Keithleys [A]
+ILIMIT_FRACTION = 0.9 # trip when a current is above this fraction of ilimit
+T_NTC_RANGE = (-40.,60.) # allowed range of T_NTC [*C]
+
+# Channel of the current of each SMU role
+CURRENT_CHANNELS = {"I_HV": "hv","I_pwell": "pwell","I_psub": "psub"}
+
+
+class Rule:
+    """
+    Allowed range of a channel.
+
+    Parameters:
+    - name (str): name of the rule, used in the reports;
+    - channel (str): channel of channels.SCHEMA;
+    - low (float): default = None, minimum allowed value (no minimum if None);
+    - high (float): default = None, maximum allowed value (no maximum if None);
+    - use_abs (bool): default = False, the absolute value of the channel is checked;
+    """
+
+    def __init__(self,name,channel,low=None,high=None,use_abs=False):
+        self.name = name
+        self.channel = channel
+        self.low = low
+        self.high = high
+        self.use_abs = use_abs
+
+    def violations(self,batch):
+        """Returns the mask of the samples of the batch violating the rule"""
+        values = batch[self.channel]
+        if self.use_abs:
+            values = np.abs(values)
+        bad = np.zeros(len(values),dtype=bool)
+        if self.low is not None:
+            bad |= values < self.low
+        if self.high is not None:
+            bad |= values > self.high
+        bad |= np.isnan(values)
+        return bad
+
+    def check(self,batch):
+        """Returns the index of the first sample of the batch violating the rule, or None"""
+        bad = self.violations(batch)
+        if not bad.any():
+            return None
+        return int(np.argmax(bad))
+
+    def __repr__(self):
+        return f"Rule({self.name!r}, {self.channel!r}, low={self.low}, high={self.high})"
+
+
+def default_rules(mode="cooling"):
+    """
+    Returns the default rules of a station.
+
+    Parameters:
+    - mode (str): "cooling" or "heating", side of the Peltier compared with the dew point;
+    """
+    by_name = channels.SCHEMA.by_name
+    margin = "dT_cold_dp" if mode == "cooling" else "dT_hot_dp"
+    return [
+        Rule("dew point margin",margin,low=DEW_POINT_MARGIN),
+        Rule("I_HV near ilimit","I_HV",high=ILIMIT_FRACTION*HV_ILIMIT*by_name["I_HV"].scale,use_abs=True),
+        Rule("I_pwell near ilimit","I_pwell",high=ILIMIT_FRACTION*DC_ILIMIT*by_name["I_pwell"].scale,use_abs=True),
+        Rule("I_psub near ilimit","I_psub",high=ILIMIT_FRACTION*DC_ILIMIT*by_name["I_psub"].scale,use_abs=True),
+        Rule("T_NTC range","T_NTC",low=T_NTC_RANGE[0],high=T_NTC_RANGE[1]),
+    ]
+
+
+def source_level(inst):
+    """Returns the voltage set on a Keithley [V]"""
+    inst.write("voltage_set = smu.source.level")
+    inst.write("print(voltage_set)")
+    return float(inst.read())
+
+
+def ramp_to_zero(inst,step,delay):
+    """
+    Ramps the voltage of a Keithley to 0 V, with the sign of the actual
+    voltage (pwell and psub are negative). It returns the number of steps.
+    """
+    level = source_level(inst)
+    n = 0
+    while level != 0:
+        level = math.copysign(max(abs(level)-step,0.),level)
+        inst.write("smu.source.level = "+str(level))
+        n += 1
+        if level != 0:
+            time.sleep(delay)
+    return n
+
+
+def dc_order(level_pwell,voltage_pwell):
+    """
+    Safe order of the DC Keithleys to ramp pwell from level_pwell to
+    voltage_pwell (voltages set, negative [V]): pwell first when its
+    voltage increases in absolute value, psub first otherwise.
+    """
+    return ("pwell","psub") if level_pwell > voltage_pwell else ("psub","pwell")
+
+
+# Order of the ramp-down: HV, then the DC part in the order of smu_ramps.ramp_dc toward 0 V
+RAMP_DOWN_ORDER = ("hv",)+dc_order(-1.,0.)
+
+
+class Interlock:
+    """
+    Parameters:
+    - acq (acquisition.Acquisition): station protected by the interlock;
+    - rules (list of Rule): default = None, the rules of default_rules();
+    - step (float): default = 5, voltage step of the ramp-down [V];
+    - delay (float): default = 0.02, delay between two steps [s];
+    - budget (float): default = 1, maximum time from the trip to all the
+    voltages at 0 V [s], a warning is reported if it is exceeded;
+    - max_silence (float): default = 60, the watchdog trips the interlock
+    if no sample arrives for this time [s] (None to disable it);
+    - order (list of str): default = RAMP_DOWN_ORDER (hv, psub, pwell), order of the ramp-down;
+    """
+
+    def __init__(self,acq,rules=None,step=5.,delay=0.02,budget=1.,max_silence=60.,order=RAMP_DOWN_ORDER):
+        self.acq = acq
+        self.rules = rules if rules is not None else default_rules()
+        self.step = step
+        self.delay = delay
+        self.budget = budget
+        self.max_silence = max_silence
+        self.order = list(order)
+        self.listeners = [] # called with the report of each trip
+        self.reports = []
+        self.tripped = False
+        self.cause = None
+        self.trip_time = None
+        self.last_sample = time.monotonic()
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.active = False
+        self.thread = None
+
+    def start(self):
+        """Starts the thread of the interlock"""
+        self.active = True
+        self.last_sample = time.monotonic()
+        self.thread = threading.Thread(target=self.run,name="interlock",daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Stops the thread of the interlock"""
+        self.active = False
+        self.event.set()
+        if self.thread is not None:
+            self.thread.join(5)
+
+    def set_mode(self,mode):
+        """Changes the dew point margin rule for "cooling" or "heating" mode"""
+        margin = "dT_cold_dp" if mode == "cooling" else "dT_hot_dp"
+        for rule in self.rules:
+            if rule.name == "dew point margin":
+                rule.channel = margin
+
+    def __call__(self,batch):
+        now = time.monotonic()
+        self.last_sample = now
+        if self.tripped or not len(batch):
+            return
+        for rule in self.rules:
+            i = rule.check(batch)
+            if i is not None:
+                # Delay between the sample and its check (the times of the samples are the wall clock)
+                detection = time.time()-(self.acq.starttime+batch["time"][i])
+                self.trip(rule.name,f"{rule.channel} = {batch[rule.channel][i]:.4g} {channels.SCHEMA.unit(rule.channel)}",detection)
+                return
+
+    def check_currents(self,t_scheduled,t_actual,currents):
+        """Sink of smu_scheduler.SmuScheduler: checks the rules of the currents on the readings of a tick"""
+        if self.tripped:
+            return
+        by_name = channels.SCHEMA.by_name
+        batch = np.zeros(1,dtype=[(name,np.float64) for name in CURRENT_CHANNELS])
+        for name,role in CURRENT_CHANNELS.items():
+            batch[name] = currents[role]*by_name[name].scale
+        for rule in self.rules:
+            if rule.channel in CURRENT_CHANNELS and rule.check(batch) is not None:
+                detection = time.time()-(self.acq.starttime+t_actual)
+                self.trip(rule.name,f"{rule.channel} = {batch[rule.channel][0]:.4g} {channels.SCHEMA.unit(rule.channel)} (SMU tick)",detection)
+                return
+
+    def trip(self,rule,detail="",detection=math.nan):
+        """Trips the interlock, it can be called from any thread (e.g. an emergency button)"""
+        with self.lock:
+            if self.tripped:
+                return
+            self.tripped = True
+            self.trip_time = time.perf_counter()
+            # No new readings of the Keithleys, the ramp-down waits only for the one in progress
+            self.currents_before = self.acq.currents
+            self.currents_changes = self.acq.n_currents_changes
+            self.acq.currents = False
+            self.cause = (rule,detail,detection)
+        self.event.set()
+
+    def reset(self):
+        """Arms again the interlock after a trip"""
+        with self.lock:
+            self.tripped = False
+            self.cause = None
+            self.last_sample = time.monotonic()
+
+    def run(self):
+        """Thread of the interlock: it waits for a trip and ramps down the voltages"""
+        try:
+            # Higher priority than the other threads where allowed (Linux, privileges)
+            os.setpriority(os.PRIO_PROCESS,threading.get_native_id(),-10)
+        except (AttributeError,OSError):
+            pass
+        while self.active:
+            timeout = self.max_silence/10 if self.max_silence is not None else None
+            self.event.wait(timeout)
+            self.event.clear()
+            if not self.active:
+                break
+            if not self.tripped and self.max_silence is not None and self.acq.active:
+                silence = time.monotonic()-self.last_sample
+                if silence > self.max_silence:
+                    self.trip("watchdog",f"no samples for {silence:.1f} s")
+                    self.event.clear()
+            if self.tripped and self.trip_time is not None:
+                self.ramp_down()
+
+    def ramp_down(self):
+        """Ramps all the voltages to 0 V and reports the reaction time"""
+        trip_time = self.trip_time
+        self.trip_time = None
+        rule,detail,detection = self.cause
+        reaction = None
+        errors = []
+
+        def command(inst):
+            nonlocal reaction
+            if reaction is None:
+                reaction = time.perf_counter()-trip_time
+            return ramp_to_zero(inst,self.step,self.delay)
+
+        smus = self.acq.smus()
+        for role in self.order:
+            if smus[role] is None:
+                continue
+            try:
+                self.acq.broker.call(role,command,INTERLOCK)
+            except Exception as err: # VISA errors: go on with the other Keithleys
+                errors.append(f"{role}: {err}")
+        safe = time.perf_counter()-trip_time
+        if self.acq.n_currents_changes == self.currents_changes: # not paused or resumed meanwhile
+            self.acq.currents = self.currents_before
+
+        report = {"rule": rule,"detail": detail,"detection": detection,
+                  "reaction": reaction if reaction is not None else math.nan,
+                  "safe": safe,"budget": self.budget,"errors": errors,
+                  "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+        self.reports.append(report)
+        print(format_report(report,self.acq.station))
+        for listener in self.listeners:
+            listener(report)
+        return report
+
+
+def format_report(report,station=None):
+    """Text of a report of the interlock"""
+    prefix = f"{station}: " if station else ""
+    text = f"{prefix}INTERLOCK tripped by {report['rule']} ({report['detail']}): "
+    if not math.isnan(report["detection"]):
+        text += f"detection {report['detection']*1e3:.0f} ms, "
+    text += f"reaction {report['reaction']*1e3:.1f} ms, voltages at 0 V after {report['safe']*1e3:.0f} ms"
+    if report["safe"] > report["budget"]:
+        text += f" - WARNING: budget of {report['budget']*1e3:.0f} ms exceeded"
+    if report["errors"]:
+        text += " - ERRORS: "+"; ".join(report["errors"])
+    return text
@@ -0,0 +1,107 @@
+"""
+Health of the links of an acquisition: the serial port of the Arduino and
+the VISA session of each Keithley.
+
+A failure (serial or VISA error) marks the link down; it is then retried
+with a capped exponential backoff (RETRY_INITIAL, doubled at every failed
+retry up to RETRY_MAX) until it recovers. While a link is down its
+readings are not attempted (LinkDown is raised), so a broken instrument
+does not stall the others with its timeouts.
+
+The start and the end of every outage are written on the data file as
+comment lines, with the times of the data file:
+
+    # gap arduino start t=1234.567 s: [Errno 5] Input/output error
+    # gap arduino end t=1240.891 s: outage 6.324 s, recovery 0.012 s, 3 retries
+
+and the outages are reported with their duration and the recovery time
+(the time of the reconnection that succeeded).
+"""
+import time
+import threading
+
+
+# Delays of the retries of a link that is down [s] << CHANGE WHEN NEEDED
+RETRY_INITIAL = 0.5
+RETRY_MAX = 30.
+
+
+class LinkDown(Exception):
+    """The link is down and waits for its next retry"""
+
+
+class LinkHealth:
+    """
+    Parameters:
+    - name (str): name of the link ("arduino" or a SMU role);
+    - initial (float): default = RETRY_INITIAL, delay of the first retry [s];
+    - maximum (float): default = RETRY_MAX, maximum delay between two retries [s];
+    """
+
+    def __init__(self,name,initial=RETRY_INITIAL,maximum=RETRY_MAX):
+        self.name = name
+        self.initial = initial
+        self.maximum = maximum
+        self.lock = threading.Lock()
+        self.up = True
+        self.cause = None # error of the failure that took the link down
+        self.error = None # last error
+        self.down_since = None
+        self.delay = initial
+        self.next_retry = 0.
+        self.n_retries = 0
+        self.n_outages = 0
+        self.total_outage = 0.
+
+    def failed(self,err):
+        """Records a failure, it returns True if the link was up"""
+        with self.lock:
+            self.error = str(err)
+            if not self.up:
+                return False
+            now = time.monotonic()
+            self.cause = str(err)
+            self.up = False
+            self.down_since = now
+            self.delay = self.initial
+            self.next_retry = now+self.delay
+            self.n_retries = 0
+            self.n_outages += 1
+            return True
+
+    def retry_due(self):
+        return not self.up and time.monotonic() >= self.next_retry
+
+    def retry_failed(self,err):
+        """Records a failed retry: the delay of the next one is doubled"""
+        with self.lock:
+            self.error = str(err)
+            self.n_retries += 1
+            self.delay = min(2*self.delay,self.maximum)
+            self.next_retry = time.monotonic()+self.delay
+
+    def recovered(self,recovery=0.):
+        """
+        Marks the link up again, recovery is the time of the reconnection
+        [s]. It returns the report of the outage, or None if the link was up.
+        """
+        with self.lock:
+            if self.up:
+                return None
+            outage = time.monotonic()-self.down_since
+            self.up = True
+            self.total_outage += outage
+            return {"link": self.name,"error": self.cause,"outage": outage,"recovery": recovery,
+                    "retries": self.n_retries,"time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+    def status(self):
+        if self.up:
+            return f"{self.name} up"
+        return f"{self.name} down for {time.monotonic()-self.down_since:.0f} s ({self.error})"
+
+
+def format_outage(report,station=None):
+    """Text of the report of an outage"""
+    prefix = f"{station}: " if station else ""
+    return (f"{prefix}{report['link']} recovered after an outage of {report['outage']:.3f} s "
+            f"(recovery {report['recovery']:.3f} s, {report['retries']} retries, error: {report['error']})")
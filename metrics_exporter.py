@@ -0,0 +1,262 @@
+"""
+OpenMetrics (Prometheus) endpoint of the monitor, for the monitoring
+stack of the lab:
+
+    python headless_monitor.py --metrics 9420
+    curl localhost:9420/metrics
+
+It exports, for each station:
+- the last value of every channel (temperatures, dew point, currents);
+- the health of the acquisition: samples and sample rate, age of the last
+sample, malformed or lost frames of the Arduino, state and outages of the
+links (see link_health.py), duration of the readings of the Keithleys and
+waiting time of their commands (see smu_scheduler.py, smu_broker.py).
+
+The acquisition only stores its last sample in the exporter (it is a sink
+of acquisition.Acquisition); a thread builds the text of the metrics every
+period from the counters already kept by the acquisition, and a scrape
+returns that text: scrapes never touch the instruments nor the
+acquisition thread, however frequent they are.
+"""
+import math
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import channels
+from smu_broker import PRIORITY_NAMES
+
+
+# Default TCP port of the endpoint << CHANGE WHEN NEEDED
+METRICS_PORT = 9420
+PREFIX = "ctmon"
+CONTENT_TYPES = {"openmetrics": "application/openmetrics-text; version=1.0.0; charset=utf-8",
+                 "text": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = {k: str(v).replace("\\","\\\\").replace("\"","\\\"").replace("\n","\\n") for k,v in labels.items()}
+    return "{"+",".join(f'{k}="{v}"' for k,v in escaped.items())+"}"
+
+
+class MetricFamily:
+    """
+    Samples of a metric in the text of a snapshot.
+
+    Parameters:
+    - name (str): name of the metric, without PREFIX (and without _total for counters);
+    - kind (str): "gauge" or "counter";
+    - text (str): help of the metric;
+    - unit (str): default = None, unit of the metric (suffix of the name);
+    """
+
+    def __init__(self,name,kind,text,unit=None):
+        self.name = f"{PREFIX}_{name}"+(f"_{unit}" if unit else "")
+        self.kind = kind
+        self.text = text
+        self.unit = unit
+        self.samples = []
+
+    def add(self,value,**labels):
+        self.samples.append((labels,value))
+
+    def lines(self,kind="openmetrics"):
+        """
+        Lines of the family in the format kind of CONTENT_TYPES: in the text
+        format 0.0.4 of Prometheus a counter is typed with its _total name
+        and there is no UNIT.
+        """
+        suffix = "_total" if self.kind == "counter" else ""
+        if kind == "text":
+            return [f"# HELP {self.name}{suffix} {self.text}",f"# TYPE {self.name}{suffix} {self.kind}"]+[
+                f"{self.name}{suffix}{format_labels(labels)} {format_value(value)}" for labels,value in self.samples]
+        lines = [f"# TYPE {self.name} {self.kind}",f"# HELP {self.name} {self.text}"]
+        if self.unit:
+            lines.insert(1,f"# UNIT {self.name} {self.unit}")
+        for labels,value in self.samples:
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return lines
+
+
+class StationMetrics:
+    """
+    Sink of an acquisition.Acquisition, it keeps the last sample of the station.
+
+    Parameters:
+    - acq (acquisition.Acquisition): the acquisition;
+    - smu (smu_scheduler.SmuScheduler): default = None, scheduler of the
+    readings of the Keithleys, for the duration of the readings;
+    """
+
+    def __init__(self,acq,smu=None):
+        self.acq = acq
+        self.smu = smu
+        self.station = acq.station or "station"
+        self.last = None # last sample
+        self.last_time = None # time.time() of the last sample
+        self.rate = 0. # samples per second between the last two snapshots
+        self.previous = None # (time, n_samples) of the last snapshot
+
+    def __call__(self,batch):
+        if len(batch):
+            self.last = batch[-1].copy()
+            self.last_time = time.time()
+
+    def collect(self,families,now):
+        """Adds the samples of the station to the families of the snapshot"""
+        acq = self.acq
+        station = self.station
+        if self.previous is not None and now > self.previous[0]:
+            self.rate = (acq.n_samples-self.previous[1])/(now-self.previous[0])
+        self.previous = (now,acq.n_samples)
+
+        last = self.last
+        if last is not None:
+            for name in channels.SCHEMA.names[1:]:
+                families["channel"].add(last[name],station=station,channel=name,unit=channels.SCHEMA.unit(name))
+        families["samples"].add(acq.n_samples,station=station)
+        families["sample_rate"].add(self.rate,station=station)
+        families["sample_age"].add(now-self.last_time if self.last_time is not None else None,station=station)
+        families["frames_malformed"].add(acq.parser.n_malformed,station=station)
+        families["frames_lost"].add(getattr(acq.parser,"n_lost",0),station=station)
+        families["currents_enabled"].add(int(bool(acq.currents)),station=station)
+
+        reconnects = {}
+        for report in list(acq.outages):
+            reconnects[report["link"]] = reconnects.get(report["link"],0)+1
+        for name,health in acq.health.items():
+            if name != "arduino" and acq.rm is None: # station without the Keithleys
+                continue
+            families["link_up"].add(int(health.up),station=station,link=name)
+            families["link_outages"].add(health.n_outages,station=station,link=name)
+            families["link_reconnects"].add(reconnects.get(name,0),station=station,link=name)
+            outage = health.total_outage
+            if not health.up and health.down_since is not None:
+                outage += time.monotonic()-health.down_since
+            families["link_outage"].add(outage,station=station,link=name)
+
+        if acq.rm is not None: # station with the Keithleys
+            broker = acq.broker
+            for priority,name in PRIORITY_NAMES.items():
+                families["smu_commands"].add(broker.n_commands[priority],station=station,priority=name)
+                families["smu_wait_max"].add(broker.max_wait[priority],station=station,priority=name)
+        if self.smu is not None:
+            stats = self.smu.stats
+            families["smu_reading"].add(stats.duration.mean if stats.n_ticks else None,station=station)
+            families["smu_ticks_late"].add(stats.n_late,station=station)
+            families["smu_ticks_missed"].add(stats.n_missed,station=station)
+            families["smu_errors"].add(self.smu.n_errors,station=station)
+
+
+class MetricsExporter:
+    """
+    HTTP endpoint of the metrics of many stations.
+
+    Parameters:
+    - port (int): default = METRICS_PORT, TCP port;
+    - host (str): default = "localhost", interface to listen on;
+    - period (float): default = 1, seconds between two snapshots of the metrics;
+    """
+
+    def __init__(self,port=METRICS_PORT,host="localhost",period=1.):
+        self.period = period
+        self.stations = []
+        self.snapshots = {"openmetrics": b"# EOF\n","text": b""} # text of each format
+        self.n_scrapes = 0
+        self.stop_event = threading.Event()
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics","/"):
+                    self.send_error(404)
+                    return
+                accept = self.headers.get("Accept","")
+                kind = "openmetrics" if "application/openmetrics-text" in accept else "text"
+                body = exporter.snapshots[kind]
+                exporter.n_scrapes += 1
+                self.send_response(200)
+                self.send_header("Content-Type",CONTENT_TYPES[kind])
+                self.send_header("Content-Length",str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self,*args): # no line on the terminal for every scrape
+                pass
+
+        self.server = ThreadingHTTPServer((host,port),Handler)
+        self.server.daemon_threads = True
+        self.server_thread = threading.Thread(target=self.server.serve_forever,name="metrics-http",daemon=True)
+        self.thread = threading.Thread(target=self.run,name="metrics",daemon=True)
+
+    def add(self,acq,smu=None):
+        """Exports the metrics of an acquisition, it returns the sink to append to acq.sinks"""
+        metrics = StationMetrics(acq,smu)
+        self.stations.append(metrics)
+        return metrics
+
+    def start(self):
+        self.update()
+        self.server_thread.start()
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.period):
+            try:
+                self.update()
+            except Exception as err: # the endpoint keeps the last snapshot
+                print(f"Metrics not updated: {err!r}")
+
+    def update(self):
+        """Builds the snapshot of the metrics, in each format of CONTENT_TYPES"""
+        families = {key: MetricFamily(*spec) for key,spec in [
+            ("channel",("channel","gauge","Last value of the channel, in the unit of the label")),
+            ("samples",("samples","counter","Samples acquired")),
+            ("sample_rate",("sample_rate","gauge","Samples acquired per second","hertz")),
+            ("sample_age",("last_sample_age","gauge","Time since the last sample","seconds")),
+            ("frames_malformed",("frames_malformed","counter","Malformed frames of the Arduino")),
+            ("frames_lost",("frames_lost","counter","Frames of the Arduino lost (binary frames)")),
+            ("currents_enabled",("currents_enabled","gauge","1 if the currents are read, 0 if paused or off")),
+            ("link_up",("link_up","gauge","1 if the link (serial port or VISA session) is up")),
+            ("link_outages",("link_outages","counter","Outages of the link")),
+            ("link_reconnects",("link_reconnects","counter","Outages of the link recovered")),
+            ("link_outage",("link_outage","counter","Time the link has been down","seconds")),
+            ("smu_commands",("smu_commands","counter","Commands executed by the Keithleys")),
+            ("smu_wait_max",("smu_command_wait_max","gauge","Maximum waiting time of the commands of the Keithleys","seconds")),
+            ("smu_reading",("smu_reading","gauge","Mean duration of the readings of the Keithleys (VISA latency)","seconds")),
+            ("smu_ticks_late",("smu_ticks_late","counter","Readings of the Keithleys late on their grid")),
+            ("smu_ticks_missed",("smu_ticks_missed","counter","Readings of the Keithleys skipped")),
+            ("smu_errors",("smu_errors","counter","Failed readings of the Keithleys")),
+        ]}
+        now = time.time()
+        for metrics in self.stations:
+            metrics.collect(families,now)
+        snapshots = {}
+        for kind in CONTENT_TYPES:
+            lines = []
+            for family in families.values():
+                if family.samples:
+                    lines += family.lines(kind)
+            if kind == "openmetrics":
+                lines.append("# EOF")
+            snapshots[kind] = ("\n".join(lines)+"\n").encode()
+        self.snapshots = snapshots
+
+    def close(self):
+        self.stop_event.set()
+        if self.server_thread.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
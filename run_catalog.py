@@ -0,0 +1,330 @@
+"""
+SQLite catalog of the runs of a data directory (runs.sqlite next to the
+time-and-dew-point-*.dat files).
+
+Every run has a row in the table runs: data file, station, chip, start and
+end time, duration, samples, outages of the links, highest voltages set by
+the ramps; the table channels has the min, max and mean of every channel of
+every run. The tables are indexed, so queries across thousands of runs
+answer in milliseconds, e.g. all the runs of W2R17 with pwell at 6 V that
+reached -30 *C:
+
+    python run_catalog.py query data/ --chip W2R17 --pwell 6 --below T_NTC:-30
+
+or in SQL:
+
+    SELECT file FROM runs JOIN channels USING (file)
+    WHERE chip = 'W2R17' AND pwell_max = 6 AND channel = 'T_NTC' AND min <= -30
+
+The acquisitions add their run when the data file is closed (RunRecorder,
+a sink that keeps the statistics of the channels while the run goes on);
+the runs already on disk are added with:
+
+    python run_catalog.py rebuild data/ --jobs 8
+
+(see analyze_runs.py, only the files new or changed since the last
+rebuild are read; their chip and voltages are unknown).
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import concurrent.futures
+from datetime import datetime
+
+import numpy as np
+
+import channels
+import analyze_runs
+import run_columns
+
+
+CATALOG_NAME = "runs.sqlite"
+
+TABLES = """
+CREATE TABLE IF NOT EXISTS runs (
+    file TEXT PRIMARY KEY,  -- name of the data file, without directory
+    station TEXT,
+    chip TEXT,
+    start REAL,             -- [s since epoch]
+    end REAL,
+    start_time TEXT,        -- YYYY-MM-DD HH:MM:SS, local time
+    duration REAL,          -- [s]
+    samples INTEGER,
+    outages INTEGER,        -- outages of the links (gaps of the data file)
+    hv_max REAL,            -- highest voltages set by the ramps [V], absolute values
+    pwell_max REAL,
+    psub_max REAL,
+    size INTEGER,           -- size and modification time of the data file
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS channels (
+    file TEXT,
+    channel TEXT,
+    min REAL,
+    max REAL,
+    mean REAL,
+    PRIMARY KEY (file,channel)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS runs_chip ON runs (chip,pwell_max);
+CREATE INDEX IF NOT EXISTS runs_start ON runs (start);
+CREATE INDEX IF NOT EXISTS channels_min ON channels (channel,min);
+CREATE INDEX IF NOT EXISTS channels_max ON channels (channel,max);
+"""
+RUN_COLUMNS = ["file","station","chip","start","end","start_time","duration","samples","outages",
+               "hv_max","pwell_max","psub_max","size","mtime"]
+KEPT_COLUMNS = ["chip","hv_max","pwell_max","psub_max"]
+
+
+def catalog_path(filename):
+    """Catalog of the directory of a data file or of its columns (or of a directory)"""
+    is_run = filename.rstrip("/\\").endswith(run_columns.COLUMNS_SUFFIX)
+    directory = filename if os.path.isdir(filename) and not is_run else os.path.dirname(filename.rstrip("/\\"))
+    return os.path.join(directory or ".",CATALOG_NAME)
+
+
+def connect(path):
+    """Opens the catalog, creating its tables if needed"""
+    conn = sqlite3.connect(path,timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL") # readers do not block the acquisitions
+    conn.executescript(TABLES)
+    return conn
+
+
+def add_run(conn,run,channel_rows):
+    """
+    Adds (or replaces) a run. The chip and the voltages already known are
+    kept if the new values are NULL (e.g. rebuild of a run of the catalog).
+
+    Parameters:
+    - conn (sqlite3.Connection): the catalog;
+    - run (dict): values of the columns of runs (RUN_COLUMNS, missing ones are NULL);
+    - channel_rows (list of tuple): (channel, min, max, mean) of each channel;
+    """
+    with conn:
+        update = ",".join(f"{c} = COALESCE(excluded.{c},runs.{c})" if c in KEPT_COLUMNS else f"{c} = excluded.{c}"
+                          for c in RUN_COLUMNS[1:])
+        conn.execute(f"INSERT INTO runs ({','.join(RUN_COLUMNS)}) VALUES ({','.join('?'*len(RUN_COLUMNS))}) "
+                     f"ON CONFLICT (file) DO UPDATE SET {update}",[run.get(column) for column in RUN_COLUMNS])
+        conn.execute("DELETE FROM channels WHERE file = ?",(run["file"],))
+        conn.executemany("INSERT INTO channels VALUES (?,?,?,?,?)",
+                         [(run["file"],row[0])+tuple(nullable(v) for v in row[1:]) for row in channel_rows])
+
+
+def nullable(value):
+    """NULL instead of NaN (e.g. channel without valid values)"""
+    if value is None or np.isnan(value):
+        return None
+    return float(value)
+
+
+def file_stat(filename):
+    """Size and modification time of a data file (also for the columns of a run, see run_columns.py)"""
+    if os.path.isdir(filename):
+        meta,_ = run_columns.load_columns(filename)
+        return meta["size"],meta["mtime"]
+    stat = os.stat(filename)
+    return stat.st_size,stat.st_mtime
+
+
+class RunRecorder:
+    """
+    Sink of an acquisition.Acquisition that adds its run to the catalog when
+    the data file is closed. The statistics of the channels are updated
+    with every batch, so the data file is not read again.
+
+    Parameters:
+    - acq (acquisition.Acquisition): the acquisition;
+    - path (str): default = None, catalog (the one of the directory of the data file if None);
+    """
+
+    def __init__(self,acq,path=None):
+        self.acq = acq
+        self.path = path if path is not None else catalog_path(acq.filename)
+        self.names = channels.SCHEMA.names[1:]
+        n = len(self.names)
+        self.count = np.zeros(n,dtype=np.int64)
+        self.sum = np.zeros(n)
+        self.min = np.full(n,np.inf)
+        self.max = np.full(n,-np.inf)
+        self.levels_max = {}
+
+    def __call__(self,batch):
+        if len(batch) == 0:
+            return
+        values = np.column_stack([batch[name] for name in self.names])
+        valid = ~np.isnan(values)
+        self.count += valid.sum(axis=0)
+        self.sum += np.where(valid,values,0.).sum(axis=0)
+        self.min = np.minimum(self.min,np.where(valid,values,np.inf).min(axis=0))
+        self.max = np.maximum(self.max,np.where(valid,values,-np.inf).max(axis=0))
+
+    def set_levels(self,levels):
+        """Records the voltages set by a ramp: [hv, pwell, psub] absolute values [V]"""
+        for role,level in zip(["hv","pwell","psub"],levels):
+            self.set_level(role,level)
+
+    def set_level(self,role,level):
+        """Records a voltage set on the Keithley of a role, e.g. a step of a ramp [V]"""
+        self.levels_max[role] = max(self.levels_max.get(role,0.),abs(float(level)))
+
+    def run_closed(self):
+        """Called by the acquisition when the data file is closed"""
+        acq = self.acq
+        end = time.time()
+        size,mtime = file_stat(acq.filename)
+        run = {"file": os.path.basename(acq.filename),"station": acq.station,"chip": acq.chip,
+               "start": acq.starttime,"end": end,
+               "start_time": datetime.fromtimestamp(acq.starttime).strftime("%Y-%m-%d %H:%M:%S"),
+               "duration": end-acq.starttime,"samples": acq.n_samples,
+               "outages": sum(health.n_outages for health in acq.health.values()),
+               "hv_max": self.levels_max.get("hv"),"pwell_max": self.levels_max.get("pwell"),
+               "psub_max": self.levels_max.get("psub"),"size": size,"mtime": mtime}
+        rows = []
+        for i,name in enumerate(self.names):
+            if self.count[i]:
+                rows.append((name,self.min[i],self.max[i],self.sum[i]/self.count[i]))
+            else:
+                rows.append((name,None,None,None))
+        conn = connect(self.path)
+        try:
+            add_run(conn,run,rows)
+        finally:
+            conn.close()
+        print("Run added to the catalog",self.path)
+
+
+def run_from_analysis(path,row,channel_rows,chip=None):
+    """Row of the catalog of a data file already on disk (see analyze_runs.analyze_run)"""
+    size,mtime = file_stat(path)
+    start = None
+    if row["start"] is not None:
+        start = datetime.strptime(row["start"],"%Y-%m-%d %H:%M").timestamp()
+    return ({"file": row["file"],"station": row["station"],"chip": chip,"start": start,
+             "end": start+row["duration"] if start is not None else None,
+             "start_time": row["start"]+":00" if row["start"] is not None else None,
+             "duration": row["duration"],"samples": row["samples"],"outages": row["gaps"],
+             "size": size,"mtime": mtime},
+            [(ch["channel"],ch["min"],ch["max"],ch["mean"]) for ch in channel_rows])
+
+
+def rebuild(paths,path=None,jobs=None,chip=None,force=False):
+    """
+    Adds the data files of paths (files, directories or glob patterns, see
+    analyze_runs.find_runs) to the catalog, in parallel. The files already
+    in the catalog with the same size and modification time are skipped,
+    unless force is True. It returns the number of runs added.
+    """
+    files = analyze_runs.find_runs(paths)
+    by_catalog = {}
+    for filename in files:
+        by_catalog.setdefault(path or catalog_path(filename),[]).append(filename)
+    n_added = 0
+    for catalog,filenames in by_catalog.items():
+        conn = connect(catalog)
+        try:
+            known = {file: (size,mtime) for file,size,mtime in conn.execute("SELECT file,size,mtime FROM runs")}
+            todo = [f for f in filenames if force or known.get(analyze_runs.run_name(f)) != file_stat(f)]
+            print(f"{catalog}: {len(todo)} runs to add, {len(filenames)-len(todo)} up to date")
+            if not todo:
+                continue
+            with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+                n = len(todo)
+                results = pool.map(analyze_runs.analyze_task,todo,[analyze_runs.COLD_LIMIT]*n,["cooling"]*n,chunksize=max(1,n//(4*(jobs or os.cpu_count()))))
+                for filename,(row,channel_rows,_) in zip(todo,results):
+                    if "error" in row:
+                        print(f"{row['file']}: {row['error']}")
+                        continue
+                    add_run(conn,*run_from_analysis(filename,row,channel_rows,chip))
+                    n_added += 1
+        finally:
+            conn.close()
+    return n_added
+
+
+def query(conn,chip=None,station=None,hv=None,pwell=None,psub=None,since=None,until=None,below=(),above=()):
+    """
+    Returns the runs (rows of runs as dicts) matching all the conditions.
+
+    Parameters:
+    - conn (sqlite3.Connection): the catalog;
+    - chip, station (str): default = None, chip and station of the runs;
+    - hv, pwell, psub (float): default = None, highest voltage set [V];
+    - since, until (str): default = None, start of the runs ("YYYY-MM-DD [HH:MM]");
+    - below, above (list of (channel, value)): the channel reached the value
+    (its min is <= value, its max is >= value);
+    """
+    where = []
+    params = []
+    for column,value in [("chip",chip),("station",station),("hv_max",hv),("pwell_max",pwell),("psub_max",psub)]:
+        if value is not None:
+            where.append(f"runs.{column} = ?")
+            params.append(value)
+    if since is not None:
+        where.append("runs.start_time >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("runs.start_time <= ?")
+        params.append(until)
+    for op,column,conditions in [("<=","min",below),(">=","max",above)]:
+        for channel,value in conditions:
+            where.append(f"runs.file IN (SELECT file FROM channels WHERE channel = ? AND {column} {op} ?)")
+            params += [channel,value]
+    sql = "SELECT * FROM runs"+(" WHERE "+" AND ".join(where) if where else "")+" ORDER BY start"
+    cursor = conn.execute(sql,params)
+    keys = [d[0] for d in cursor.description]
+    return [dict(zip(keys,row)) for row in cursor]
+
+
+def parse_condition(text):
+    channel,value = text.split(":")
+    if channel not in channels.SCHEMA.names:
+        raise argparse.ArgumentTypeError(f"Unknown channel {channel}")
+    return channel,float(value)
+
+
+def main():
+    # Parse arguments from terminal
+    parser = argparse.ArgumentParser(description="SQLite catalog of the runs of a data directory.")
+    commands = parser.add_subparsers(dest="command",required=True)
+    build = commands.add_parser("rebuild",help="Add the data files on disk to the catalog.")
+    build.add_argument('paths', nargs='+', help="Data files, directories or glob patterns.")
+    build.add_argument('--catalog', default=None, help="Catalog file (default is %s in the directory of each data file)." % CATALOG_NAME)
+    build.add_argument('--jobs', type=int, default=None, help="Processes reading the data files (default is the number of cores).")
+    build.add_argument('--chip', default=None, help="Chip of the runs added, if known.")
+    build.add_argument('--force', action='store_true', help="Read again the runs already in the catalog.")
+    find = commands.add_parser("query",help="Print the runs matching the conditions.")
+    find.add_argument('catalog', help="Catalog file or data directory.")
+    find.add_argument('--chip', default=None)
+    find.add_argument('--station', default=None)
+    find.add_argument('--hv', type=float, default=None, help="Highest HV set [V].")
+    find.add_argument('--pwell', type=float, default=None, help="Highest abs(pwell) set [V].")
+    find.add_argument('--psub', type=float, default=None, help="Highest abs(psub) set [V].")
+    find.add_argument('--since', default=None, help="Runs started since YYYY-MM-DD [HH:MM].")
+    find.add_argument('--until', default=None, help="Runs started until YYYY-MM-DD [HH:MM].")
+    find.add_argument('--below', type=parse_condition, action='append', default=[], help="CHANNEL:VALUE, the channel went down to VALUE (e.g. T_NTC:-30).")
+    find.add_argument('--above', type=parse_condition, action='append', default=[], help="CHANNEL:VALUE, the channel went up to VALUE.")
+
+    args = parser.parse_args()
+    if args.command == "rebuild":
+        start = time.perf_counter()
+        n = rebuild(args.paths,args.catalog,args.jobs,args.chip,args.force)
+        print(f"{n} runs added in {time.perf_counter()-start:.1f} s")
+        return 0
+
+    path = catalog_path(args.catalog) if os.path.isdir(args.catalog) else args.catalog
+    if not os.path.exists(path):
+        print("No catalog",path)
+        return 1
+    conn = connect(path)
+    start = time.perf_counter()
+    runs = query(conn,args.chip,args.station,args.hv,args.pwell,args.psub,args.since,args.until,args.below,args.above)
+    elapsed = time.perf_counter()-start
+    analyze_runs.print_table(runs,["file","station","chip","start_time","duration","samples","outages","hv_max","pwell_max","psub_max"])
+    print(f"{len(runs)} runs ({elapsed*1e3:.1f} ms)")
+    conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+"""
+Columnar binary format of the runs, and bulk converter of the text data
+files (time-and-dew-point-*.dat) to it.
+
+A converted run is a directory next to its data file (the name of the file
+with .cols instead of .dat) with one file per channel, the raw values
+(little-endian float64, so the values are exactly the ones of the text),
+and meta.json: names and units of the columns, number of rows, size,
+modification time and SHA-256 of the data file, and the lines of the data
+file that are not samples (comments such as the gaps of the links,
+malformed lines) with their position. A run is loaded with memory maps:
+
+    meta,columns = run_columns.load_columns("data/time-and-dew-point-20240101-1200.cols")
+    columns["T_NTC"] # numpy.memmap
+
+and analyze_runs.py / run_catalog.py read the .cols of a run instead of
+its data file.
+
+The converter streams each data file in chunks (memory bounded by the
+chunk size), runs the files in parallel with a pool of processes and
+verifies every run before publishing it: the data file is rebuilt from the
+columns and must have the same SHA-256 (bit-for-bit); if only the
+formatting of the numbers differs (files written by old versions) the
+values parsed again from the text must be bit-for-bit the ones of the
+columns. A run is written in NAME.cols.tmp and renamed when verified, so
+an interrupted conversion is resumed by running the same command again:
+the runs already converted (same size and modification time of the data
+file) are skipped, the partial ones are converted again.
+
+    python run_columns.py data/ --jobs 8
+"""
+import io
+import os
+import sys
+import json
+import mmap
+import time
+import shutil
+import hashlib
+import argparse
+import concurrent.futures
+
+import numpy as np
+
+import channels
+import analyze_runs
+
+
+COLUMNS_SUFFIX = ".cols"
+META_NAME = "meta.json"
+FORMAT_VERSION = 1
+# Bytes of a data file converted at once
+CHUNK_SIZE = 1<<24
+# Rows formatted at once by the verification
+VERIFY_ROWS = 1<<17
+
+
+class VerificationError(Exception):
+    """The columns of a run are not the values of its data file"""
+
+
+def columns_path(filename):
+    """Directory of the columns of a data file"""
+    return os.path.splitext(filename)[0]+COLUMNS_SUFFIX
+
+
+def column_file(path,name):
+    return os.path.join(path,name+".f8")
+
+
+def format_rows(rows):
+    """Lines of a data file for rows of values, the format of acquisition.format_sample"""
+    return [" ".join(str(x) for x in row)+"\n" for row in rows.tolist()]
+
+
+def split_chunk(data,n_columns):
+    """
+    Splits whole lines of a data file into the rows of values and the other
+    lines, it returns (rows, [(index of the next row, line)]).
+    """
+    if b"#" not in data:
+        try:
+            rows = np.loadtxt(io.BytesIO(data),dtype=np.float64,ndmin=2)
+            if rows.shape == (data.count(b"\n"),n_columns) and data.endswith(b"\n"):
+                return rows,[]
+        except ValueError:
+            pass
+    # Slow path: comments, malformed or empty lines, last line without newline
+    rows = []
+    other = []
+    for line in data.splitlines(keepends=True):
+        values = None
+        if line.endswith(b"\n") and not line.startswith(b"#"):
+            try:
+                values = [float(x) for x in line.split()]
+            except ValueError:
+                pass
+        if values is None or len(values) != n_columns:
+            other.append((len(rows),line))
+            continue
+        rows.append(values)
+    return np.array(rows,dtype=np.float64).reshape(-1,n_columns),other
+
+
+def count_columns(mm):
+    """Number of values of the first sample line of a data file"""
+    pos = 0
+    while pos < len(mm):
+        end = mm.find(b"\n",pos)
+        end = len(mm) if end < 0 else end
+        line = mm[pos:end]
+        if line.strip() and not line.startswith(b"#"):
+            return len(line.split())
+        pos = end+1
+    return len(channels.SCHEMA.names)
+
+
+def chunks(mm,chunk_size):
+    """(start, stop) of the chunks of whole lines of a memory map"""
+    pos = 0
+    size = len(mm)
+    while pos < size:
+        stop = mm.find(b"\n",pos+chunk_size) if pos+chunk_size < size else -1
+        stop = size if stop < 0 else stop+1
+        yield pos,stop
+        pos = stop
+
+
+def load_columns(path):
+    """Returns (meta, dict name: numpy.memmap of the column) of a converted run"""
+    with open(os.path.join(path,META_NAME)) as f:
+        meta = json.load(f)
+    columns = {}
+    for name in meta["names"]:
+        if meta["rows"] == 0:
+            columns[name] = np.empty(0,dtype="<f8")
+        else:
+            columns[name] = np.memmap(column_file(path,name),dtype="<f8",mode="r",shape=(meta["rows"],))
+    return meta,columns
+
+
+def load_samples(path,schema=channels.SCHEMA):
+    """
+    Returns (samples, meta) of a converted run, samples is a structured
+    array of the schema (see channels.py).
+    """
+    meta,columns = load_columns(path)
+    if meta["names"] != schema.names:
+        raise ValueError(f"{path}: columns {meta['names']} are not the channels of the schema")
+    samples = np.empty(meta["rows"],dtype=schema.dtype)
+    for name,column in columns.items():
+        samples[name] = column
+    return samples,meta
+
+
+def is_converted(path,size,mtime):
+    """True if path has the verified columns of a data file with this size and modification time"""
+    try:
+        with open(os.path.join(path,META_NAME)) as f:
+            meta = json.load(f)
+    except (OSError,ValueError):
+        return False
+    return meta.get("size") == size and meta.get("mtime") == mtime
+
+
+def rebuilt_text(columns,n_rows,other):
+    """Chunks (bytes) of the data file rebuilt from the columns and the other lines"""
+    k = 0
+    for a in range(0,n_rows,VERIFY_ROWS):
+        b = min(a+VERIFY_ROWS,n_rows)
+        lines = format_rows(np.column_stack([column[a:b] for column in columns]))
+        pieces = []
+        last = a
+        while k < len(other) and other[k][0] < b:
+            index,line = other[k]
+            pieces += lines[last-a:index-a]
+            pieces.append(line)
+            last = index
+            k += 1
+        pieces += lines[last-a:]
+        yield "".join(pieces).encode("latin-1")
+    for _,line in other[k:]:
+        yield line.encode("latin-1")
+
+
+def verify(path,source,meta,chunk_size=CHUNK_SIZE):
+    """
+    Verifies the columns of path against the data file source, it returns
+    "exact" (the data file is rebuilt bit-for-bit) or "values" (the values
+    are bit-for-bit the ones of the text, its formatting is different).
+    It raises VerificationError otherwise.
+    """
+    _,by_name = load_columns(path)
+    columns = [by_name[name] for name in meta["names"]]
+    other = [(index,line) for index,line in meta["lines"]]
+    sha = hashlib.sha256()
+    for data in rebuilt_text(columns,meta["rows"],other):
+        sha.update(data)
+    if sha.hexdigest() == meta["sha256"]:
+        return "exact"
+
+    # Compare the values
+    n_rows = 0
+    with open(source,"rb") as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+        for start,stop in chunks(mm,chunk_size):
+            rows,_ = split_chunk(mm[start:stop],len(columns))
+            for i,column in enumerate(columns):
+                if not np.array_equal(rows[:,i].view(np.uint64),np.asarray(column[n_rows:n_rows+len(rows)]).view(np.uint64)):
+                    raise VerificationError(f"{source}: values of {meta['names'][i]} differ near row {n_rows}")
+            n_rows += len(rows)
+    if n_rows != meta["rows"]:
+        raise VerificationError(f"{source}: {n_rows} rows in the text, {meta['rows']} in the columns")
+    return "values"
+
+
+def convert_run(source,target=None,chunk_size=CHUNK_SIZE,force=False):
+    """
+    Converts a data file to columns and verifies them, it returns a report
+    (dict: file, state "exact", "values" or "skipped", rows, sizes, time).
+
+    Parameters:
+    - source (str): data file;
+    - target (str): default = None, directory of the columns (columns_path(source) if None);
+    - chunk_size (int): default = CHUNK_SIZE, bytes of the data file read at once;
+    - force (bool): default = False, convert again a run already converted;
+    """
+    start = time.perf_counter()
+    target = target or columns_path(source)
+    stat = os.stat(source)
+    report = {"file": os.path.basename(source),"size": stat.st_size}
+    partial = target+".tmp"
+    shutil.rmtree(partial,ignore_errors=True) # left by an interrupted conversion
+    if not force and is_converted(target,stat.st_size,stat.st_mtime):
+        report["state"] = "skipped"
+        return report
+
+    os.makedirs(partial)
+    sha = hashlib.sha256()
+    n_rows = 0
+    other = []
+    if stat.st_size == 0:
+        names = channels.SCHEMA.names
+    else:
+        with open(source,"rb") as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+            n_columns = count_columns(mm)
+            names = channels.SCHEMA.names if n_columns == len(channels.SCHEMA.names) else [f"col{i}" for i in range(n_columns)]
+            outputs = [open(column_file(partial,name),"wb") for name in names]
+            try:
+                for a,b in chunks(mm,chunk_size):
+                    data = mm[a:b]
+                    sha.update(data)
+                    rows,lines = split_chunk(data,n_columns)
+                    for i,output in enumerate(outputs):
+                        output.write(np.ascontiguousarray(rows[:,i],dtype="<f8").tobytes())
+                    other += [(n_rows+index,line.decode("latin-1")) for index,line in lines]
+                    n_rows += len(rows)
+            finally:
+                for output in outputs:
+                    output.close()
+    if stat.st_size == 0:
+        for name in names:
+            open(column_file(partial,name),"wb").close()
+
+    units = [channels.SCHEMA.unit(name) if name in channels.SCHEMA.by_name else "" for name in names]
+    meta = {"version": FORMAT_VERSION,"source": os.path.basename(source),"names": names,"units": units,
+            "rows": n_rows,"size": stat.st_size,"mtime": stat.st_mtime,"sha256": sha.hexdigest(),
+            "lines": other}
+    with open(os.path.join(partial,META_NAME),"w") as f:
+        json.dump(meta,f)
+    report["state"] = verify(partial,source,meta,chunk_size)
+
+    # Publish the verified run
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.replace(partial,target)
+    report["rows"] = n_rows
+    report["columns_size"] = sum(os.path.getsize(column_file(target,name)) for name in names)
+    report["time"] = time.perf_counter()-start
+    return report
+
+
+def convert_task(source,chunk_size,force):
+    """Task of the pool: the errors are returned, a bad file does not stop the conversion"""
+    try:
+        return convert_run(source,chunk_size=chunk_size,force=force)
+    except Exception as err:
+        return {"file": os.path.basename(source),"state": "error","error": repr(err)}
+
+
+def main():
+    # Parse arguments from terminal
+    parser = argparse.ArgumentParser(description="Converts the text data files of the runs to columns (see run_columns.py).")
+    parser.add_argument('paths', nargs='+', help="Data files, directories or glob patterns.")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="Processes of the pool (default is the number of cores).")
+    parser.add_argument('--chunk', type=float, default=CHUNK_SIZE/2**20, help="MB of a data file converted at once (default is %g)." % (CHUNK_SIZE/2**20))
+    parser.add_argument('--force', action='store_true', help="Convert again the runs already converted.")
+
+    args = parser.parse_args()
+    files = analyze_runs.find_runs(args.paths,columns=False)
+    if not files:
+        print("No data files found")
+        return 1
+    print(f"Converting {len(files)} runs with {args.jobs} processes")
+
+    start = time.perf_counter()
+    counts = {}
+    text_size = columns_size = 0
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+        n = len(files)
+        for report in pool.map(convert_task,files,[int(args.chunk*2**20)]*n,[args.force]*n):
+            counts[report["state"]] = counts.get(report["state"],0)+1
+            if report["state"] == "error":
+                failed += 1
+                print(f"{report['file']}: {report['error']}")
+                continue
+            if report["state"] == "skipped":
+                continue
+            text_size += report["size"]
+            columns_size += report["columns_size"]
+            note = "" if report["state"] == "exact" else " (values verified, formatting of the text differs)"
+            print(f"{report['file']}: {report['rows']} rows, {report['size']/1e6:.1f} -> {report['columns_size']/1e6:.1f} MB in {report['time']:.1f} s{note}")
+    elapsed = time.perf_counter()-start
+    print(", ".join(f"{state}: {count}" for state,count in sorted(counts.items()))+f" in {elapsed:.1f} s")
+    if columns_size:
+        print(f"Text {text_size/1e6:.1f} MB, columns {columns_size/1e6:.1f} MB ({text_size/columns_size:.1f}x smaller)")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Bridge between the acquisition thread and the GUI.
+
+The batches of the acquisition are merged and sent as one NumPy structured
+array (channels.SAMPLE_DTYPE) per signal, so the cross-thread cost depends on the
+number of batches and not on the number of samples.
+
+The backlog is bounded: at most max_in_flight batches can wait in the Qt
+queue. When the GUI is behind, the new samples are merged in the next
+batch instead of making new signals, and if more than max_pending samples
+are waiting the oldest ones are dropped (they are already on the data file).
+"""
+import time
+import threading
+import numpy as np
+
+
+class SampleBridge:
+    """
+    Sink of acquisition.Acquisition that sends the samples in batches.
+
+    Parameters:
+    - emit (callable): called with each batch (e.g. the emit of a pyqtSignal(object));
+    - max_in_flight (int): default = 2, maximum number of batches sent and not yet
+    acknowledged by the GUI with ack();
+    - max_pending (int): default = 100000, maximum number of samples waiting;
+    - min_interval (float): default = 0.05, minimum time between two batches in seconds;
+    """
+
+    def __init__(self,emit,max_in_flight=2,max_pending=100000,min_interval=0.05):
+        self.emit = emit
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.pending = [] # batches waiting
+        self.n_pending = 0 # samples waiting
+        self.in_flight = 0
+        self.held = False # a batch is waiting for the GUI
+        self.last_emit = 0.
+
+        # Counters
+        self.n_samples = 0
+        self.n_batches = 0
+        self.n_merged = 0 # batches not sent because the GUI was behind, merged in the next one
+        self.n_dropped = 0 # samples dropped because too many were pending
+
+    def __call__(self,batch):
+        with self.lock:
+            self.pending.append(batch)
+            self.n_pending += len(batch)
+            self.n_samples += len(batch)
+            while self.n_pending > self.max_pending:
+                n = min(len(self.pending[0]),self.n_pending-self.max_pending)
+                self.pending[0] = self.pending[0][n:]
+                if not len(self.pending[0]):
+                    del self.pending[0]
+                self.n_pending -= n
+                self.n_dropped += n
+        if time.monotonic()-self.last_emit >= self.min_interval:
+            self.flush()
+
+    def flush(self):
+        """Sends the pending samples as one batch, if the GUI is not behind"""
+        with self.lock:
+            if not self.pending:
+                return
+            if self.in_flight >= self.max_in_flight:
+                self.held = True
+                return
+            if self.held: # the batches arrived while the GUI was behind are merged in the first one
+                self.n_merged += len(self.pending)-1
+            batch = np.concatenate(self.pending) if len(self.pending) > 1 else self.pending[0]
+            self.pending = []
+            self.n_pending = 0
+            self.held = False
+            self.in_flight += 1
+            self.n_batches += 1
+            self.last_emit = time.monotonic()
+        self.emit(batch)
+
+    def ack(self):
+        """Called by the GUI when a batch has been handled"""
+        with self.lock:
+            self.in_flight = max(0,self.in_flight-1)
+
+    def status(self):
+        return f"batches: {self.n_batches}, merged: {self.n_merged}, dropped samples: {self.n_dropped}"
@@ -0,0 +1,241 @@
+"""
+Shared memory bus of the live samples, for the other programs of the lab
+(e.g. the DAQ of the chip, dashboards).
+
+The acquisition writes every sample in a ring buffer of shared memory
+(multiprocessing.shared_memory) named after the station, e.g. ctmon-box1;
+any number of local processes can attach to it and read the last samples
+without reading the data file and without any load on the instruments.
+
+Layout of the shared memory:
+- header of 64 bytes: magic, capacity, size of a sample, reserved and
+committed sequence numbers (uint64), length of the dtype, pid of the writer;
+- dtype of the samples (channels.SAMPLE_DTYPE) as JSON, padded to 64 bytes;
+- ring of capacity samples, sample n is in slot n % capacity.
+The writer reserves the slots (reserved = n after the batch), copies the
+batch, then commits it (committed = reserved): a reader copies the slots
+up to committed and drops the ones the writer may have overwritten
+meanwhile (older than reserved - capacity), so it never returns a torn
+sample. Example of a reader:
+
+    bus = sample_bus.BusReader("ctmon-box1")
+    while True:
+        samples = bus.wait_new(timeout=5) # structured array, see channels.py
+        print(samples["T_NTC"])
+
+or from the terminal: python sample_bus.py ctmon-box1
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+import channels
+
+
+MAGIC = b"CTBUS001"
+HEADER_SIZE = 64
+# Fields of the header (uint64)
+CAPACITY,ITEMSIZE,RESERVED,COMMITTED,DESCR_LENGTH,PID = range(1,7)
+# Samples kept in the ring << CHANGE WHEN NEEDED
+BUS_CAPACITY = 65536
+
+
+def bus_name(prefix="ctmon",station=None):
+    """Name of the shared memory of a station"""
+    return f"{prefix}-{station or 'station'}"
+
+
+def padded(n,alignment=64):
+    return -(-n//alignment)*alignment
+
+
+def process_alive(pid):
+    """True if the process pid exists"""
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # process of another user
+        return True
+    return True
+
+
+class SampleBus:
+    """
+    Sink of acquisition.Acquisition that publishes the samples on the bus.
+
+    Parameters:
+    - name (str): name of the shared memory (see bus_name); a segment left
+    by a crashed writer with the same name is replaced, FileExistsError is
+    raised if its writer is still running;
+    - dtype (numpy.dtype): default = channels.SAMPLE_DTYPE, dtype of the samples;
+    - capacity (int): default = BUS_CAPACITY, samples kept in the ring;
+    """
+
+    def __init__(self,name,dtype=channels.SAMPLE_DTYPE,capacity=BUS_CAPACITY):
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        descr = json.dumps(self.dtype.descr).encode()
+        offset = HEADER_SIZE+padded(len(descr))
+        size = offset+capacity*self.dtype.itemsize
+        try:
+            self.shm = shared_memory.SharedMemory(name,create=True,size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name)
+            pid = int.from_bytes(bytes(stale.buf[PID*8:PID*8+8]),"little") if stale.size >= HEADER_SIZE else 0
+            if pid != os.getpid() and process_alive(pid):
+                # Not ours to remove: the segment stays to its writer
+                resource_tracker.unregister(stale._name,"shared_memory")
+                stale.close()
+                raise FileExistsError(f"The sample bus {name} is in use by the process {pid}")
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name,create=True,size=size)
+        self.header = np.ndarray(8,dtype="<u8",buffer=self.shm.buf)
+        self.shm.buf[HEADER_SIZE:HEADER_SIZE+len(descr)] = descr
+        self.records = np.ndarray(capacity,dtype=self.dtype,buffer=self.shm.buf,offset=offset)
+        self.header[CAPACITY] = capacity
+        self.header[ITEMSIZE] = self.dtype.itemsize
+        self.header[RESERVED] = self.header[COMMITTED] = 0
+        self.header[DESCR_LENGTH] = len(descr)
+        self.header[PID] = os.getpid()
+        self.shm.buf[:len(MAGIC)] = MAGIC # last: the bus is ready
+
+    def __call__(self,batch):
+        n = len(batch)
+        if n == 0 or self.header is None:
+            return
+        committed = int(self.header[COMMITTED])
+        start = committed
+        if n > self.capacity: # only the last capacity samples fit
+            batch = batch[-self.capacity:]
+            start += n-self.capacity
+        self.header[RESERVED] = committed+n
+        i = start%self.capacity
+        k = min(len(batch),self.capacity-i)
+        self.records[i:i+k] = batch[:k]
+        self.records[:len(batch)-k] = batch[k:]
+        self.header[COMMITTED] = committed+n
+
+    def close(self):
+        """Removes the shared memory, the readers attached keep their mapping"""
+        self.header = self.records = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+class BusReader:
+    """
+    Reader of a SampleBus of another process.
+
+    Parameters:
+    - name (str): name of the shared memory (see bus_name);
+    - from_start (bool): default = False, the first read_new() returns the
+    samples still in the ring instead of only the new ones;
+
+    The ring can also be read zero-copy through records (numpy view on the
+    shared memory) and committed(): the sample n is records[n % capacity],
+    valid until the writer reserves the sample n + capacity.
+    """
+
+    def __init__(self,name,from_start=False):
+        self.name = name
+        try:
+            self.shm = shared_memory.SharedMemory(name,track=False) # Python >= 3.13
+            track = False
+        except TypeError:
+            self.shm = shared_memory.SharedMemory(name)
+            track = True
+        if bytes(self.shm.buf[:len(MAGIC)]) != MAGIC:
+            self.shm.close()
+            raise ValueError(f"{name} is not a sample bus (or it is not ready)")
+        self.header = np.ndarray(8,dtype="<u8",buffer=self.shm.buf)
+        self.writer_pid = int(self.header[PID])
+        if track and self.writer_pid != os.getpid():
+            # Otherwise the segment would be removed when the reader exits
+            resource_tracker.unregister(self.shm._name,"shared_memory")
+        self.capacity = int(self.header[CAPACITY])
+        descr_length = int(self.header[DESCR_LENGTH])
+        descr = json.loads(bytes(self.shm.buf[HEADER_SIZE:HEADER_SIZE+descr_length]))
+        self.dtype = np.dtype([tuple(field) for field in descr])
+        self.records = np.ndarray(self.capacity,dtype=self.dtype,buffer=self.shm.buf,offset=HEADER_SIZE+padded(descr_length))
+        self.next = 0 if from_start else self.committed()
+        self.n_lost = 0 # samples overwritten before being read
+
+    def committed(self):
+        """Number of samples published since the start of the bus"""
+        return int(self.header[COMMITTED])
+
+    def read(self,start,end):
+        """Copies the samples from start to end (sequence numbers), it returns (samples, first sequence number)"""
+        start = max(start,end-self.capacity,0)
+        index = np.arange(start,end)%self.capacity
+        samples = self.records[index]
+        # Drop the samples the writer may have overwritten during the copy
+        oldest = int(self.header[RESERVED])-self.capacity
+        if oldest > start:
+            samples = samples[oldest-start:]
+            start = oldest
+        return samples,start
+
+    def latest(self,n=1):
+        """Returns the last n samples (or fewer)"""
+        end = self.committed()
+        return self.read(end-n,end)[0]
+
+    def read_new(self):
+        """Returns the samples published since the last call"""
+        end = self.committed()
+        samples,start = self.read(self.next,end)
+        self.n_lost += start-self.next
+        self.next = end
+        return samples
+
+    def wait_new(self,timeout=None,interval=0.01):
+        """Waits for new samples (at most timeout seconds) and returns them"""
+        deadline = None if timeout is None else time.monotonic()+timeout
+        while self.committed() == self.next:
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            time.sleep(interval)
+        return self.read_new()
+
+    def close(self):
+        self.header = self.records = None
+        self.shm.close()
+
+
+def main():
+    # Parse arguments from terminal
+    parser = argparse.ArgumentParser(description="Prints the live samples of a station from its shared memory bus.")
+    parser.add_argument('name', nargs='?', default=bus_name(), help="Name of the bus (default is %s)." % bus_name())
+    parser.add_argument('--channels', default="T_NTC,dew_point,I_HV", help="Channels to print, comma separated.")
+
+    args = parser.parse_args()
+    names = args.channels.split(",")
+
+    bus = BusReader(args.name)
+    print("Attached to",args.name,"written by pid",bus.writer_pid,"-",bus.committed(),"samples published")
+    print("time "+" ".join(f"{name}[{channels.SCHEMA.unit(name)}]" for name in names))
+    try:
+        while True:
+            for sample in bus.wait_new(timeout=10):
+                print(sample["time"]," ".join(str(sample[name]) for name in names))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if bus.n_lost:
+            print(bus.n_lost,"samples lost (reader too slow)")
+        bus.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Command broker of the Keithleys.
+
+Every Keithley is used only by a thread of the broker, which executes the
+commands sent to it one at a time, so that the commands of different
+threads (acquisition, ramps, interlock, GUI) are never interleaved on a
+VISA session. A command is a function of the instrument, e.g.
+acquisition.measure_current, and runs as a whole (a write and the read of
+its answer cannot be split).
+
+The waiting commands are executed by priority, then in order of arrival:
+- INTERLOCK: ramp-down of the safety interlock;
+- RAMP: steps of the ramps and configuration (speed profiles, benchmark);
+- MONITOR: readings of the currents.
+A ramp sends one command for each step, so the readings of the monitor
+are executed between two steps and the currents are logged during ramps.
+"""
+import time
+import queue
+import itertools
+import threading
+import concurrent.futures
+
+import channels
+
+
+# Priorities of the commands, the lowest first
+INTERLOCK = 0
+RAMP = 1
+MONITOR = 2
+PRIORITY_NAMES = {INTERLOCK: "interlock",RAMP: "ramp",MONITOR: "monitor"}
+
+
+class SmuBroker:
+    """
+    Parameters:
+    - instrument (callable): returns the instrument of a role, called for
+    each command (so the instruments can be reopened);
+    - roles (list of str): default = channels.SMU_ROLES, roles of the Keithleys;
+    """
+
+    def __init__(self,instrument,roles=channels.SMU_ROLES):
+        self.instrument = instrument
+        self.roles = list(roles)
+        self.queues = {role: queue.PriorityQueue() for role in self.roles}
+        self.counter = itertools.count()
+        self.closed = False
+        # Statistics: commands executed and maximum waiting time of each priority
+        self.n_commands = {p: 0 for p in PRIORITY_NAMES}
+        self.max_wait = {p: 0. for p in PRIORITY_NAMES}
+        self.threads = [threading.Thread(target=self.run,args=(role,),name=f"smu-{role}",daemon=True) for role in self.roles]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self,role,command,priority=MONITOR):
+        """Queues command(instrument) for the Keithley of a role, it returns a concurrent.futures.Future"""
+        if self.closed:
+            raise RuntimeError("The SMU broker is closed")
+        future = concurrent.futures.Future()
+        self.queues[role].put((priority,next(self.counter),time.monotonic(),command,future))
+        return future
+
+    def call(self,role,command,priority=MONITOR,timeout=None):
+        """Executes command(instrument) on the Keithley of a role and returns its result"""
+        return self.submit(role,command,priority).result(timeout)
+
+    def run(self,role):
+        q = self.queues[role]
+        while True:
+            priority,_,queued,command,future = q.get()
+            if command is None: # close()
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            wait = time.monotonic()-queued
+            self.n_commands[priority] += 1
+            self.max_wait[priority] = max(self.max_wait[priority],wait)
+            try:
+                future.set_result(command(self.instrument(role)))
+            except BaseException as err: # passed to the caller
+                future.set_exception(err)
+
+    def close(self):
+        """Stops the threads, the commands still waiting are cancelled"""
+        if self.closed:
+            return
+        self.closed = True
+        for q in self.queues.values():
+            q.put((-1,next(self.counter),0.,None,None))
+        for thread in self.threads:
+            thread.join(5)
+        for q in self.queues.values():
+            while not q.empty():
+                item = q.get_nowait()
+                if item[4] is not None:
+                    item[4].cancel()
+
+    def status(self):
+        return ", ".join(f"{PRIORITY_NAMES[p]}: {self.n_commands[p]} (max wait {self.max_wait[p]*1e3:.0f} ms)" for p in sorted(PRIORITY_NAMES))
@@ -0,0 +1,151 @@
+"""
+Speed profiles of the Keithleys: integration time (NPLC, number of power
+line cycles), autozero and averaging filter of the current measurements.
+A faster profile gives more readings per second with more noise.
+
+Each SMU role (hv, pwell, psub) has its own profile, applied when the
+Keithleys are configured and changeable at runtime. The benchmark reads
+a Keithley with each profile and reports the readings per second and the
+RMS noise, e.g. from the terminal:
+
+    python smu_profiles.py --role hv --readings 50
+"""
+import sys
+import time
+import argparse
+
+import numpy as np
+
+import acquisition
+import channels
+from smu_broker import RAMP
+
+
+# Profiles: NPLC, autozero, averaging filter (number of readings, None for no filter)
+PROFILES = {
+    "fast": {"nplc": 0.01,"autozero": False,"filter": None},
+    "balanced": {"nplc": 1,"autozero": True,"filter": None},
+    "low-noise": {"nplc": 10,"autozero": True,"filter": 10},
+}
+
+# Profile of each role at the configuration of the Keithleys << CHANGE WHEN NEEDED
+DEFAULT_PROFILES = {"hv": "balanced","pwell": "balanced","psub": "balanced"}
+
+
+def apply_profile(inst,name):
+    """Sets the measurement settings of a profile on a Keithley"""
+    profile = PROFILES[name]
+    inst.write(f"smu.measure.nplc = {profile['nplc']}")
+    inst.write("smu.measure.autozero.enable = "+("smu.ON" if profile["autozero"] else "smu.OFF"))
+    if profile["filter"]:
+        inst.write("smu.measure.filter.type = smu.FILTER_REPEAT_AVG")
+        inst.write(f"smu.measure.filter.count = {profile['filter']}")
+        inst.write("smu.measure.filter.enable = smu.ON")
+    else:
+        inst.write("smu.measure.filter.enable = smu.OFF")
+
+
+def set_profile(acq,role,name):
+    """Sets the profile of a role of an acquisition.Acquisition, between two readings"""
+    acq.broker.call(role,lambda inst: apply_profile(inst,name),RAMP)
+    acq.profiles[role] = name
+
+
+def apply_profiles(acq,profiles=None):
+    """Sets the profile of each role (DEFAULT_PROFILES if None), e.g. after configuring the Keithleys"""
+    for role,name in (profiles or DEFAULT_PROFILES).items():
+        set_profile(acq,role,name)
+
+
+def parse_profiles(text):
+    """
+    Returns the profile of each role from a string, either a profile for
+    all the roles ("fast") or a list of role=profile ("hv=low-noise,psub=fast").
+    """
+    profiles = dict(DEFAULT_PROFILES)
+    for item in text.split(","):
+        role,_,name = item.rpartition("=")
+        if name not in PROFILES:
+            raise ValueError(f"Unknown profile {name}, it must be one of {list(PROFILES)}")
+        if role:
+            if role not in channels.SMU_ROLES:
+                raise ValueError(f"Unknown role {role}, it must be one of {channels.SMU_ROLES}")
+            profiles[role] = name
+        else:
+            profiles = {r: name for r in channels.SMU_ROLES}
+    return profiles
+
+
+def timed_reading(inst):
+    """Returns (current [A], seconds of the reading)"""
+    start = time.perf_counter()
+    value = acquisition.measure_current(inst)
+    return value,time.perf_counter()-start
+
+
+def benchmark(execute,names=None,readings=50):
+    """
+    Reads a Keithley with each profile (the readings of the acquisition,
+    see acquisition.measure_current) and returns a list of dicts with the
+    profile, the readings per second, the mean and the RMS noise [A].
+    Every change of profile and every reading is a call of execute(command),
+    which runs command(instrument); the rate counts the time of the
+    readings only. The caller restores the profile in use afterwards.
+    """
+    results = []
+    for name in names or list(PROFILES):
+        execute(lambda inst: apply_profile(inst,name))
+        execute(acquisition.measure_current) # first reading with the new settings
+        values = np.empty(readings)
+        elapsed = 0.
+        for i in range(readings):
+            values[i],duration = execute(timed_reading)
+            elapsed += duration
+        results.append({"profile": name,"rate": readings/elapsed,"mean": values.mean(),
+                        "rms": values.std(ddof=1) if readings > 1 else 0.})
+    return results
+
+
+def benchmark_role(acq,role,names=None,readings=50):
+    """
+    Benchmark of the Keithley of a role of an acquisition.Acquisition, then
+    the profile of the role is set again. Every change of profile and every
+    reading is a command of the broker of its own, so the ramp-down of the
+    interlock and the readings of the monitor are executed in between (the
+    readings of the monitor use the profile being benchmarked meanwhile).
+    """
+    try:
+        return benchmark(lambda command: acq.broker.call(role,command,RAMP),names,readings)
+    finally:
+        set_profile(acq,role,acq.profiles.get(role,DEFAULT_PROFILES[role]))
+
+
+def format_benchmark(role,results):
+    """Table of the results of benchmark"""
+    scale = channels.SCHEMA.by_name[{"hv": "I_HV","pwell": "I_pwell","psub": "I_psub"}[role]]
+    lines = [f"{role}: profile, readings/s, mean, RMS noise [{scale.unit}]"]
+    for r in results:
+        lines.append(f"  {r['profile']:<10} {r['rate']:8.2f} {r['mean']*scale.scale:12.5g} {r['rms']*scale.scale:10.3g}")
+    return "\n".join(lines)
+
+
+def main():
+    # Parse arguments from terminal
+    parser = argparse.ArgumentParser(description="Benchmark of the speed profiles of the Keithleys.")
+    parser.add_argument('--role', choices=channels.SMU_ROLES, default=None, help="Keithley to benchmark (default is all of them).")
+    parser.add_argument('--readings', type=int, default=50, help="Readings for each profile (default is 50).")
+
+    args = parser.parse_args()
+
+    rm,keithley1,keithley2,keithley3 = acquisition.configure_keithleys()
+    smus = {"hv": keithley3,"pwell": keithley2,"psub": keithley1}
+    try:
+        for role in [args.role] if args.role else channels.SMU_ROLES:
+            print(format_benchmark(role,benchmark(lambda command: command(smus[role]),readings=args.readings)))
+            apply_profile(smus[role],DEFAULT_PROFILES[role])
+    finally:
+        rm.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+Voltage ramps of the Keithleys of a station, through the command broker
+of the acquisition (see smu_broker.py).
+
+Every step of a ramp (setting the voltage, reading the current) is a
+command of RAMP priority: the readings of the currents are executed
+between the steps, so the currents are still measured and logged while
+the voltages are ramped. The ramps do not depend on Qt and are meant to
+run on a thread of their own, e.g.:
+
+    smu_ramps.run_ramps(acq.broker,hv=20,pwell=0,psub=0,chip="W8R4",step=0.5,delay=0.1)
+"""
+import time
+
+import numpy as np
+
+import acquisition
+import interlock
+from smu_broker import RAMP
+
+
+# Overprotection voltage of HV [V]
+HV_MAX = 30
+# Maximum abs(pwell) [V]
+PWELL_MAX = 6
+# Maximum abs(psub-pwell) of each chip, with pwell at PWELL_MAX [V]
+PSUB_MAX = {"W8R4": 4,"W2R17": 9,"W8R6": 14}
+
+
+class RampError(Exception):
+    """Voltages that must not be set on the chip"""
+
+
+def set_level(inst,volt):
+    inst.write("smu.source.level = "+str(volt))
+
+
+def check_hv(voltage):
+    """Raises RampError if HV cannot be set to voltage"""
+    if abs(voltage) > HV_MAX:
+        raise RampError("WARNING: the HV set is higher than the Overprotection Voltage set!")
+    if voltage < 0.:
+        raise RampError("HV cannot be negative!! ")
+
+
+def check_dc(voltage_pwell,voltage_psub,chip):
+    """Raises RampError if pwell and psub (absolute values) cannot be set on the chip"""
+    if voltage_psub < 0.:
+        raise RampError("WARNING: provide the absolute value of psub!! ")
+    if voltage_pwell < 0.:
+        raise RampError("WARNING: provide the absolute value of pwell!! ")
+    if voltage_pwell < PWELL_MAX:
+        if voltage_psub != 0:
+            raise RampError(f"WARNING: if pwell is <{PWELL_MAX} abs(psub-pwell) NEEDS TO be 0! ")
+    elif voltage_pwell == PWELL_MAX:
+        if voltage_psub > PSUB_MAX[chip]:
+            raise RampError(f"WARNING: abs(psub-pwell) CANNOT be >{PSUB_MAX[chip]} ({chip})! ")
+    else:
+        raise RampError(f"WARNING: pwell CANNOT be >{PWELL_MAX}!! ")
+
+
+def levels(broker):
+    """Returns the voltages set on HV, pwell and psub (absolute values) [V]"""
+    return [broker.call("hv",interlock.source_level,RAMP),
+            -broker.call("pwell",interlock.source_level,RAMP),
+            -broker.call("psub",interlock.source_level,RAMP)]
+
+
+def ramp(broker,role,voltage,step,delay,name,abort=None,scale=1.,unit="A",on_level=None):
+    """
+    Ramps the voltage of the Keithley of a role either up or down.
+
+    Parameters:
+    - broker (smu_broker.SmuBroker): broker of the Keithleys;
+    - role (str): "hv", "pwell" or "psub";
+    - voltage (float): ending voltage [V];
+    - step (float): step increment for voltage change [V];
+    - delay (float): delay between setting a voltage and reading the current [s];
+    - name (str): name of the voltage;
+    - abort (callable): default = None, the ramp stops when it returns True,
+    it is checked again on the thread of the Keithley right before each step
+    (a step queued before a trip of the interlock is not executed after it);
+    - scale (float), unit (str): default = 1, "A", unit of the printed currents;
+    - on_level (callable): default = None, called with (role, voltage) after each step is set;
+    """
+    set_voltage = broker.call(role,interlock.source_level,RAMP)
+    print(f"Current {name} voltage set:",set_voltage,"V")
+    if set_voltage > voltage:
+        print(f"Ramping {name} down to ",voltage,"V")
+        volts = np.arange(set_voltage,voltage-step,-step)
+        past = lambda volt: voltage != 0 and volt < voltage
+    else:
+        print(f"Ramping {name} up to ",voltage,"V")
+        volts = np.arange(set_voltage,voltage+step,step)
+        past = lambda volt: volt > voltage
+
+    def set_step(inst,volt):
+        if abort is not None and abort():
+            return False
+        set_level(inst,volt)
+        if on_level is not None:
+            on_level(role,volt)
+        return True
+
+    for volt in volts:
+        if past(volt) or (abort is not None and abort()):
+            break
+        if not broker.call(role,lambda inst,volt=volt: set_step(inst,volt),RAMP):
+            break
+        time.sleep(delay) # the readings of the currents are executed meanwhile
+        response = broker.call(role,acquisition.measure_current,RAMP)*scale
+        print(f"Voltage: {volt:.1f} V, current: {response:.2e} {unit}")
+        time.sleep(0.1)
+
+
+def ramp_dc(broker,voltage_pwell,voltage_psub,step,delay,chip,abort=None,on_level=None):
+    """
+    Ramps pwell and psub (absolute values [V]) in the safe order: pwell is
+    ramped first when the voltages decrease, psub first when they increase.
+    """
+    check_dc(voltage_pwell,voltage_psub,chip)
+
+    # Change sign to the voltage values
+    voltage_pwell = -voltage_pwell
+    voltage_psub = -voltage_psub
+
+    set_voltage_pwell = broker.call("pwell",interlock.source_level,RAMP)
+    set_voltage_psub = broker.call("psub",interlock.source_level,RAMP)
+    if set_voltage_pwell != voltage_pwell:
+        # Same order as the ramp-down of the interlock
+        first,second = interlock.dc_order(set_voltage_pwell,voltage_pwell)
+        voltages = {"pwell": voltage_pwell,"psub": voltage_psub}
+        ramp(broker,first,voltages[first],step,delay,first,abort,1000,"mA",on_level)
+        time.sleep(0.2)
+        ramp(broker,second,voltages[second],step,delay,second,abort,1000,"mA",on_level)
+    elif set_voltage_psub != voltage_psub:
+        ramp(broker,"psub",voltage_psub,step,delay,"psub",abort,1000,"mA",on_level)
+
+    print("Voltage ramp completed.")
+    print("Current values:")
+    for role,name in [("pwell","Pwell"),("psub","abs(Psub-Pwell)")]:
+        level = broker.call(role,interlock.source_level,RAMP)
+        current = broker.call(role,acquisition.measure_current,RAMP)*1000 # Convert in mA
+        print(f"{name}: Voltage: {level:.1f} V, current: {current:.2e} mA")
+
+
+def ramp_hv(broker,voltage,step,delay,abort=None,on_level=None):
+    """Ramps HV to voltage [V]"""
+    check_hv(voltage)
+    ramp(broker,"hv",voltage,step,delay,"HV",abort,on_level=on_level)
+    print("Voltage ramp completed.")
+
+
+def run_ramps(broker,hv,pwell,psub,chip,step,delay,abort=None,on_level=None):
+    """
+    Sets the voltages of a station (absolute values [V]): the DC part
+    (pwell, psub) and the HV part cannot be powered together, the part
+    switched off is ramped to 0 V before the other one is ramped.
+    It raises RampError, before any ramp, if the voltages are not allowed.
+    """
+    check_hv(hv)
+    check_dc(pwell,psub,chip)
+    if pwell == 0 and psub == 0:
+        ramp_dc(broker,0,0,step,delay,chip,abort,on_level)
+        time.sleep(0.5)
+        ramp_hv(broker,hv,step,delay,abort,on_level)
+    elif hv == 0:
+        ramp_hv(broker,0,step,delay,abort,on_level)
+        time.sleep(0.5)
+        ramp_dc(broker,pwell,psub,step,delay,chip,abort,on_level)
+    else:
+        raise RampError("Cannot power both the DCC and HVC parts!!")
@@ -0,0 +1,170 @@
+"""
+Fixed-rate measurement of the currents.
+
+The Keithleys are read on a fixed grid of a monotonic clock (one tick
+every period seconds), independently of the frames of the Arduino, by a
+thread of their own. For every tick the scheduled time and the actual
+time of the reading are written on a series file next to the data file:
+
+    time-and-dew-point-YYYYMMDD-HHMM.currents
+    t_scheduled t_actual I_HV I_pwell I_psub
+
+with the times of the data file [s] and the units of channels.py, so the
+currents are evenly spaced (e.g. for FFT and drift analysis) whatever the
+delay of the VISA calls. The last currents are also those of the samples
+of the data file (Acquisition.last_currents).
+
+The timing is checked at every tick: jitter (actual - scheduled time),
+late ticks (jitter above the tolerance or reading longer than the period)
+and missed ticks (a tick skipped because the previous reading was still
+in progress: the grid is kept, it never drifts).
+"""
+import os
+import math
+import time
+import threading
+
+import channels
+import link_health
+from channel_stats import RollingStats
+
+
+# Default period of the readings [s] << CHANGE WHEN NEEDED
+SMU_PERIOD = 1.
+
+
+def series_file_name(filename):
+    """Name of the series file of the currents of a data file (NAME.currents, not a run for analyze_runs.py)"""
+    return os.path.splitext(filename)[0]+".currents"
+
+
+class TickStats:
+    """
+    Timing statistics of a fixed-rate loop.
+
+    Parameters:
+    - period (float): period of the ticks [s];
+    - tolerance (float): default = None, maximum jitter of a tick in time
+    (10% of the period if None) [s];
+    - window (int): default = 100, ticks of the rolling statistics of the jitter;
+    """
+
+    def __init__(self,period,tolerance=None,window=100):
+        self.period = period
+        self.tolerance = tolerance if tolerance is not None else 0.1*period
+        self.jitter = RollingStats(window)
+        self.duration = RollingStats(window)
+        self.n_ticks = 0
+        self.n_late = 0
+        self.n_missed = 0
+        self.n_skipped = 0 # ticks without readings (currents off)
+        self.max_jitter = 0.
+
+    def record(self,scheduled,actual,duration):
+        """Records a tick: scheduled and actual time of the start, duration of the readings [s]"""
+        jitter = actual-scheduled
+        self.jitter.update(scheduled,jitter)
+        self.duration.update(scheduled,duration)
+        self.n_ticks += 1
+        self.max_jitter = max(self.max_jitter,jitter)
+        if jitter > self.tolerance or duration > self.period:
+            self.n_late += 1
+
+    def status(self):
+        return (f"SMU ticks: {self.n_ticks}, jitter {self.jitter.mean*1e3:.1f} +- {self.jitter.std*1e3:.1f} ms "
+                f"(max {self.max_jitter*1e3:.1f} ms), reading {self.duration.mean*1e3:.0f} ms, "
+                f"late: {self.n_late}, missed: {self.n_missed}")
+
+
+class SmuScheduler:
+    """
+    Thread reading the Keithleys of an acquisition at a fixed rate.
+
+    Parameters:
+    - acq (acquisition.Acquisition): the acquisition, its currents are taken
+    from the scheduler while it runs;
+    - period (float): default = SMU_PERIOD, seconds between two ticks;
+    - tolerance (float): default = None, maximum jitter of a tick (see TickStats);
+    - series (bool): default = True, write the series file of the currents;
+    """
+
+    def __init__(self,acq,period=SMU_PERIOD,tolerance=None,series=True):
+        self.acq = acq
+        self.period = period
+        self.stats = TickStats(period,tolerance)
+        self.sinks = [] # called with (t_scheduled, t_actual, currents) at each tick
+        self.n_errors = 0
+        self.series_file = None
+        if series:
+            self.series_file = open(series_file_name(acq.filename),"w")
+            header = " ".join(f"{name}[{channels.SCHEMA.unit(name)}]" for name in ["I_HV","I_pwell","I_psub"])
+            self.series_file.write("# t_scheduled[s] t_actual[s] "+header+"\n")
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Starts the thread, the acquisition stops reading the Keithleys itself"""
+        self.acq.currents_scheduled = True
+        self.thread = threading.Thread(target=self.run,name="smu-scheduler",daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(5+self.period)
+        self.acq.currents_scheduled = False
+        if self.series_file is not None:
+            self.series_file.close()
+
+    def run(self):
+        t0 = time.monotonic()
+        t0_wall = time.time()
+        k = 0
+        while not self.stop_event.is_set():
+            scheduled = t0+k*self.period
+            delay = scheduled-time.monotonic()
+            if delay > 0 and self.stop_event.wait(delay):
+                break
+            actual = time.monotonic()
+            if self.acq.currents:
+                self.tick(t0_wall+(scheduled-t0),scheduled,actual)
+            else:
+                self.stats.n_skipped += 1
+            # Next tick on the grid, skipping the ones already past
+            k += 1
+            late = math.floor((time.monotonic()-t0)/self.period)-k
+            if late > 0:
+                self.stats.n_missed += late
+                k += late
+
+    def tick(self,scheduled_wall,scheduled,actual):
+        currents = dict(self.acq.last_currents)
+        for role in channels.SMU_ROLES:
+            try:
+                currents[role] = self.acq.measure_role(role)
+            except link_health.LinkDown: # waiting to be reconnected (see supervisor.py)
+                pass
+            except Exception as err: # VISA errors or closed sessions: keep the last value
+                self.n_errors += 1
+                print(f"{role}: {err}")
+        duration = time.monotonic()-actual
+        self.acq.last_currents = currents
+        self.stats.record(scheduled,actual,duration)
+
+        # Times of the data file
+        t_scheduled = scheduled_wall-self.acq.starttime
+        t_actual = t_scheduled+(actual-scheduled)
+        if self.series_file is not None and not self.series_file.closed:
+            by_name = channels.SCHEMA.by_name
+            values = [currents["hv"]*by_name["I_HV"].scale,currents["pwell"]*by_name["I_pwell"].scale,
+                      currents["psub"]*by_name["I_psub"].scale]
+            self.series_file.write(" ".join(str(x) for x in [t_scheduled,t_actual]+values)+"\n")
+            self.series_file.flush()
+        for sink in self.sinks:
+            sink(t_scheduled,t_actual,currents)
+
+    def status(self):
+        text = self.stats.status()
+        if self.n_errors:
+            text += f", errors: {self.n_errors}"
+        return text
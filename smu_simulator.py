@@ -0,0 +1,126 @@
+"""
+Simulator of the Keithleys (psub, pwell, HV), to test the monitor without
+the instruments. It answers the TSP commands of the monitor (configuration,
+speed profiles, source level, readings of the current) like a VISA session
+of pyvisa; the sessions are opened by a SimulatedResourceManager:
+
+    rm = smu_simulator.SimulatedResourceManager()
+    acq = acquisition.Acquisition(directory,port,resource_manager=rm)
+
+Sessions can time out on purpose to test the reconnection of the
+Keithleys (see supervisor.py): a session that timed out stays broken
+until it is reopened.
+"""
+import time
+import random
+import threading
+from collections import deque
+
+import acquisition
+
+
+# Leakage resistance seen by the Keithley of each role [Ohm]
+LEAKAGE = {"psub": 1e6,"pwell": 1e6,"hv": 1e9}
+TIMEOUT_ERROR = "VI_ERROR_TMO (-1073807339): Timeout expired before operation completed."
+
+
+class SimulatedKeithley:
+    """
+    VISA session of a simulated Keithley.
+
+    Parameters:
+    - address (str): VISA address;
+    - role (str): default = None, "psub", "pwell" or "hv" (leakage of LEAKAGE);
+    - latency (float): default = 0.002, seconds of each read, as the round trip of VISA;
+    - fail (float): default = 0, probability of a timeout of each command;
+    - noise (float): default = 0.01, relative noise of the currents;
+    """
+
+    def __init__(self,address,role=None,latency=0.002,fail=0.,noise=0.01):
+        self.address = address
+        self.role = role
+        self.latency = latency
+        self.fail = fail
+        self.noise = noise
+        self.resistance = LEAKAGE.get(role,1e6)
+        self.level = 0.
+        self.settings = {} # other assignments, e.g. smu.measure.nplc
+        self.output = deque()
+        self.broken = False
+        self.lock = threading.Lock()
+        self.n_commands = 0
+
+    def check(self):
+        if self.broken:
+            raise IOError(TIMEOUT_ERROR)
+        if self.fail and random.random() < self.fail:
+            self.broken = True
+            raise IOError(TIMEOUT_ERROR)
+
+    def current(self):
+        return self.level/self.resistance*(1+random.gauss(0,self.noise))+random.gauss(0,1e-12)
+
+    def write(self,command):
+        with self.lock:
+            self.check()
+            self.n_commands += 1
+            command = command.strip()
+            if command == "print(smu.measure.read())":
+                self.output.append("%.6e" % self.current())
+            elif command == "print(voltage_set)":
+                self.output.append(repr(self.level))
+            elif command.startswith("smu.source.level ="):
+                self.level = float(command.split("=",1)[1])
+            elif "=" in command:
+                key,value = command.split("=",1)
+                self.settings[key.strip()] = value.strip()
+
+    def read(self):
+        time.sleep(self.latency)
+        with self.lock:
+            self.check()
+            if not self.output:
+                raise IOError(TIMEOUT_ERROR) # nothing printed
+            return self.output.popleft()
+
+    def query(self,command):
+        with self.lock:
+            self.check()
+            if command.strip() == "*IDN?":
+                return "KEITHLEY INSTRUMENTS,MODEL 2450,SIMULATED,1.0\n"
+        self.write(command)
+        return self.read()
+
+    def close(self):
+        self.broken = True
+
+
+class SimulatedResourceManager:
+    """
+    Resource manager of the simulated Keithleys, it replaces
+    pyvisa.ResourceManager.
+
+    Parameters:
+    - roles (dict): default = None, role of each VISA address (the default
+    addresses of acquisition.py if None);
+    - latency, fail: default = 0.002, 0, see SimulatedKeithley;
+    """
+
+    def __init__(self,roles=None,latency=0.002,fail=0.):
+        if roles is None:
+            roles = {acquisition.SMU_PSUB: "psub",acquisition.SMU_PWELL: "pwell",acquisition.SMU_HV: "hv"}
+        self.roles = roles
+        self.latency = latency
+        self.fail = fail
+        self.sessions = {} # last session of each address
+
+    def open_resource(self,address):
+        inst = SimulatedKeithley(address,self.roles.get(address),self.latency,self.fail)
+        if address in self.sessions: # the instrument keeps its source level
+            inst.level = self.sessions[address].level
+        self.sessions[address] = inst
+        return inst
+
+    def close(self):
+        for inst in self.sessions.values():
+            inst.close()
@@ -0,0 +1,397 @@
+"""
+Soak test of the monitor: days of samples in compressed time, to find the
+slow growths (memory, file handles, threads, backlog of the Qt signals)
+that only show up after hours of a real run.
+
+The whole pipeline of the GUI (the acquisition of a station, its sinks:
+data file, history, statistics, interlock, catalog..., and the windows,
+offscreen) runs on simulated instruments: the Arduino of
+arduino_simulator.py on a pseudo-terminal, sending the frames of --days
+at --speed times their rate, and the Keithleys of smu_simulator.py.
+
+Every --interval seconds the resources of the process are recorded on
+soak-YYYYMMDD-HHMMSS.csv (in --output): resident memory, CPU, open file
+descriptors, threads, Python heap traced by tracemalloc, latency of the
+samples (from the frame written on the serial port to the sample published
+by the acquisition, and from the acquisition to the GUI). The allocators
+that grow the most (tracemalloc, by line) are written on the -allocators.txt
+file at each record.
+
+At the end the records of the last quarter of the run are compared with
+the ones of the first quarter (after --warmup), and the test fails (exit
+code 1) if a resource grew beyond its threshold:
+
+    python soak_test.py --days 2 --speed 200
+    python soak_test.py --days 0.1 --max-rss-growth 20
+
+The time of the samples is the clock of the soak, so a day is shown as
+days/speed seconds by the plots; the Keithleys are read speed times more
+often too, with the same number of samples per reading as a real run.
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from collections import deque
+
+import numpy as np
+
+import acquisition
+import arduino_simulator
+import smu_scheduler
+import smu_simulator
+import stations
+
+
+# Default thresholds of the growth between the first and the last quarter << CHANGE WHEN NEEDED
+MAX_RSS_GROWTH = 100. # [MB]
+MAX_HEAP_GROWTH = 50. # Python heap traced by tracemalloc [MB]
+MAX_FD_GROWTH = 10
+MAX_THREAD_GROWTH = 5
+MAX_CPU_GROWTH = 25. # [percentage points]
+MAX_LATENCY_GROWTH = 0.5 # 99th percentile [s]
+# Frames per second of the Arduino of the lab
+FRAME_RATE = 4.
+COLUMNS = ["elapsed","simulated","samples","rss_mb","heap_mb","cpu","fds","threads",
+           "acq_p50","acq_p99","acq_max","gui_p50","gui_p99","gui_max"]
+
+
+class SimulatedArduino:
+    """
+    Arduino of arduino_simulator.py on a pseudo-terminal, writing the frames
+    of rate frames per second (of simulated time) speed times faster. The
+    time of each frame written is kept for the latency of the samples.
+
+    Parameters:
+    - rate (float): default = FRAME_RATE, frames per second of simulated time;
+    - speed (float): default = 100, compression of the time;
+    - binary (bool): default = False, binary frames instead of ASCII lines;
+    - block (float): default = 0.01, seconds between two writes;
+    """
+
+    def __init__(self,rate=FRAME_RATE,speed=100.,binary=False,block=0.01):
+        self.rate = rate
+        self.speed = speed
+        self.block = block
+        self.master,self.slave = os.openpty()
+        self.port = os.ttyname(self.slave)
+        self.sim = arduino_simulator.ArduinoSimulator(binary)
+        self.n_frames = 0
+        self.written = deque() # (index of the first frame of the next write, time.monotonic() of the write)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run,name="arduino-simulator",daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        start = time.monotonic()
+        while not self.stop_event.wait(self.block):
+            n = int((time.monotonic()-start)*self.rate*self.speed)-self.n_frames
+            if n <= 0:
+                continue
+            data = self.sim.stream(n,1/self.rate)
+            os.write(self.master,data) # blocks when the monitor is behind
+            with self.lock:
+                self.n_frames += n
+                self.written.append((self.n_frames,time.monotonic()))
+
+    def written_at(self,index):
+        """time.monotonic() of the write of a frame, the writes before it are forgotten"""
+        with self.lock:
+            while self.written and self.written[0][0] <= index:
+                self.written.popleft()
+            return self.written[0][1] if self.written else None
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join(5)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class SimulatedStation(stations.Station):
+    """Station of the soak, its Keithleys are opened by a smu_simulator.SimulatedResourceManager"""
+
+    def __init__(self,resource_manager,**kwargs):
+        super().__init__(**kwargs)
+        self.resource_manager = resource_manager
+
+    def open(self):
+        return acquisition.Acquisition(self.directory,self.port,currents=self.currents,
+                                       smu_addresses=self.smu_addresses,station=self.name,
+                                       binary=self.binary,chip=self.chip,resource_manager=self.resource_manager)
+
+
+class LatencyProbe:
+    """
+    Latency of the samples: last sink of the acquisition (from the write
+    of the frame to the publication) and slot of the batches of the GUI
+    (from the publication to the GUI).
+
+    Parameters:
+    - arduino (SimulatedArduino): the simulated Arduino;
+    - acq (acquisition.Acquisition): the acquisition;
+    """
+
+    def __init__(self,arduino,acq):
+        self.arduino = arduino
+        self.acq = acq
+        self.n_samples = 0
+        self.lock = threading.Lock()
+        self.acq_latency = []
+        self.gui_latency = []
+
+    def __call__(self,batch):
+        now = time.monotonic()
+        written = self.arduino.written_at(self.n_samples)
+        self.n_samples += len(batch)
+        if written is not None:
+            with self.lock:
+                self.acq_latency.append(now-written)
+
+    def gui(self,batch):
+        if len(batch):
+            with self.lock:
+                self.gui_latency.append(time.time()-self.acq.starttime-batch["time"][0])
+
+    def take(self):
+        """Latencies since the last call: (acquisition, GUI) [s]"""
+        with self.lock:
+            latencies = (np.array(self.acq_latency),np.array(self.gui_latency))
+            self.acq_latency = []
+            self.gui_latency = []
+        return latencies
+
+
+def percentiles(values):
+    if not len(values):
+        return [float("nan")]*3
+    return [np.percentile(values,50),np.percentile(values,99),values.max()]
+
+
+def proc_status(key):
+    """Value of a line of /proc/self/status (e.g. VmRSS in kB), None if unavailable"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(key+":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+class ResourceMonitor:
+    """
+    Records the resources of the process.
+
+    Parameters:
+    - probe (LatencyProbe): latencies of the samples;
+    - speed (float): compression of the time;
+    - path (str): CSV file of the records;
+    - traces (bool): default = True, trace the Python heap with tracemalloc
+    (started before the pipeline);
+    """
+
+    def __init__(self,probe,speed,path,traces=True):
+        self.probe = probe
+        self.speed = speed
+        self.traces = traces and tracemalloc.is_tracing()
+        self.records = []
+        self.start = time.monotonic()
+        self.last = (self.start,sum(os.times()[:2]))
+        self.baseline = None # tracemalloc snapshot at the end of the warmup
+        self.file = open(path,"w")
+        self.file.write(",".join(COLUMNS)+"\n")
+        self.allocators = open(os.path.splitext(path)[0]+"-allocators.txt","w")
+
+    def record(self,warm=True):
+        """Records the resources, the first record with warm True is the baseline of tracemalloc"""
+        now = time.monotonic()
+        cpu = sum(os.times()[:2])
+        cpu_load = (cpu-self.last[1])/max(now-self.last[0],1e-9)*100
+        self.last = (now,cpu)
+        acq_latency,gui_latency = self.probe.take()
+        rss = proc_status("VmRSS")
+        threads = proc_status("Threads") or threading.active_count()
+        heap = tracemalloc.get_traced_memory()[0]/2**20 if self.traces else float("nan")
+        row = dict(zip(COLUMNS,[now-self.start,(now-self.start)*self.speed,self.probe.n_samples,
+                                rss/1024 if rss is not None else float("nan"),heap,cpu_load,
+                                open_fds(),threads]+percentiles(acq_latency)+percentiles(gui_latency)))
+        row["warm"] = warm
+        self.records.append(row)
+        self.file.write(",".join("%.6g" % row[c] if row[c] is not None else "" for c in COLUMNS)+"\n")
+        self.file.flush()
+
+        if self.traces and warm:
+            snapshot = self.snapshot()
+            if self.baseline is None:
+                self.baseline = snapshot
+            else:
+                self.allocators.write(f"# {row['elapsed']:.0f} s\n")
+                for stat in self.top_allocators(snapshot):
+                    self.allocators.write(f"{stat}\n")
+                self.allocators.flush()
+        return row
+
+    def snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False,tracemalloc.__file__)])
+
+    def top_allocators(self,snapshot,n=10):
+        """Allocators (lines) of the largest growths since the baseline"""
+        return [stat for stat in snapshot.compare_to(self.baseline,"lineno")[:n] if stat.size_diff > 0]
+
+    def close(self):
+        self.file.close()
+        self.allocators.close()
+
+
+def format_record(row):
+    heap = "" if np.isnan(row["heap_mb"]) else f"heap {row['heap_mb']:6.1f} MB, "
+    return (f"{row['elapsed']:7.0f} s ({row['simulated']/3600:6.1f} h simulated) samples {row['samples']:9d}, "
+            f"RSS {row['rss_mb']:6.1f} MB, {heap}CPU {row['cpu']:5.1f}%, "
+            f"fds {row['fds']}, threads {row['threads']}, latency p99 {row['acq_p99']*1e3:.1f} ms (acq) "
+            f"{row['gui_p99']*1e3:.1f} ms (GUI)")
+
+
+def growths(records):
+    """
+    Growth of each resource: mean (maximum for fds and threads) of the last
+    quarter of the warm records minus the one of the first quarter.
+    """
+    warm = [r for r in records if r["warm"]]
+    n = max(len(warm)//4,1)
+    first,last = warm[:n],warm[-n:]
+    result = {}
+    for key in ["rss_mb","heap_mb","cpu","acq_p99","gui_p99"]:
+        a = np.nanmean([r[key] for r in first]) if not all(np.isnan(r[key]) for r in first) else np.nan
+        b = np.nanmean([r[key] for r in last]) if not all(np.isnan(r[key]) for r in last) else np.nan
+        result[key] = b-a
+    for key in ["fds","threads"]:
+        if first[0][key] is not None:
+            result[key] = max(r[key] for r in last)-max(r[key] for r in first)
+    return result
+
+
+def verdict(records,thresholds):
+    """Returns the resources that grew beyond their threshold: [(name, growth, threshold)]"""
+    failures = []
+    for key,growth in growths(records).items():
+        if not np.isnan(growth) and growth > thresholds[key]:
+            failures.append((key,growth,thresholds[key]))
+    return failures
+
+
+def main():
+    # Parse arguments from terminal
+    parser = argparse.ArgumentParser(description="Soak test of the monitor on simulated instruments, in compressed time.")
+    parser.add_argument('--days', type=float, default=1., help="Days of samples (default is 1).")
+    parser.add_argument('--speed', type=float, default=100., help="Compression of the time: frames sent speed times faster than the Arduino (default is 100).")
+    parser.add_argument('--rate', type=float, default=FRAME_RATE, help="Frames per second of the Arduino (default is %g)." % FRAME_RATE)
+    parser.add_argument('--binary', action='store_true', help="Binary frames (see binary_frames.py).")
+    parser.add_argument('--no-currents', action='store_true', help="Do not use the simulated Keithleys.")
+    parser.add_argument('--smu-latency', type=float, default=0.002, help="Seconds of each read of the simulated Keithleys (default is 0.002).")
+    parser.add_argument('--smu-fail', type=float, default=0., help="Probability of a timeout of each command of the Keithleys, to test the reconnections (default is 0).")
+    parser.add_argument('--interval', type=float, default=30., help="Seconds between two records of the resources (default is 30).")
+    parser.add_argument('--warmup', type=float, default=None, help="Seconds before the first quarter of the comparison (default is 10%% of the run).")
+    parser.add_argument('--directory', default=None, help="Directory of the data files (default is a temporary directory, deleted at the end).")
+    parser.add_argument('--output', default=".", help="Directory of the records of the resources (default is the current directory).")
+    parser.add_argument('--no-tracemalloc', action='store_true', help="Do not trace the Python heap (faster).")
+    parser.add_argument('--max-rss-growth', type=float, default=MAX_RSS_GROWTH, help="MB (default is %g)." % MAX_RSS_GROWTH)
+    parser.add_argument('--max-heap-growth', type=float, default=MAX_HEAP_GROWTH, help="MB (default is %g)." % MAX_HEAP_GROWTH)
+    parser.add_argument('--max-fd-growth', type=int, default=MAX_FD_GROWTH, help="File descriptors (default is %d)." % MAX_FD_GROWTH)
+    parser.add_argument('--max-thread-growth', type=int, default=MAX_THREAD_GROWTH, help="Threads (default is %d)." % MAX_THREAD_GROWTH)
+    parser.add_argument('--max-cpu-growth', type=float, default=MAX_CPU_GROWTH, help="Percentage points of CPU (default is %g)." % MAX_CPU_GROWTH)
+    parser.add_argument('--max-latency-growth', type=float, default=MAX_LATENCY_GROWTH, help="Seconds of the 99th percentile of the latency (default is %g)." % MAX_LATENCY_GROWTH)
+
+    args = parser.parse_args()
+    duration = args.days*86400/args.speed
+    warmup = duration*0.1 if args.warmup is None else args.warmup
+    thresholds = {"rss_mb": args.max_rss_growth,"heap_mb": args.max_heap_growth,"fds": args.max_fd_growth,
+                  "threads": args.max_thread_growth,"cpu": args.max_cpu_growth,
+                  "acq_p99": args.max_latency_growth,"gui_p99": args.max_latency_growth}
+    directory = args.directory or tempfile.mkdtemp(prefix="soak-")
+    directory = os.path.join(directory,"")
+    os.makedirs(directory,exist_ok=True)
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+
+    # Offscreen GUI
+    os.environ.setdefault("QT_QPA_PLATFORM","offscreen")
+    from PyQt5 import QtWidgets, QtCore
+    import temp_curr_monitor_new as monitor
+
+    arduino = SimulatedArduino(args.rate,args.speed,args.binary)
+    rm = smu_simulator.SimulatedResourceManager(latency=args.smu_latency,fail=args.smu_fail)
+    station = SimulatedStation(rm,name="soak",port=arduino.port,directory=directory,
+                               currents=not args.no_currents,binary=args.binary)
+    print(f"Soak test: {args.days:g} days of samples at {args.rate*args.speed:g} frames/s in {duration:.0f} s, data on {directory}")
+
+    app = QtWidgets.QApplication(sys.argv[:1])
+    window = monitor.StationsWindow([station],catalog=True,smu_period=smu_scheduler.SMU_PERIOD/args.speed)
+    receiver = window.receivers[0]
+    probe = LatencyProbe(arduino,receiver.acq)
+    receiver.acq.sinks.append(probe)
+    receiver.dataBatch.connect(probe.gui)
+    resources = ResourceMonitor(probe,args.speed,os.path.join(args.output,time.strftime("soak-%Y%m%d-%H%M%S.csv")),not args.no_tracemalloc)
+    arduino.start()
+
+    def record():
+        elapsed = time.monotonic()-resources.start
+        print(format_record(resources.record(warm=elapsed >= warmup)))
+        if elapsed >= duration:
+            window.close()
+            app.quit()
+
+    timer = QtCore.QTimer()
+    timer.timeout.connect(record)
+    timer.start(int(args.interval*1000))
+    app.exec_()
+    arduino.close()
+    rm.close()
+
+    # Verdict
+    acq = receiver.acq
+    print(f"{acq.n_samples} samples ({acq.n_samples/args.rate/3600:.1f} h simulated) of {arduino.n_frames} frames, "
+          f"malformed frames {acq.parser.n_malformed}, outages {len(acq.outages)}, {receiver.bridge.status()}")
+    warm = [r for r in resources.records if r["warm"]]
+    failures = []
+    if len(warm) < 2:
+        print("Too few records after the warmup for a verdict, use a longer run or a shorter --interval")
+        failures.append(("records",len(warm),2))
+    else:
+        for key,growth in sorted(growths(resources.records).items()):
+            if np.isnan(growth): # e.g. heap without tracemalloc
+                continue
+            print(f"Growth of {key}: {growth:+.3g} (maximum {thresholds[key]:g})")
+        failures += verdict(resources.records,thresholds)
+    if resources.baseline is not None:
+        print("Largest growths of the Python heap since the warmup:")
+        for stat in resources.top_allocators(resources.snapshot()):
+            print(f"  {stat}")
+    resources.close()
+    print("Records on",resources.file.name)
+    if args.directory is None:
+        shutil.rmtree(directory,ignore_errors=True)
+    if failures:
+        print("FAILED: "+", ".join(f"{key} grew by {growth:.3g} > {limit:g}" for key,growth,limit in failures))
+        return 1
+    print("PASSED")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""
+Sampling profiler of all the threads of the running process (GUI,
+acquisition, Keithleys, renderer...), to be started when the monitor is
+slow without restarting it.
+
+A thread takes the Python stack of every other thread every interval
+(sys._current_frames) and counts the stacks; the cost on the monitor is
+the sampling only, the code being profiled is not instrumented. The
+result is written in the folded format of the flame graphs, one line per
+stack with the number of samples:
+
+    MainThread;<module> (temp_curr_monitor_new.py:1);update_data (temp_curr_monitor_new.py:880) 12
+
+which can be opened with speedscope (https://www.speedscope.app) or
+converted with flamegraph.pl. The samples are wall-clock: a thread waiting
+(sleep, lock, serial read) is counted where it waits.
+
+    sampler = StackSampler()
+    sampler.start(duration=30)
+    ...
+    sampler.save("profile.folded")
+"""
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+
+# Interval between two samples [s]
+SAMPLE_INTERVAL = 0.005
+# Default duration of a capture [s] << CHANGE WHEN NEEDED
+PROFILE_DURATION = 30
+
+
+def profile_file_name(filename):
+    """File of a capture next to a data file: the name of the file without .dat, plus -profile-YYYYMMDD-HHMMSS.folded"""
+    return os.path.splitext(filename)[0]+time.strftime("-profile-%Y%m%d-%H%M%S.folded")
+
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Parameters:
+    - interval (float): default = SAMPLE_INTERVAL, seconds between two samples;
+    - on_done (callable): default = None, called with the sampler (on its
+    thread) when the capture ends;
+    """
+
+    def __init__(self,interval=SAMPLE_INTERVAL,on_done=None):
+        self.interval = interval
+        self.on_done = on_done
+        self.stacks = Counter() # (thread ident, code objects from the root) : samples
+        self.thread_names = {}
+        self.labels = {}
+        self.n_samples = 0
+        self.sampling_time = 0. # time spent taking the samples [s]
+        self.started = None
+        self.elapsed = 0.
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self,duration=None):
+        """Starts the capture, it ends after duration seconds (or at stop() if None)"""
+        self.thread = threading.Thread(target=self.run,args=(duration,),name="stack-sampler",daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(5)
+
+    def run(self,duration):
+        own = threading.get_ident()
+        self.started = time.perf_counter()
+        deadline = None if duration is None else self.started+duration
+        next_sample = self.started
+        while not self.stop_event.is_set():
+            now = time.perf_counter()
+            if deadline is not None and now >= deadline:
+                break
+            if self.n_samples%100 == 0: # new threads
+                self.thread_names.update({t.ident: t.name for t in threading.enumerate()})
+            for ident,frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                self.stacks[(ident,tuple(reversed(codes)))] += 1
+            self.n_samples += 1
+            self.sampling_time += time.perf_counter()-now
+            next_sample = max(next_sample+self.interval,time.perf_counter())
+            self.stop_event.wait(next_sample-time.perf_counter())
+        self.elapsed = time.perf_counter()-self.started
+        if self.on_done is not None:
+            self.on_done(self)
+
+    def thread_name(self,ident):
+        """Name of a thread, the threads not started by threading (QThread) by their ident"""
+        return self.thread_names.get(ident,f"thread-{ident}")
+
+    def label(self,code):
+        if code not in self.labels:
+            self.labels[code] = frame_label(code)
+        return self.labels[code]
+
+    def folded(self):
+        """Lines of the folded stacks, the root of each stack is the name of its thread"""
+        counts = Counter()
+        for (ident,codes),n in self.stacks.items():
+            counts[";".join([self.thread_name(ident)]+[self.label(code) for code in codes])] += n
+        return [f"{stack} {n}" for stack,n in sorted(counts.items())]
+
+    def save(self,path):
+        with open(path,"w") as f:
+            f.write("\n".join(self.folded())+"\n")
+
+    def top(self,n=10):
+        """The n functions with the most samples on the top of the stacks: [(label, thread, samples)]"""
+        counts = Counter()
+        for (ident,codes),k in self.stacks.items():
+            if codes:
+                counts[(self.label(codes[-1]),self.thread_name(ident))] += k
+        return [(label,thread,k) for (label,thread),k in counts.most_common(n)]
+
+    def summary(self,n=10):
+        """Text of the capture: duration, overhead and top functions"""
+        lines = [f"{self.n_samples} samples in {self.elapsed:.1f} s "
+                 f"(sampling {self.sampling_time/max(self.elapsed,1e-9)*100:.1f}% of the time), top functions:"]
+        for label,thread,k in self.top(n):
+            lines.append(f"  {k/max(self.n_samples,1)*100:5.1f}%  {thread}: {label}")
+        return "\n".join(lines)
@@ -0,0 +1,289 @@
+"""
+Control of a station from another process.
+
+With --split the GUI (temp_curr_monitor_new.py) runs the acquisition and
+the persistence in a headless_monitor.py child process: the samples reach
+the GUI through the shared memory of sample_bus.py, and the buttons of the
+GUI (ramps, pause of the currents, reconnection of the Keithleys,
+interlock, chip, stop) are sent back as commands. A slow GUI no longer
+delays the readings of the serial port and of the Keithleys, and the child
+keeps acquiring if the GUI crashes (it runs in its own session, with its
+output on a log file).
+
+The commands are JSON lines on a TCP connection of localhost, one
+connection for each command:
+
+    {"command": "ramp", "hv": 50, "pwell": 2, ...}
+    -> {"ok": true, "result": ["Voltage ramp completed.", null]}
+    -> {"ok": false, "error": "..."}
+
+    python headless_monitor.py --bus --control 9500
+"""
+import os
+import sys
+import json
+import socket
+import threading
+import subprocess
+import socketserver
+
+import interlock
+import smu_profiles
+import smu_ramps
+import stations
+
+
+# Default TCP port of the commands << CHANGE WHEN NEEDED
+CONTROL_PORT = 9500
+# Seconds between two status requests of the GUI
+STATUS_PERIOD = 1.
+
+
+class ControlError(Exception):
+    """A command failed in the monitor that executed it"""
+
+
+def run_ramps(acq,safety,recorder,hv,pwell,psub,chip,step,delay):
+    """
+    Ramps the voltages of a station through its broker (see smu_ramps.py)
+    and records them in the catalog, every step as it is set (also when the
+    ramp fails or is stopped by the interlock). It returns (message,
+    voltages set or None): the voltages set are returned when the voltages
+    asked are not allowed, and nothing has been ramped.
+    """
+    def tripped():
+        return safety is not None and safety.tripped
+
+    broker = acq.broker
+    levels = None
+    on_level = recorder.set_level if recorder is not None else None
+    try:
+        levels = smu_ramps.levels(broker)
+        smu_ramps.run_ramps(broker,hv,pwell,psub,chip,step,delay,abort=tripped,on_level=on_level)
+        if tripped():
+            return "Ramp stopped by the interlock",None
+        return "Voltage ramp completed.",None
+    except smu_ramps.RampError as err: # voltages not allowed: nothing has been ramped
+        return str(err),levels
+    except Exception as err: # VISA errors
+        return f"Ramp failed: {err}",None
+    finally:
+        if recorder is not None:
+            try:
+                recorder.set_levels(smu_ramps.levels(broker))
+            except Exception: # the Keithley that failed cannot be read: its steps are recorded
+                pass
+
+
+def reconnect(acq):
+    """Reopens the broken Keithleys of a station with their speed profile, it returns the state of each role"""
+    states = acq.reconnect_keithleys()
+    for role,state in states.items():
+        if state == "reopened":
+            smu_profiles.set_profile(acq,role,acq.profiles.get(role,smu_profiles.DEFAULT_PROFILES[role]))
+    return states
+
+
+class StationControl:
+    """
+    Commands of a station: execute() calls the method command_NAME of the
+    command with its parameters, the result must be a JSON value.
+
+    Parameters:
+    - acq (acquisition.Acquisition): the acquisition;
+    - safety (interlock.Interlock): default = None, interlock of the station;
+    - recorder (run_catalog.RunRecorder): default = None, catalog of the run;
+    - smu (smu_scheduler.SmuScheduler): default = None, readings of the Keithleys;
+    - on_stop (callable): default = None, stops the monitor (command stop);
+    """
+
+    def __init__(self,acq,safety=None,recorder=None,smu=None,on_stop=None):
+        self.acq = acq
+        self.safety = safety
+        self.recorder = recorder
+        self.smu = smu
+        self.on_stop = on_stop
+        self.ramp_lock = threading.Lock()
+
+    def execute(self,request):
+        name = request.get("command")
+        method = getattr(self,f"command_{name}",None)
+        if method is None:
+            raise ControlError(f"Unknown command {name!r}")
+        return method(**{key: value for key,value in request.items() if key != "command"})
+
+    def command_status(self):
+        acq = self.acq
+        status = {"station": acq.station,"filename": acq.filename,"pid": os.getpid(),"chip": acq.chip,
+                  "samples": acq.n_samples,"currents": acq.currents,"keithleys": acq.rm is not None,
+                  "links_down": acq.links_down(),"malformed": acq.parser.n_malformed,
+                  "lost": getattr(acq.parser,"n_lost",None),"ramping": self.ramp_lock.locked(),
+                  "scheduler": self.smu.status() if self.smu is not None else None,"interlock": None}
+        if self.safety is not None:
+            status["interlock"] = {"tripped": self.safety.tripped,"reports": len(self.safety.reports),
+                                   "last_report": self.safety.reports[-1] if self.safety.reports else None,
+                                   "rules": [[r.name,r.channel,r.low,r.high,r.use_abs] for r in self.safety.rules]}
+        return status
+
+    def command_pause_currents(self):
+        self.acq.pause_currents()
+        return self.acq.currents
+
+    def command_resume_currents(self):
+        self.acq.resume_currents()
+        return self.acq.currents
+
+    def command_reconnect(self):
+        return reconnect(self.acq)
+
+    def command_ramp(self,hv,pwell,psub,chip,step,delay):
+        if self.safety is not None and self.safety.tripped:
+            return "Interlock tripped: reset it before ramping",None
+        if not self.ramp_lock.acquire(blocking=False):
+            raise ControlError("A ramp is already running")
+        try:
+            return run_ramps(self.acq,self.safety,self.recorder,hv,pwell,psub,chip,step,delay)
+        finally:
+            self.ramp_lock.release()
+
+    def command_interlock_reset(self):
+        if self.safety is not None:
+            self.safety.reset()
+
+    def command_interlock_mode(self,mode):
+        if self.safety is not None:
+            self.safety.set_mode(mode)
+
+    def command_chip(self,chip):
+        if chip not in stations.CHIPS:
+            raise ControlError(f"Unknown chip {chip}, it must be one of {stations.CHIPS}")
+        self.acq.chip = chip
+
+    def command_stop(self):
+        """Stops the monitor, all its stations"""
+        if self.on_stop is None:
+            raise ControlError("This monitor cannot be stopped by a command")
+        self.on_stop()
+
+
+class ControlServer:
+    """
+    TCP endpoint of the commands of a station.
+
+    Parameters:
+    - control (StationControl): commands of the station;
+    - port (int): default = CONTROL_PORT, TCP port;
+    - host (str): default = "localhost", interface to listen on;
+    """
+
+    def __init__(self,control,port=CONTROL_PORT,host="localhost"):
+        self.control = control
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                if not line:
+                    return
+                try:
+                    reply = {"ok": True,"result": control.execute(json.loads(line))}
+                except Exception as err: # sent to the client, the monitor goes on
+                    reply = {"ok": False,"error": str(err) or repr(err)}
+                self.wfile.write((json.dumps(reply)+"\n").encode())
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True # restart on the same port
+            daemon_threads = True
+
+        self.server = Server((host,port),Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,name="control",daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ControlClient:
+    """
+    Sends commands to the ControlServer of a station.
+
+    Parameters:
+    - host (str): host of the monitor;
+    - port (int): default = CONTROL_PORT, TCP port of the commands;
+    - timeout (float): default = 10, seconds to wait for an answer;
+    """
+
+    def __init__(self,host="localhost",port=CONTROL_PORT,timeout=10.):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def call(self,command,timeout=-1,**params):
+        """
+        Executes a command and returns its result, it raises ControlError if
+        the command failed and OSError if the monitor does not answer.
+        timeout is the one of the client if -1, None to wait for the end of
+        the command however long (e.g. ramps).
+        """
+        with socket.create_connection((self.host,self.port),timeout=self.timeout) as sock:
+            sock.settimeout(self.timeout if timeout == -1 else timeout)
+            sock.sendall((json.dumps(dict(params,command=command))+"\n").encode())
+            with sock.makefile("rb") as f:
+                line = f.readline()
+        if not line:
+            raise ConnectionError("The monitor closed the connection")
+        reply = json.loads(line)
+        if not reply["ok"]:
+            raise ControlError(reply["error"])
+        return reply["result"]
+
+
+class RemoteInterlock:
+    """
+    State of the interlock of a station of another process, for the GUI:
+    the same tripped, rules, reset() and set_mode() of interlock.Interlock.
+
+    Parameters:
+    - client (ControlClient): commands of the station;
+    """
+
+    def __init__(self,client):
+        self.client = client
+        self.rules = []
+        self.tripped = False
+        self.n_reports = None
+
+    def update(self,state):
+        """Updates from the status of the station, it returns the report of a new trip or None"""
+        self.rules = [interlock.Rule(*spec) for spec in state["rules"]]
+        self.tripped = state["tripped"]
+        new = self.n_reports is not None and state["reports"] > self.n_reports
+        self.n_reports = state["reports"]
+        return state["last_report"] if new else None
+
+    def reset(self):
+        self.client.call("interlock_reset")
+        self.tripped = False
+
+    def set_mode(self,mode):
+        self.client.call("interlock_mode",mode=mode)
+
+
+def free_port():
+    """A TCP port of localhost free at the moment"""
+    with socket.socket() as sock:
+        sock.bind(("localhost",0))
+        return sock.getsockname()[1]
+
+
+def start_monitor(options,log_path):
+    """
+    Starts headless_monitor.py with the command line options in its own
+    session, so that it is not stopped by the GUI (or its terminal)
+    closing or crashing. Its output is written on log_path. It returns
+    the subprocess.Popen of the monitor.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),"headless_monitor.py")
+    with open(log_path,"a") as log:
+        return subprocess.Popen([sys.executable,"-u",script]+list(options),stdin=subprocess.DEVNULL,
+                                stdout=log,stderr=subprocess.STDOUT,start_new_session=True)
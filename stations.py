@@ -0,0 +1,116 @@
+"""
+Stations of the lab: each station is a cold box with its own Arduino,
+its own three Keithleys (psub, pwell, HV), chip under test and data files.
+
+The stations are described in a JSON file, e.g.:
+
+    [
+        {"name": "box1", "port": "/dev/ttyUSB0", "chip": "W8R4",
+         "psub": "TCPIP0::169.254.91.1::inst0::INSTR",
+         "pwell": "TCPIP0::169.254.91.2::inst0::INSTR",
+         "hv": "TCPIP0::169.254.91.3::inst0::INSTR"},
+        {"name": "box2", "port": "/dev/ttyUSB1", "chip": "W2R17",
+         "psub": "TCPIP0::169.254.92.1::inst0::INSTR",
+         "pwell": "TCPIP0::169.254.92.2::inst0::INSTR",
+         "hv": "TCPIP0::169.254.92.3::inst0::INSTR",
+         "directory": "/home/labb2/ardu_dew_point/data/box2/"}
+    ]
+
+Missing keys take the default values of acquisition.py.
+All the stations of a process are acquired by a single StationScheduler.
+"""
+import json
+import time
+
+import acquisition
+
+
+# Chips that can be tested, the index is the one of MainWindow.dut
+CHIPS = ["W8R4","W2R17","W8R6"]
+
+
+class Station:
+    """
+    Configuration of a station.
+
+    Parameters:
+    - name (str): name of the station, used in the tabs and data file names;
+    - port (str): serial port of the Arduino;
+    - psub, pwell, hv (str): VISA addresses of the Keithleys;
+    - chip (str): chip under test, one of CHIPS;
+    - directory (str): directory of the output data files;
+    - currents (bool): if False the Keithleys are not used;
+    - binary (bool): if True the Arduino sends binary frames;
+    """
+
+    def __init__(self,name=None,port=acquisition.ARDUINO_PORT,psub=acquisition.SMU_PSUB,
+                 pwell=acquisition.SMU_PWELL,hv=acquisition.SMU_HV,chip=CHIPS[0],
+                 directory=acquisition.DATA_DIRECTORY,currents=True,binary=False):
+        if chip not in CHIPS:
+            raise ValueError(f"Unknown chip {chip}, it must be one of {CHIPS}")
+        self.name = name
+        self.port = port
+        self.smu_addresses = (psub,pwell,hv)
+        self.chip = chip
+        self.directory = directory
+        self.currents = currents
+        self.binary = binary
+
+    def open(self):
+        """Opens the instruments and the data file, it returns the Acquisition of the station."""
+        return acquisition.Acquisition(self.directory,self.port,currents=self.currents,
+                                       smu_addresses=self.smu_addresses,station=self.name,
+                                       binary=self.binary,chip=self.chip)
+
+
+def load_stations(path):
+    """Reads the JSON file of the stations and returns the list of Station."""
+    with open(path) as f:
+        config = json.load(f)
+    stations = [Station(**entry) for entry in config]
+    names = [st.name for st in stations]
+    if len(stations) > 1 and (None in names or len(set(names)) != len(names)):
+        raise ValueError("Each station needs a different name")
+    ports = [st.port for st in stations]
+    if len(set(ports)) != len(ports):
+        raise ValueError("Two stations use the same serial port")
+    return stations
+
+
+class StationScheduler:
+    """
+    Acquires many stations from a single thread: each acquisition is
+    polled in turn and the thread sleeps only when none of them has new
+    data. The cost of a station is only the time spent reading it.
+
+    Parameters:
+    - acquisitions (list of acquisition.Acquisition): the stations to acquire;
+    - idle (float): default = 0.05, sleeping time when no data is available;
+    """
+
+    def __init__(self,acquisitions,idle=0.05):
+        self.acquisitions = acquisitions
+        self.idle = idle
+        self.active = False
+
+    def run(self):
+        for acq in self.acquisitions:
+            acq.start()
+        self.active = True
+        try:
+            while self.active:
+                n = 0
+                for acq in self.acquisitions:
+                    if acq.active:
+                        n += acq.poll()
+                if n == 0:
+                    time.sleep(self.idle)
+        finally:
+            for acq in self.acquisitions:
+                acq.close()
+
+    def stop(self):
+        """Stops all the stations"""
+        self.active = False
+        for acq in self.acquisitions:
+            acq.stop()
@@ -0,0 +1,61 @@
+"""
+Supervision of the Keithleys of an acquisition.
+
+A thread checks the health of the Keithleys (see link_health.py): when
+a reading fails the Keithley is marked down and its readings are
+suspended, then the thread retries with a capped exponential backoff to
+reconnect it (Acquisition.reconnect_keithleys: the session is checked and
+reopened only if broken, with its speed profile). When the reconnection
+succeeds the Keithley is up again and the outage is reported.
+
+The serial port of the Arduino is supervised by the acquisition itself
+(Acquisition.poll, or the reader of async_acquisition.py).
+"""
+import time
+import threading
+
+import smu_profiles
+
+
+class SmuSupervisor:
+    """
+    Parameters:
+    - acq (acquisition.Acquisition): acquisition whose Keithleys are supervised;
+    - period (float): default = 0.2, seconds between two checks of the health;
+    """
+
+    def __init__(self,acq,period=0.2):
+        self.acq = acq
+        self.period = period
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,name="smu-supervisor",daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(5)
+
+    def run(self):
+        while not self.stop_event.wait(self.period):
+            for role in self.acq.broker.roles:
+                if self.acq.health[role].retry_due():
+                    self.recover(role)
+
+    def recover(self,role):
+        """Tries to reconnect the Keithley of a role"""
+        health = self.acq.health[role]
+        start = time.monotonic()
+        try:
+            state = self.acq.reconnect_keithleys([role])[role]
+            if state == "reopened":
+                smu_profiles.set_profile(self.acq,role,self.acq.profiles.get(role,smu_profiles.DEFAULT_PROFILES[role]))
+            elif state != "ok":
+                raise RuntimeError(state)
+        except Exception as err: # VISA errors: retry later
+            health.retry_failed(err)
+            return
+        self.acq.link_recovered(role,time.monotonic()-start)
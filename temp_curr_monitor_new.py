@@ -8,198 +8,328 @@
 
 
 
+import os
 import sys
-import serial
 import time
+import socket
+import argparse
+import threading
+import asyncio
 import random
+import tempfile
+import traceback
 import numpy as np
 import matplotlib
 matplotlib.use('Qt5Agg')
-from datetime import datetime
-from queue import Queue,Empty
+from queue import Queue
 
 
-from PyQt5 import QtCore, QtWidgets
-from PyQt5.QtCore import QThread,pyqtSignal,QTimer
+from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5.QtCore import QThread,pyqtSignal
 from PyQt5.QtWidgets import QVBoxLayout,QWidget,QTabWidget,QLabel,QHBoxLayout,QComboBox, QPushButton, QSpinBox, QDoubleSpinBox, QGridLayout
 
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
-import pyvisa as visa
 import pymeasure.instruments.keithley as kit
+import acquisition
+import channels
+import channel_stats
+import figure_renderer
+import history_pyramid
+import history_store
+import interlock
+import run_catalog
+import metrics_exporter
+import sample_bridge
+import sample_bus
+import smu_profiles
+import smu_scheduler
+import stack_sampler
+import station_control
+import supervisor
+import async_acquisition
+import stations
 
 
 class GetData(QtCore.QObject):
     """
     Subclass of QtCore.QObject, used for defining the main thread of program.
-    """
-    # How we expect our signal (13 floats)
-    dataChanged = pyqtSignal(float, float, float, float, float, float, float, float,float,float,float,float,float)
+    The acquisition and the saving of the data are done by acquisition.Acquisition,
+    this class only forwards the samples to the GUI.
 
-    def __init__(self, queue, *args, **kwargs):
+    Parameters:
+    - queue (Queue): queue of the thread;
+    - acq (acquisition.Acquisition): default = None, acquisition of a station
+    already opened and scheduled by a stations.StationScheduler; if None the
+    default station is opened and run() acquires it.
+    - engine (str): default = "threads", "asyncio" to acquire with the
+    engine of async_acquisition.py instead of the loop of Acquisition.run.
+    - binary (bool): default = False, the Arduino of the default station
+    sends binary frames (see binary_frames.py).
+    - bus (str): default = None, prefix of the shared memory on which the
+    samples are also published (see sample_bus.py).
+    - exporter (metrics_exporter.MetricsExporter): default = None, endpoint
+    on which the metrics of the station are exported.
+    - catalog (bool): default = True, the run is added to the catalog of
+    the data directory when it is closed (see run_catalog.py).
+    - smu_period (float): default = smu_scheduler.SMU_PERIOD, period of the
+    readings of the Keithleys in seconds (0 to read them with each frame).
+    """
+    # How we expect our signal (a structured array of samples, see sample_bridge.py)
+    dataBatch = pyqtSignal(object)
+    # Alarms of the rolling statistics (see channel_stats.py)
+    statsAlarm = pyqtSignal(object)
+    # Reports of the safety interlock (see interlock.py)
+    interlockTrip = pyqtSignal(object)
+
+    def __init__(self, queue, *args, acq=None, engine="threads", binary=False, bus=None, exporter=None, catalog=True, smu_period=smu_scheduler.SMU_PERIOD, **kwargs):
         QtCore.QObject.__init__(self, *args, **kwargs)
         self.queue = queue
+        self.engine = engine
+
+        if acq is None:
+            # Serial port, Keithleys and data file << CHANGE WHEN NEEDED in acquisition.py
+            acq = acquisition.Acquisition(binary=binary)
+
+            # IF THE CURRENTS' PART DOESN'T WORK: TRY WITH THE COMMANDS OF THE RAMP UP
+
+            time.sleep(2) # wait 2 seconds
+        self.acq = acq
+        self.stats = channel_stats.ChannelStats(drift_limits=channel_stats.DRIFT_LIMITS)
+        self.stats.listeners.append(lambda *alarm: self.statsAlarm.emit(alarm))
+        self.bridge = sample_bridge.SampleBridge(self.dataBatch.emit)
+        # History of the run at several resolutions, saved next to the data file
+        self.pyramid = history_pyramid.HistoryPyramid(path=history_pyramid.pyramid_path(self.acq.filename))
+        self.acq.sinks.append(self.stats)
+        self.acq.sinks.append(self.pyramid)
+        self.acq.sinks.append(self.bridge)
+
+        # Catalog of the runs (see run_catalog.py), the voltages of the ramps are recorded too
+        self.recorder = None
+        if catalog:
+            self.recorder = run_catalog.RunRecorder(self.acq)
+            self.acq.sinks.append(self.recorder)
+
+        # Samples for the local programs (see sample_bus.py)
+        self.bus = None
+        if bus is not None:
+            self.bus = sample_bus.SampleBus(sample_bus.bus_name(bus,self.acq.station))
+            self.acq.sinks.append(self.bus)
+            print("Publishing samples on the shared memory",self.bus.name)
+
+        # Safety interlock, first sink so that the rules are checked before anything else
+        self.interlock = None
+        if self.acq.currents:
+            self.interlock = interlock.Interlock(self.acq)
+            self.interlock.listeners.append(self.interlockTrip.emit)
+            self.acq.sinks.insert(0,self.interlock)
+            self.interlock.start()
+
+        # Speed profiles of the Keithleys (see smu_profiles.py)
+        if self.acq.currents:
+            smu_profiles.apply_profiles(self.acq)
+
+        # Readings of the Keithleys on a fixed grid (see smu_scheduler.py)
+        self.smu_scheduler = None
+        if self.acq.currents and smu_period > 0:
+            self.smu_scheduler = smu_scheduler.SmuScheduler(self.acq,smu_period)
+            if self.interlock is not None: # the currents are checked at every tick
+                self.smu_scheduler.sinks.append(self.interlock.check_currents)
+            self.smu_scheduler.start()
+
+        # Reconnection of the Keithleys that fail (see supervisor.py)
+        self.supervisor = None
+        if self.acq.currents:
+            self.supervisor = supervisor.SmuSupervisor(self.acq)
+            self.supervisor.start()
+
+        # OpenMetrics endpoint (see metrics_exporter.py)
+        if exporter is not None:
+            self.acq.sinks.append(exporter.add(self.acq,self.smu_scheduler))
 
-        # Data file path
-        directory = "/home/labb2/ardu_dew_point/data/" # directory name << CHANGE WHEN NEEDED
-        actual_time = f"{datetime.now()}"
-        wrd = actual_time.split()
-        wrd2 = wrd[1].split(":")
-        wrd1 = wrd[0].split("-")
-        dat = "".join(wrd1)
-        tim = "".join(wrd2[:-1])
-        ff = "-".join([dat,tim])
-        file = "time-and-dew-point-{0}.dat".format(ff)
-        self.filename = directory+file # file name << CHANGE WHEN NEEDED
-        self.output_data_file = open(self.filename,"w")
-
-        # Initialization of the serial port for communication with Arduino
-        self.Arduino = serial.Serial("/dev/ttyUSB0",115200, timeout=0.01) # open the serial port << CHANGE WHEN NEEDED
-
-        # INSERT THE CORRECT LINKS FOR THE KEITHLEYS
-        # Initialization of the Keithleys for current measuring
-        # self.keithley1 = kit.Keithley2450("TCPIP0::169.254.91.1::inst0::INSTR")
-        # self.keithley2 = kit.Keithley2450("TCPIP0::169.254.91.2::inst0::INSTR")
-        # self.keithley3 = kit.Keithley2450("TCPIP0::169.254.91.3::inst0::INSTR")
-        self.rm,self.keithley1,self.keithley2,self.keithley3 = self.configure_keithleys()
-
-        # self.keithley1 = self.rm.open_resource("TCPIP0::169.254.91.1::inst0::INSTR")
-        # self.keithley2 = self.rm.open_resource("TCPIP0::169.254.91.2::inst0::INSTR")
-        # self.keithley3 = self.rm.open_resource("TCPIP0::169.254.91.3::inst0::INSTR")
-
+    def run(self):  # also a required QThread function, the working part
+        try:
+            if self.engine == "asyncio":
+                asyncio.run(async_acquisition.AsyncAcquisition(self.acq).run())
+            else:
+                self.acq.run()
+        except Exception: # the serial and VISA errors are recovered, report anything else
+            print("Acquisition stopped by an unexpected error:")
+            traceback.print_exc()
+        finally:
+            self.pyramid.close()
+            if self.bus is not None:
+                self.bus.close()
 
-        # IF THE CURRENTS' PART DOESN'T WORK: TRY WITH THE COMMANDS OF THE RAMP UP
+    def stop(self):
+        """Method to safely stop the thread"""
+        # Set the thread managing flag to False, the data file is closed at the end of run
+        self.acq.stop()
+        if self.smu_scheduler is not None:
+            self.smu_scheduler.stop()
+        if self.supervisor is not None:
+            self.supervisor.stop()
+        if self.interlock is not None:
+            self.interlock.close()
 
-        time.sleep(2) # wait 2 seconds
 
+class RemoteData(QtCore.QObject):
+    """
+    Subclass of QtCore.QObject used instead of GetData when the acquisition
+    runs in another process: a headless_monitor.py the GUI is attached to,
+    or the child of --split (see station_control.py). It reads the samples
+    streamed on TCP by the monitor, or published on its shared memory
+    (see sample_bus.py). Instruments and data file are owned by the
+    monitor, the commands are sent to it through control if given.
 
-    def __del__(self):  # part of the standard format of a QThread
-        self.wait()
+    Parameters:
+    - host (str): default = None, host of the headless monitor (TCP stream);
+    - port (int): default = None, port of the headless monitor;
+    - bus (str): default = None, name of the shared memory of the samples,
+    instead of the TCP stream;
+    - control (station_control.ControlClient): default = None, commands of
+    the station, if None the instruments are not controlled by the GUI;
+    - process (subprocess.Popen): default = None, the monitor started by
+    the GUI (--split), stopped by stop_monitor();
+    """
+    dataBatch = pyqtSignal(object)
+    statsAlarm = pyqtSignal(object)
+    interlockTrip = pyqtSignal(object)
+    # Status of the station (see station_control.StationControl), every STATUS_PERIOD
+    remoteStatus = pyqtSignal(object)
 
-    def run(self):  # also a required QThread function, the working part
-        starttime = time.time() # starting time
-        self.active = True # flag for exit procedure management
-        self.currents = True # flag for currents measuring management
-        last_ihv = 0
-        last_ipwell = 0
-        last_ipsub = 0
-        while self.active:
+    def __init__(self, host=None, port=None, *args, bus=None, control=None, process=None, **kwargs):
+        QtCore.QObject.__init__(self, *args, **kwargs)
+        self.acq = None
+        self.interlock = None # owned by the headless monitor, a RemoteInterlock if controlled
+        self.smu_scheduler = None
+        self.supervisor = None
+        self.recorder = None # the headless monitor catalogs its runs
+        self.control = control
+        self.process = process
+        self.status = {}
+        # The headless monitor saves its own pyramid, this one is deleted at exit
+        self.pyramid_dir = tempfile.TemporaryDirectory(prefix="pyramid-")
+        self.pyramid = history_pyramid.HistoryPyramid(path=self.pyramid_dir.name)
+        self.stats = channel_stats.ChannelStats(drift_limits=channel_stats.DRIFT_LIMITS)
+        self.stats.listeners.append(lambda *alarm: self.statsAlarm.emit(alarm))
+        self.bridge = sample_bridge.SampleBridge(self.dataBatch.emit)
+        self.bus_name = bus
+        self.reader = None
+        self.sock = None
+        self.address = None if host is None else (host,port)
+        if host is not None:
+            self.sock = socket.create_connection((host,port))
+            self.sock.settimeout(0.5)
+
+    def connect_bus(self,timeout=120):
+        """Waits for the shared memory of the monitor (it is created once the instruments are open)"""
+        deadline = time.monotonic()+timeout
+        while self.active and time.monotonic() < deadline:
+            if self.process is not None and self.process.poll() is not None:
+                print("The acquisition process exited with code",self.process.returncode)
+                return False
             try:
-
-                if self.Arduino.inWaiting() > 0: # Do not do anything if there are no characters to read
-                    while True:
-                        data = self.Arduino.readline().decode() # read data and decode
-                        # print(repr(data))
-                        if not data:
-                            break
-                        words = data.split()
-
-                        if words[0] == "inizio:" and len(words) == 8: # CHANGE accordingly to Arduino code!!!
-                            # Extract the data
-                            ddpp = float(words[1]) # dew point
-                            ttchip = float(words[2]) # T_NTC
-                            ttcold = float(words[3]) # T_cold side
-                            tthot = float(words[4]) # T_hot side
-                            delta_hc = abs(float(words[5])) # T_hot - T_cold
-                            delta_cc = float(words[6]) # T_NTC - T_cold
-                            delta_dc = float(words[7]) # T_cold - dew point
-                            delta_ch = ttchip-tthot # T_NTC - T_hot
-                            delta_dh = tthot-ddpp #T_hot - dew point
-
-                            tt = time.time()-starttime # extract the time
-
-                            # self.data structure: time,dew point,T_NTC,T_Cold,T_hot,Delta_ColdNTC,Delta_DpNTC,Delta_NTCHot,Delta_DpHot,I_HV,I_pwell,I_psub
-
-                            # self.data_set[0].append(tt)
-                            # self.data_set[1].append(ddpp)
-                            # self.data_set[2].append(ttchip)
-                            # self.data_set[3].append(ttcold)
-                            # self.data_set[4].append(tthot)
-                            # self.data_set[5].append(delta_hc)
-                            # self.data_set[6].append(delta_cc)
-                            # self.data_set[7].append(delta_dc)
-                            # self.data_set[8].append(delta_ch)
-                            # self.data_set[9].append(delta_dh)
-
-                            # Currents' part managed by the currents flag
-                            if self.currents:
-                                i_hv = self.measure_current(self.keithley3)*1000000 # I_HV converted in uA
-                                i_pwell = self.measure_current(self.keithley2)*1000 # I_pwell converted in mA
-                                i_psub = self.measure_current(self.keithley1)*1000 # I_psub converted in mA
-
-                                last_ipwell = i_pwell
-                                last_ipsub = i_psub
-                                last_ihv = i_hv
-                                # self.data_set[10].append(i_hv)
-                                # self.data_set[11].append(i_pwell)
-                                # self.data_set[12].append(i_psub)
-                            else:
-                                i_hv = last_ihv
-                                i_pwell = last_ipwell
-                                i_psub = last_ipsub
-                            # Signal with the new data
-                            self.dataChanged.emit(tt,ddpp,ttchip,ttcold,tthot,delta_hc,delta_cc,delta_dc,delta_ch,delta_dh,i_hv,i_pwell,i_psub)
-            except Empty:
-                print("Empty")
-                continue
-
-    def measure_current(self,inst):
-        inst.write("smu.measure.read()") # saving without append, it overwrites old values
-        inst.write("print(smu.measure.read())")
-        response = inst.read()
-        response = float(response)
-        return response
-
-    def configure_keithleys(self):
-        rm = visa.ResourceManager()
-        keithley1 = rm.open_resource("TCPIP0::169.254.91.1::inst0::INSTR")
-        keithley2 = rm.open_resource("TCPIP0::169.254.91.2::inst0::INSTR")
-        keithley3 = rm.open_resource("TCPIP0::169.254.91.3::inst0::INSTR")
-
-        keithley2.write("smu.source.func = smu.FUNC_DC_VOLTAGE") # Source function --> voltage
-        keithley2.write("smu.source.range = 2.000000e+01")
-        keithley2.write("smu.source.autorange = smu.OFF")
-        keithley2.write("smu.measure.range = 1.000000e-02")
-        keithley2.write("smu.measure.autorange = smu.OFF")
-        keithley2.write("smu.source.ilimit.level = 3.000000e-03")
-        keithley2.write("smu.source.autodelay = smu.OFF")
-        keithley2.write("smu.source.protect.level = smu.PROTECT_20V")
-        keithley2.write("smu.source.readback = smu.ON")
-        keithley2.write("smu.measure.func = smu.FUNC_DC_CURRENT") # Measure function --> current
-
-        keithley1.write("smu.source.func = smu.FUNC_DC_VOLTAGE") # Source function --> voltage
-        keithley1.write("smu.source.range = 2.000000e+01")
-        keithley1.write("smu.source.autorange = smu.OFF")
-        keithley1.write("smu.measure.range = 1.000000e-02")
-        keithley1.write("smu.measure.autorange = smu.OFF")
-        keithley1.write("smu.source.ilimit.level = 3.000000e-03")
-        keithley1.write("smu.source.autodelay = smu.OFF")
-        keithley1.write("smu.source.protect.level = smu.PROTECT_20V")
-        keithley1.write("smu.source.readback = smu.ON")
-        keithley1.write("smu.measure.func = smu.FUNC_DC_CURRENT") # Measure function --> current
-
-        keithley3.write("smu.source.func = smu.FUNC_DC_VOLTAGE") # Source function --> voltage
-        keithley3.write("smu.source.range = 2.000000e+02")
-        keithley3.write("smu.source.autorange = smu.OFF")
-        keithley3.write("smu.measure.range = 1.000000e-03")
-        keithley3.write("smu.measure.autorange = smu.OFF")
-        keithley3.write("smu.source.ilimit.level = 3.000000e-04")
-        keithley3.write("smu.source.autodelay = smu.OFF")
-        keithley3.write("smu.source.protect.level = smu.PROTECT_40V")
-        keithley3.write("smu.source.readback = smu.ON")
-        keithley3.write("smu.measure.func = smu.FUNC_DC_CURRENT") # Measure function --> current
-
-        return rm,keithley1,keithley2,keithley3
-
+                self.reader = sample_bus.BusReader(self.bus_name)
+                return True
+            except (FileNotFoundError,ValueError): # not created yet
+                time.sleep(0.5)
+        print("No samples published on",self.bus_name)
+        return False
+
+    def poll_status(self):
+        """Asks the status of the station, a trip of its interlock is signaled"""
+        try:
+            status = self.control.call("status",timeout=2)
+        except Exception as err: # the monitor is busy or gone, the samples still arrive
+            self.status = dict(self.status,error=str(err) or repr(err))
+            if self.process is not None and self.process.poll() is not None:
+                self.status["error"] = f"acquisition process exited with code {self.process.returncode}"
+            self.remoteStatus.emit(self.status)
+            return
+        if status["interlock"] is None:
+            self.interlock = None
+        else:
+            if self.interlock is None:
+                self.interlock = station_control.RemoteInterlock(self.control)
+            report = self.interlock.update(status["interlock"])
+            if report is not None:
+                self.interlockTrip.emit(report)
+        self.status = status
+        self.remoteStatus.emit(status)
+
+    def status_text(self):
+        """Status of the monitor for the status bar"""
+        status = self.status
+        if "error" in status:
+            return "monitor: "+status["error"]
+        if not status:
+            return "monitor: starting"
+        text = f"monitor pid {status['pid']}: {status['samples']} samples, malformed frames: {status['malformed']}"
+        if status["links_down"]:
+            text += ", "+", ".join(status["links_down"])
+        if status["scheduler"]:
+            text += ", "+status["scheduler"]
+        return text
+
+    def read_stream(self,buffer):
+        """Reads the TCP stream, it returns (batch or None, rest of the buffer), or None if closed"""
+        try:
+            chunk = self.sock.recv(65536)
+        except socket.timeout:
+            return None,buffer
+        if not chunk:
+            return None
+        buffer += chunk
+        *lines,buffer = buffer.split(b"\n")
+        rows = []
+        for line in lines:
+            words = line.split()
+            if len(words) == len(channels.SCHEMA.names):
+                rows.append([float(w) for w in words])
+        return (channels.SCHEMA.from_rows(rows) if rows else None),buffer
+
+    def run(self):
+        self.active = True
+        buffer = b""
+        next_status = 0.
+        if self.bus_name is None or self.connect_bus():
+            while self.active:
+                if self.control is not None and time.monotonic() >= next_status:
+                    next_status = time.monotonic()+station_control.STATUS_PERIOD
+                    self.poll_status()
+                if self.reader is not None:
+                    batch = self.reader.wait_new(timeout=0.2)
+                else:
+                    result = self.read_stream(buffer)
+                    if result is None:
+                        print("Headless monitor closed the connection")
+                        break
+                    batch,buffer = result
+                if batch is not None and len(batch):
+                    self.stats(batch)
+                    self.pyramid(batch)
+                    self.bridge(batch)
+                self.pyramid.flush()
+                self.bridge.flush()
+        self.pyramid.close()
+        if self.reader is not None:
+            self.reader.close()
+        if self.sock is not None:
+            self.sock.close()
 
     def stop(self):
-        """Method to safely stop the thread"""
-        # Set the thread managing flag to False
         self.active = False
-        # Close the output data file
-        self.output_data_file.close()
+
+    def stop_monitor(self,timeout=30):
+        """Stops the monitor started by the GUI and waits for it to close its data file"""
+        try:
+            self.control.call("stop")
+            self.process.wait(timeout)
+        except Exception as err: # not answering: it is left running
+            print(f"The acquisition process (pid {self.process.pid}) was not stopped: {err}")
 
 class MplCanvas(FigureCanvas):
     """
@@ -207,6 +337,10 @@ class MplCanvas(FigureCanvas):
     It has been optimized to work with more than 1 subplot but the class itself
     should work fine with just one of them.
 
+    The figures are rendered by a figure_renderer.FigureRenderer and the
+    canvas paints the last image (set_frame); its own figure is not drawn,
+    its axes only follow the layout of the image for the toolbar.
+
     Parameters:
     - subs (int): default = 1, it is the number of subplots in the vertical diretion;
     - tit (str or list of str): default = None, it is the title or the list of
@@ -232,22 +366,147 @@ class MplCanvas(FigureCanvas):
             self.axes.set_title(tit)
             self.axes.set_xlabel(xlab)
             self.axes.set_ylabel(ylab)
-        # Preparing the lists with the infos about the plotted data and graphical charachteristics
+        # Preparing the lists with the infos about the plotted data (names of the channels, see channels.py) and graphical charachteristics
         self.data_indx = [[] for i in range(subs)]
         self.line_colors = [[] for i in range(subs)]
         self.line_labels = [[] for i in range(subs)]
+        # Time span chosen with the toolbar (None: last points)
+        self.span = None
+        # Last rendered image, and callable called when the canvas is resized (e.g. to render it again)
+        self.frame = None
+        self.frame_bytes = None
+        self.on_resize = None
         super().__init__(self.fig)
 
+    def set_frame(self,result):
+        """Shows an image of figure_renderer.render, the axes take its layout and limits"""
+        self.frame_bytes = result["image"] # the QImage does not copy the buffer
+        self.frame = QtGui.QImage(self.frame_bytes,result["width"],result["height"],QtGui.QImage.Format_RGBA8888)
+        self.frame.setDevicePixelRatio(self.device_pixel_ratio)
+        if getattr(self.toolbar,"xlims",None) is not None:
+            self.update() # zoom or pan in progress on the axes
+            return
+        for ax,(position,xlim,ylim) in zip(np.atleast_1d(self.axes),result["layout"]):
+            ax.set_position(position)
+            ax.set_xlim(xlim)
+            ax.set_ylim(ylim)
+        self.update()
+
+    def draw(self):
+        """Only repaints the last image (e.g. the toolbar while zooming)"""
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        try:
+            painter.eraseRect(event.rect())
+            if self.frame is not None:
+                painter.drawImage(QtCore.QPoint(0,0),self.frame)
+            self._draw_rect_callback(painter) # zoom rectangle of the toolbar
+        finally:
+            painter.end()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self.on_resize is not None:
+            self.on_resize()
+
+
+class HistoryToolbar(NavigationToolbar):
+    """
+    Navigation toolbar of a MplCanvas. Zooming or panning sets the time span
+    of the canvas, which is then drawn from the history pyramid at the
+    right resolution; Home goes back to the last points.
+
+    Parameters:
+    - canvas (MplCanvas): the canvas;
+    - parent (QWidget): parent widget;
+    - on_span (callable): default = None, called when the span changes (e.g. to redraw);
+    """
+
+    def __init__(self, canvas, parent, on_span=None):
+        super().__init__(canvas, parent)
+        self.on_span = on_span
+        self.xlims = None
+
+    def press_zoom(self, event):
+        self.xlims = [ax.get_xlim() for ax in np.atleast_1d(self.canvas.axes)]
+        super().press_zoom(event)
+
+    def press_pan(self, event):
+        self.xlims = [ax.get_xlim() for ax in np.atleast_1d(self.canvas.axes)]
+        super().press_pan(event)
+
+    def release_zoom(self, event):
+        super().release_zoom(event)
+        self.store_span()
+
+    def release_pan(self, event):
+        super().release_pan(event)
+        self.store_span()
+
+    def save_figure(self, *args):
+        """Saves the image shown (the figure of the canvas is not drawn)"""
+        if self.canvas.frame is None:
+            return
+        fname,_ = QtWidgets.QFileDialog.getSaveFileName(self.canvas.parent(),"Save the figure","figure.png","Images (*.png *.jpg)")
+        if fname:
+            self.canvas.frame.save(fname)
+
+    def home(self, *args):
+        super().home(*args)
+        self.canvas.span = None
+        if self.on_span is not None:
+            self.on_span()
+
+    def store_span(self):
+        """Takes the span of the axis whose limits have been changed"""
+        if self.xlims is None:
+            return
+        for ax,xlim in zip(np.atleast_1d(self.canvas.axes),self.xlims):
+            if ax.get_xlim() != xlim:
+                self.canvas.span = ax.get_xlim()
+                if self.on_span is not None:
+                    self.on_span()
+                break
+        self.xlims = None
+
 
 class MainWindow(QtWidgets.QMainWindow):
     """
     A subclass of QtWidgets.QMainWindow, it is where the GUI is implemented.
+
+    Parameters:
+    - attach (tuple): default = None, (host,port) of a running headless_monitor.py;
+    if given the GUI only shows its data and the instruments are not controlled.
+    - remote (RemoteData): default = None, receiver of a monitor in another
+    process (e.g. --split), instead of attach; the instruments are
+    controlled if it has a control client.
+    - station (stations.Station): default = None, station shown by the window;
+    - receiver (GetData): default = None, receiver of a station acquired by
+    StationsWindow; if given the window does not start its own thread.
+    - engine (str): default = "threads", acquisition engine of GetData;
+    - binary (bool): default = False, the Arduino sends binary frames;
+    - bus, exporter, catalog: default = None, None, True, see GetData;
     """
-    def __init__(self, *args, **kwargs):
+    # Results of the benchmark of the speed profiles, from its thread
+    benchmarkDone = pyqtSignal(object)
+    # (index of the plot, image) rendered by the worker of the plots
+    frameRendered = pyqtSignal(object)
+    # State of each Keithley after a reconnection, from its thread
+    reconnectDone = pyqtSignal(object)
+    # (message, voltages set or None) at the end of the ramps, from their thread
+    rampDone = pyqtSignal(object)
+    # Sampler of the stacks at the end of a capture, from its thread
+    profileDone = pyqtSignal(object)
+
+    def __init__(self, *args, attach=None, remote=None, station=None, receiver=None, engine="threads", binary=False, bus=None, exporter=None, catalog=True, **kwargs):
         super().__init__(*args, **kwargs)
 
         # Window and Tabs configuration
         self.setWindowTitle("C & T monitor")
+        if station is not None and station.name is not None:
+            self.setWindowTitle("C & T monitor - "+station.name)
 
         tabs = QTabWidget()
 
@@ -301,23 +560,23 @@ class MainWindow(QtWidgets.QMainWindow):
         # Configuration of the plots
         labs_temp = [["Temperatures","Temperature Deltas","Temperature Deltas"],["T [*C]","Delta T [*C]","Delta T [*C]"],["Time [s]","Time [s]","Time [s]"]]
         self.temp_plot = MplCanvas(self,tit=labs_temp[0],ylab=labs_temp[1],xlab=labs_temp[2],subs=3)
-        self.toolbar_temp = NavigationToolbar(self.temp_plot, self)
-        self.temp_plot.data_indx[0].append(1)
-        self.temp_plot.data_indx[0].append(2)
-        self.temp_plot.data_indx[0].append(3)
-        self.temp_plot.data_indx[0].append(4)
+        self.toolbar_temp = HistoryToolbar(self.temp_plot, self, on_span=self.draw_plots)
+        self.temp_plot.data_indx[0].append("dew_point")
+        self.temp_plot.data_indx[0].append("T_NTC")
+        self.temp_plot.data_indx[0].append("T_cold")
+        self.temp_plot.data_indx[0].append("T_hot")
         self.temp_plot.line_colors[0].append("r")
         self.temp_plot.line_colors[0].append("b")
         self.temp_plot.line_colors[0].append("cyan")
         self.temp_plot.line_colors[0].append("green")
         self.temp_plot.line_labels[0] = ["Dew point","T_NTC chip","T_cold side Peltier","T_hot  side Peltier"]
 
-        self.temp_plot.data_indx[1].append(7)
+        self.temp_plot.data_indx[1].append("dT_cold_dp")
         self.temp_plot.line_colors[1].append("r")
         self.temp_plot.line_labels[1] = ["T_cold-Dew point"]
 
-        self.temp_plot.data_indx[2].append(5)
-        self.temp_plot.data_indx[2].append(6)
+        self.temp_plot.data_indx[2].append("dT_hot_cold")
+        self.temp_plot.data_indx[2].append("dT_NTC_cold")
         self.temp_plot.line_colors[2].append("r")
         self.temp_plot.line_colors[2].append("b")
         self.temp_plot.line_labels[2] = ["|T_hot-T_cold|","T_NTC-T_cold"]
@@ -363,21 +622,21 @@ class MainWindow(QtWidgets.QMainWindow):
         layout_meass = QHBoxLayout()
 
         # Configuration of the plots
-        labs_currs = [["I_HV","I_DC"],["I [uA]","I [mA]"],["Time [s]","Time [s]"]]
+        labs_currs = [["I_HV","I_DC"],["I [%s]" % channels.SCHEMA.unit("I_HV"),"I [%s]" % channels.SCHEMA.unit("I_pwell")],["Time [s]","Time [s]"]]
         self.curr_plot = MplCanvas(self,tit=labs_currs[0],ylab=labs_currs[1],xlab=labs_currs[2],subs=2)
-        self.curr_plot.data_indx[0].append(10)
+        self.curr_plot.data_indx[0].append("I_HV")
         self.curr_plot.line_colors[0].append("r")
         self.curr_plot.line_labels[0] = ["I_HV"]
 
-        self.curr_plot.data_indx[1].append(11)
-        self.curr_plot.data_indx[1].append(12)
+        self.curr_plot.data_indx[1].append("I_pwell")
+        self.curr_plot.data_indx[1].append("I_psub")
         self.curr_plot.line_colors[1].append("green")
         self.curr_plot.line_colors[1].append("b")
         self.curr_plot.line_labels[1] = ["I_pwell","I_psub"]
         self.curr_plot.fig.tight_layout()
 
-        # Stop Acquisition Button configuration
-        self.stop_cur = QPushButton("Stop Acquisition")
+        # Pause Acquisition Button configuration
+        self.stop_cur = QPushButton("Pause Acquisition")
         self.stop_cur.setCheckable(False)
         self.stop_cur.clicked.connect(self.stop_acq)
         self.stop_cur.setMaximumSize(300,70)
@@ -385,6 +644,14 @@ class MainWindow(QtWidgets.QMainWindow):
         font_cur.setPointSize(20)
         self.stop_cur.setFont(font_cur)
 
+        # Reconnect Keithleys Button configuration
+        self.reconnect_button = QPushButton("Reconnect Keithleys")
+        self.reconnect_button.clicked.connect(self.reconnect)
+        self.reconnect_button.setMaximumSize(300,70)
+        self.reconnect_button.setFont(font_cur)
+        self.reconnectDone.connect(self.onReconnectDone)
+        self.smu_state = "" # result of the last reconnection, shown in the status bar
+
         # Stopped acquisition warning configuration
         self.warning_currs = QLabel(" If the values are red they are not updated. ")
         font_war = self.warning_currs.font()
@@ -406,18 +673,96 @@ class MainWindow(QtWidgets.QMainWindow):
         font_psub.setPointSize(30)
         self.last_Ipsub.setFont(font_psub)
 
+        # Rolling statistics widgets configuration (see channel_stats.py)
+        self.stats_labels = {}
+        for name in ["I_HV","I_pwell","I_psub"]:
+            self.stats_labels[name] = QLabel(" mean = --, std = --\n min/max = --\n slope = --, EWMA = -- ")
+            font_stats = self.stats_labels[name].font()
+            font_stats.setPointSize(12)
+            self.stats_labels[name].setFont(font_stats)
+
+        self.stats_label = QLabel(" Statistics window (points): ")
+        font_swin = self.stats_label.font()
+        font_swin.setPointSize(15)
+        self.stats_label.setFont(font_swin)
+
+        self.stats_window = QSpinBox()
+        self.stats_window.setMinimum(2)
+        self.stats_window.setMaximum(10000)
+        self.stats_window.setSingleStep(10)
+        self.stats_window.setValue(100)
+        self.stats_window.valueChanged.connect(self.stats_window_changed)
+        self.stats_window.setFont(font_swin)
+
+        # Last alarm of the rolling statistics, shown in the status bar,
+        # and time of the last alarm of each current
+        self.last_alarm = ""
+        self.alarm_times = {}
+
         # Layout(s) construction
-        layout_meass.addWidget(self.last_IHV)
-        layout_meass.addWidget(self.last_Ipwell)
-        layout_meass.addWidget(self.last_Ipsub)
+        for label,name in [(self.last_IHV,"I_HV"),(self.last_Ipwell,"I_pwell"),(self.last_Ipsub,"I_psub")]:
+            layout_value = QVBoxLayout()
+            layout_value.addWidget(label)
+            layout_value.addWidget(self.stats_labels[name])
+            layout_meass.addLayout(layout_value)
+
+        # Safety interlock widgets configuration (see interlock.py)
+        self.interlock_label = QLabel(" Interlock: armed ")
+        font_il = self.interlock_label.font()
+        font_il.setPointSize(15)
+        self.interlock_label.setFont(font_il)
+        self.interlock_label.setWordWrap(True)
+
+        self.interlock_reset = QPushButton("Reset Interlock")
+        self.interlock_reset.clicked.connect(self.reset_interlock)
+        self.interlock_reset.setEnabled(False)
+        self.interlock_reset.setFont(font_il)
+
+        layout_interlock = QHBoxLayout()
+        layout_interlock.addWidget(self.interlock_label)
+        layout_interlock.addWidget(self.interlock_reset)
 
         layout_stop_curs = QHBoxLayout()
         layout_stop_curs.addWidget(self.stop_cur)
+        layout_stop_curs.addWidget(self.reconnect_button)
+        layout_stop_curs.addWidget(self.stats_label)
+        layout_stop_curs.addWidget(self.stats_window)
         layout_stop_curs.addWidget(self.warning_currs)
         layout_currs.addLayout(layout_stop_curs)
+        layout_currs.addLayout(layout_interlock)
+
+        # Speed profiles widgets configuration (see smu_profiles.py)
+        layout_profiles = QHBoxLayout()
+        self.profile_label = QLabel(" Speed profiles: ")
+        font_prof = self.profile_label.font()
+        font_prof.setPointSize(15)
+        self.profile_label.setFont(font_prof)
+        layout_profiles.addWidget(self.profile_label)
+        self.profile_sel = {}
+        for role in channels.SMU_ROLES:
+            lab = QLabel(" %s " % role)
+            lab.setFont(font_prof)
+            self.profile_sel[role] = QComboBox()
+            self.profile_sel[role].addItems(list(smu_profiles.PROFILES))
+            self.profile_sel[role].setFont(font_prof)
+            layout_profiles.addWidget(lab)
+            layout_profiles.addWidget(self.profile_sel[role])
+
+        self.benchmark_button = QPushButton("Benchmark Profiles")
+        self.benchmark_button.clicked.connect(self.start_benchmark)
+        self.benchmark_button.setFont(font_prof)
+        layout_profiles.addWidget(self.benchmark_button)
+        layout_currs.addLayout(layout_profiles)
+
+        self.benchmark_results = QLabel("")
+        font_bench = self.benchmark_results.font()
+        font_bench.setFamily("Monospace")
+        font_bench.setPointSize(11)
+        self.benchmark_results.setFont(font_bench)
+        layout_currs.addWidget(self.benchmark_results)
         layout_currs.addLayout(layout_meass)
 
-        self.toolbar_currs = NavigationToolbar(self.curr_plot, self)
+        self.toolbar_currs = HistoryToolbar(self.curr_plot, self, on_span=self.draw_plots)
         self.curr_plot.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
 
         layout_currs.addWidget(self.toolbar_currs)
@@ -434,6 +779,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.start_ramp = QPushButton("Start Ramp")
         self.start_ramp.setCheckable(False)
         self.start_ramp.clicked.connect(self.start_ramps)
+        self.rampDone.connect(self.onRampDone)
+        self.ramp_thread = None
         self.start_ramp.setMaximumSize(300,70)
         font_ramp = self.start_ramp.font()
         font_ramp.setPointSize(20)
@@ -499,6 +846,8 @@ class MainWindow(QtWidgets.QMainWindow):
         font_ch.setPointSize(30)
         self.chips.setFont(font_ch)
         self.chips.currentIndexChanged.connect(self.chip_changed)
+        if station is not None:
+            self.chips.setCurrentIndex(stations.CHIPS.index(station.chip))
 
         self.lab_step = QLabel(" Step =  ")
         font_step = self.lab_step.font()
@@ -596,27 +945,73 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # Utility lists
         self.plots = [self.temp_plot,self.curr_plot]
+
+        # Rendering of the plots on a worker thread (see figure_renderer.py)
+        self.renderer = figure_renderer.FigureRenderer(lambda key,result: self.frameRendered.emit((key,result)))
+        self.frameRendered.connect(self.onFrameRendered)
+        for pl in self.plots:
+            pl.on_resize = self.draw_plots
         self.labels = [["Temperatures","Time [s]","T [*C]"],["Temperature Deltas","Time [s]","Delta T [*C]"],["Temperature Deltas","Time [s]","Delta T [*C]"],["I_HV","Time [s]","I [uA]"],["I_DC","Time [s]","I [mA]"]]
 
-        # Data list initialization
-        self.data = []
-        self.data_full = []
-        for i in range(13):
-            self.data.append([])
-            self.data_full.append([])
+        # Data initialization: all the samples of the run (the oldest ones
+        # on disk, see history_store.py) and the last ones shown
+        self.data_full = history_store.HistoryStore()
+        self.data = self.data_full.last(0)
+
+        self.setCentralWidget(tabs)
+
+        # Diagnostics: capture of the stacks of all the threads (see stack_sampler.py)
+        self.sampler = None
+        diagnostics = self.menuBar().addMenu("Diagnostics")
+        self.profile_action = diagnostics.addAction("Profile...")
+        self.profile_action.triggered.connect(self.start_profile)
+        self.stop_profile_action = diagnostics.addAction("Stop profiling")
+        self.stop_profile_action.setEnabled(False)
+        self.stop_profile_action.triggered.connect(self.stop_profile)
+        self.profileDone.connect(self.onProfileDone)
+
+        # Station acquired by StationsWindow: no thread of its own
+        if receiver is not None:
+            self.thread = None
+            self.receiver = receiver
+            self.receiver.dataBatch.connect(self.onDataBatch)
+            self.receiver.statsAlarm.connect(self.onStatsAlarm)
+            self.receiver.interlockTrip.connect(self.onInterlockTrip)
+            self.show_interlock()
+            self.show_profiles()
+            return
 
         # Thread initialization
         self.queue = Queue()
         self.thread = QtCore.QThread(self)
-        self.receiver = GetData(self.queue)
+        if attach is not None:
+            remote = RemoteData(*attach)
+        if remote is None:
+            self.receiver = GetData(self.queue, engine=engine, binary=binary, bus=bus, exporter=exporter, catalog=catalog)
+            self.receiver.acq.chip = stations.CHIPS[self.dut]
+        else:
+            self.receiver = remote
+            if remote.process is not None:
+                self.setWindowTitle("C & T monitor (acquisition in process %d)" % remote.process.pid)
+            elif remote.address is not None:
+                self.setWindowTitle("C & T monitor (attached to %s:%d)" % remote.address)
+            if remote.control is None:
+                # The instruments are owned by the headless monitor
+                self.stop_cur.setEnabled(False)
+                self.reconnect_button.setEnabled(False)
+                ramps.setEnabled(False)
+            else:
+                remote.remoteStatus.connect(self.onRemoteStatus)
         self.receiver.moveToThread(self.thread)
         self.thread.started.connect(self.receiver.run)
-        self.receiver.dataChanged.connect(self.onDataChanged)
+        self.receiver.dataBatch.connect(self.onDataBatch)
+        self.receiver.statsAlarm.connect(self.onStatsAlarm)
+        self.receiver.interlockTrip.connect(self.onInterlockTrip)
+        self.show_interlock()
+        self.show_profiles()
 
         self.thread.start()
 
-        self.setCentralWidget(tabs)
-
         self.show()
 
     def closeEvent(self, event):
@@ -625,14 +1020,25 @@ class MainWindow(QtWidgets.QMainWindow):
         We stop the thread by setting the flag to False, quitting the
         thread and waiting for it to actually finish.
         """
+        self.renderer.close()
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.thread is None:
+            return
         print('Closing the application...')
         self.receiver.stop()  # Sets the active flag to False
         self.thread.quit()
         self.thread.wait()
+        if getattr(self.receiver,"process",None) is not None: # --split: the acquisition stops with the GUI
+            self.receiver.stop_monitor()
+        self.data_full.close()
 
     def num_changed(self,i):
         self.N_show = i
 
+    def stats_window_changed(self,i):
+        self.receiver.stats.set_window(i)
+
     def volt_changed(self,i):
         self.HV = i
 
@@ -648,525 +1054,504 @@ class MainWindow(QtWidgets.QMainWindow):
     def delay_changed(self,i):
         self.delay = i
 
+    def show_interlock(self):
+        """Shows the state of the interlock in the Currents tab"""
+        safety = self.receiver.interlock
+        if safety is None:
+            self.interlock_label.setText(" Interlock: not active in this window ")
+            self.interlock_label.setStyleSheet('color: gray')
+        elif safety.tripped:
+            self.interlock_label.setStyleSheet('color: red')
+        else:
+            rules = ", ".join(rule.name for rule in safety.rules)
+            self.interlock_label.setText(" Interlock: armed (%s) " % rules)
+            self.interlock_label.setStyleSheet('color: green')
+        self.interlock_reset.setEnabled(safety is not None and safety.tripped)
+
+    def onInterlockTrip(self,report):
+        """
+        Method called with the Interlock Trip signal of the Thread, when
+        the voltages have been ramped down by the interlock.
+        """
+        text = interlock.format_report(report)
+        self.interlock_label.setText(" "+text+" ")
+        self.lab_status.setText(" Interlock tripped: voltages at 0 V ")
+        self.ramp_HV.setValue(0)
+        self.ramp_pwell.setValue(0)
+        self.ramp_psub.setValue(0)
+        self.show_interlock()
+
+    def show_profiles(self):
+        """Shows the speed profile of each Keithley, the profiles can be changed only if the window owns them"""
+        acq = self.receiver.acq
+        enabled = acq is not None and acq.rm is not None
+        for role,combo in self.profile_sel.items():
+            if enabled and role in acq.profiles:
+                combo.setCurrentText(acq.profiles[role])
+            combo.setEnabled(enabled)
+            combo.currentTextChanged.connect(lambda name,role=role: self.profile_changed(role,name))
+        self.benchmark_button.setEnabled(enabled)
+        self.benchmarkDone.connect(self.onBenchmarkDone)
+
+    def profile_changed(self,role,name):
+        smu_profiles.set_profile(self.receiver.acq,role,name)
+        print(f"Speed profile of {role}: {name}")
+
+    def start_benchmark(self):
+        """
+        Method called when the Benchmark Profiles Button is clicked: the
+        Keithleys are benchmarked one at a time on a thread, each reading of
+        the benchmark is a command of the broker (see smu_profiles.benchmark_role).
+        """
+        self.benchmark_button.setEnabled(False)
+        self.benchmark_results.setText(" Benchmark of the speed profiles... ")
+        acq = self.receiver.acq
+
+        def run():
+            texts = []
+            for role in channels.SMU_ROLES:
+                try:
+                    texts.append(smu_profiles.format_benchmark(role,smu_profiles.benchmark_role(acq,role)))
+                except Exception as err: # VISA errors: report them with the results
+                    texts.append(f"{role}: {err}")
+            self.benchmarkDone.emit("\n".join(texts))
+
+        threading.Thread(target=run,name="benchmark",daemon=True).start()
+
+    def onBenchmarkDone(self,text):
+        print(text)
+        self.benchmark_results.setText(text)
+        self.benchmark_button.setEnabled(True)
+
+    def start_profile(self):
+        """
+        Method called by Diagnostics > Profile: the stacks of all the threads
+        of the process (GUI, acquisition, Keithleys...) are sampled for the
+        duration chosen, or until Diagnostics > Stop profiling.
+        """
+        duration,ok = QtWidgets.QInputDialog.getInt(self,"Profile","Duration of the capture [s]:",stack_sampler.PROFILE_DURATION,1,3600)
+        if not ok:
+            return
+        self.sampler = stack_sampler.StackSampler(on_done=self.profileDone.emit)
+        self.sampler.start(duration)
+        self.profile_action.setEnabled(False)
+        self.stop_profile_action.setEnabled(True)
+        print(f"Profiling for {duration} s")
+
+    def stop_profile(self):
+        self.stop_profile_action.setEnabled(False)
+        self.sampler.stop_event.set() # the capture is written by onProfileDone
+
+    def onProfileDone(self,sampler):
+        """Writes the capture next to the data file (in the temporary directory if attached)"""
+        if self.receiver.acq is not None:
+            path = stack_sampler.profile_file_name(self.receiver.acq.filename)
+        else:
+            path = stack_sampler.profile_file_name(os.path.join(tempfile.gettempdir(),"ctmon.dat"))
+        try:
+            sampler.save(path)
+            print(sampler.summary())
+            print("Profile saved on",path)
+            self.statusBar().showMessage(f"Profile saved on {path}",10000)
+        except OSError as err:
+            print("Profile not saved:",err)
+        self.sampler = None
+        self.profile_action.setEnabled(True)
+        self.stop_profile_action.setEnabled(False)
+
+    def reset_interlock(self):
+        try:
+            self.receiver.interlock.reset()
+        except (OSError,station_control.ControlError) as err: # monitor in another process not answering
+            print("Interlock not reset:",err)
+        self.show_interlock()
+
     def chip_changed(self,i):
         self.dut = i
+        receiver = getattr(self,"receiver",None) # None while the window is built
+        if receiver is not None and receiver.acq is not None:
+            receiver.acq.chip = stations.CHIPS[i]
+        elif receiver is not None and receiver.control is not None:
+            try:
+                receiver.control.call("chip",chip=stations.CHIPS[i])
+            except Exception as err: # monitor not answering
+                print("Chip not sent to the monitor:",err)
 
     def index_changed(self,i):
         """
         Method called when the operating mode is changed.
         We change the temperature plots.
         """
+        # Dew point margin of the interlock
+        if self.receiver.interlock is not None:
+            try:
+                self.receiver.interlock.set_mode("cooling" if i == 0 else "heating")
+            except (OSError,station_control.ControlError) as err: # monitor in another process not answering
+                print("Mode not sent to the interlock:",err)
+
         # Cooling
         if i == 0:
             self.temp_plot.line_labels[0] = ["Dew point","T_NTC chip","T_cold side Peltier","T_hot  side Peltier"]
-            self.temp_plot.data_indx[1][0] = 7
-            self.temp_plot.data_indx[2][1] = 6
+            self.temp_plot.data_indx[1][0] = "dT_cold_dp"
+            self.temp_plot.data_indx[2][1] = "dT_NTC_cold"
 
         # Heating
         elif i == 1:
             self.temp_plot.line_labels[0] = ["Dew point","T_NTC chip","T_hot  side Peltier","T_cold side Peltier"]
-            self.temp_plot.data_indx[1][0] = 9
-            self.temp_plot.data_indx[2][1] = 8
-
-    def ramp_up(self,resource_name,set_voltage,voltage,step,delay,name):
-        """"
-            Ramps the voltage of the pwell source meter either up or down.
-
-        Parameters:
-            resource_name_pwell (str): VISA resource name.
-            resource_name_psub (str): VISA resource name.
-            voltage_pwell (float): Ending pwell voltage.
-            voltage_psub (float): Ending psub voltage.
-            step (float): Step increment for voltage change.
-            delay (float): Delay between each step.
-            name (string): Name of the voltage.
-        """
-        print(f"Ramping {name} up to ", voltage,"V")
-        for volt in np.arange(set_voltage, voltage + step, step):
-            if volt > voltage:
-                break
-            resource_name.write("smu.source.level = "+str(volt))
-            time.sleep(delay)
-            resource_name.write("smu.measure.read()") # saving without append, it overwrites old values
-            resource_name.write("print(smu.measure.read())")
-            response = resource_name.read()
-            response = float(response)*1000 # Convert in mA
-            print(f"Voltage: {volt:.1f} V, current: {response:.2e} mA", end="\r")
-            print()
-            time.sleep(0.1)
-
-    def ramp_down(self,resource_name,set_voltage,voltage,step,delay,name):
-        """"
-            Ramps the voltage of the pwell source meter either up or down.
-
-        Parameters:
-            resource_name_pwell (str): VISA resource name.
-            resource_name_psub (str): VISA resource name.
-            voltage_pwell (float): Ending pwell voltage.
-            voltage_psub (float): Ending psub voltage.
-            step (float): Step increment for voltage change.
-            delay (float): Delay between each step.
-            name (string): Name of the voltage.
-        """
-        print(f"Ramping {name} down to ", voltage,"V")
-        for volt in np.arange(set_voltage, voltage-step, -step):
-            if voltage!=0:
-                if volt < voltage:
-                    break
-            resource_name.write("smu.source.level = "+str(volt))
-            time.sleep(delay)
-            resource_name.write("smu.measure.read()") # saving without append, it overwrites old values
-            resource_name.write("print(smu.measure.read())")
-            response = resource_name.read()
-            response = float(response)*1000 # Convert in mA
-            print(f"Voltage: {volt:.1f} V, current: {response:.2e} mA", end="\r")
-            print()
-            time.sleep(0.1)
-
+            self.temp_plot.data_indx[1][0] = "dT_hot_dp"
+            self.temp_plot.data_indx[2][1] = "dT_NTC_hot"
 
+    def interlock_tripped(self):
+        """True if the interlock has tripped: the ramps must not touch the voltages"""
+        return self.receiver.interlock is not None and self.receiver.interlock.tripped
 
-
-    def ramp_voltage_DC(self,inst_pwell,inst_psub, voltage_pwell, voltage_psub, step, delay,tmp_meas):
+    def start_ramps(self):
         """
-        Ramps the voltage of a source meter either up or down.
-
-        Parameters:
-            resource_name_pwell (str): VISA resource name.
-            resource_name_psub (str): VISA resource name.
-            voltage_pwell (float): Ending pwell voltage.
-            voltage_psub (float): Ending psub voltage.
-            step (float): Step increment for voltage change.
-            delay (float): Delay between each step.
+        Method called when the Start Ramp Button is clicked: the ramps run on
+        a thread through the broker of the Keithleys (see smu_ramps.py), so
+        the currents are still measured and the GUI updated meanwhile.
         """
-        # # Configure the smu for pwell
-        # inst_pwell = conf_smu(resource_name_pwell)
-        #
-        # # Configure the smu for psub
-        # inst_psub = conf_smu(resource_name_psub)
-
-
-        # Safety: if pwell is lower than -6 V (set OVERPROTECTION voltage) or has a positive value it stops the program
-        if voltage_psub < 0.:
-            print("WARNING: provide the absolute value of psub!! ")
-            self.lab_status.setText(" WARNING: provide the absolute value of psub!! ")
-            self.ramp_psub.setValue(int(tmp_meas[2]))
-            self.ramp_pwell.setValue(int(tmp_meas[1]))
-
+        if self.interlock_tripped():
+            print("Interlock tripped: reset it before ramping")
+            self.lab_status.setText(" Interlock tripped: reset it before ramping ")
             return
 
+        self.start_ramp.setEnabled(False)
+        self.lab_status.setText(" Ramping... ")
+        args = (self.HV,self.pwell,self.psub,stations.CHIPS[self.dut],self.step,self.delay)
+        self.ramp_thread = threading.Thread(target=self.run_ramps,args=args,name="ramps",daemon=True)
+        self.ramp_thread.start()
 
-        if voltage_pwell < 0.:
-            print("WARNING: provide the absolute value of pwell!! ")
-            self.lab_status.setText(" WARNING: provide the absolute value of pwell!! ")
-            self.ramp_pwell.setValue(int(tmp_meas[1]))
-            self.ramp_psub.setValue(int(tmp_meas[2]))
-
-            return
-
-
-        if voltage_pwell<6:
-            if voltage_psub !=0:
-                print("WARNING: if pwell is <6 abs(psub-pwell) NEEDS TO be 0! ")
-                self.lab_status.setText(" WARNING: if pwell is <6 abs(psub-pwell) NEEDS TO be 0! ")
-                self.ramp_psub.setValue(int(tmp_meas[2]))
-                self.ramp_pwell.setValue(int(tmp_meas[1]))
-
-                return
-
-        elif voltage_pwell == 6:
-            #["W8R4","W2R17","W8R6"]
-            if self.dut == 0:
-                if voltage_psub > 4:
-                    print("WARNING: abs(psub-pwell) CANNOT be >4 (W8R04)! ")
-                    self.lab_status.setText(" WARNING: abs(psub-pwell) CANNOT be >4 (W8R04)! ")
-                    self.ramp_psub.setValue(int(tmp_meas[2]))
-                    self.ramp_pwell.setValue(int(tmp_meas[1]))
-
-                    return
-
-            elif self.dut == 1:
-                if voltage_psub > 9:
-                    print("WARNING: abs(psub-pwell) CANNOT be >9 (W2R17)! ")
-                    self.lab_status.setText(" WARNING: abs(psub-pwell) CANNOT be >9 (W2R17)! ")
-                    self.ramp_psub.setValue(int(tmp_meas[2]))
-                    self.ramp_pwell.setValue(int(tmp_meas[1]))
-
-                    return
-
-            elif self.dut == 2:
-                if voltage_psub > 14:
-                    print("WARNING: abs(psub-pwell) CANNOT be >14 (W8R6)! ")
-                    self.lab_status.setText(" WARNING: abs(psub-pwell) CANNOT be >14 (W8R6)! ")
-                    self.ramp_psub.setValue(int(tmp_meas[2]))
-                    self.ramp_pwell.setValue(int(tmp_meas[1]))
-
-                    return
-
-        elif voltage_pwell > 6:
-            print("WARNING: pwell CANNOT be >6!! ")
-            self.lab_status.setText(" WARNING: pwell CANNOT be >6!! ")
-            self.ramp_pwell.setValue(int(tmp_meas[1]))
-            self.ramp_psub.setValue(int(tmp_meas[2]))
-            return
-
-
-
-        # Change sign to the voltage values
-        voltage_pwell = - voltage_pwell
-        voltage_psub = - voltage_psub
-
-        pwell_name = "pwell"
-        psub_name = "psub"
-        # Create buffer for saving data in smu
-        # inst.write("testDatabuffer = buffer.make(20000)")
-
-        # Check set voltage before ramping up/down
-        inst_pwell.write("voltage_set = smu.source.level")
-        inst_pwell.write("print(voltage_set)")
-        responsev_pwell = inst_pwell.read()
-
-        print("Current pwell voltage set:", responsev_pwell,"V")
-        set_voltage_pwell = float(responsev_pwell)
-
-        inst_psub.write("voltage_set = smu.source.level")
-        inst_psub.write("print(voltage_set)")
-        responsev_psub = inst_psub.read()
-
-        print("Current psub voltage set:", responsev_psub,"V")
-        set_voltage_psub = float(responsev_psub)
-
-
-        # # Do nothing if the voltage is already set at given value
-        # if set_voltage_pwell == voltage_pwell:
-        #     print("pwell Voltage is already set to ",voltage_pwell, " V")
-        #     sys.exit(0)
-
-        # Check if the HV is higher or lower than the set value and the ramp up or down. For each step of ramp up/down it prints set voltage and measured current
-        if set_voltage_pwell > voltage_pwell:
-            self.ramp_down(inst_pwell,set_voltage_pwell,voltage_pwell,step,delay,pwell_name)
-            time.sleep(0.2)
-            print(" ")
-            self.ramp_down(inst_psub,set_voltage_psub,voltage_psub,step,delay,psub_name)
-
-        elif set_voltage_pwell < voltage_pwell:
-            self.ramp_up(inst_psub,set_voltage_psub,voltage_psub,step,delay,psub_name)
-            time.sleep(0.2)
-            print(" ")
-
-            self.ramp_up(inst_pwell,set_voltage_pwell,voltage_pwell,step,delay,pwell_name)
-
+    def run_ramps(self,hv,pwell,psub,chip,step,delay):
+        """Thread of the ramps (executed by the monitor if it is another process), the result is sent to onRampDone"""
+        if self.receiver.acq is None:
+            try:
+                message,levels = self.receiver.control.call("ramp",timeout=None,hv=hv,pwell=pwell,psub=psub,chip=chip,step=step,delay=delay)
+            except Exception as err: # monitor not answering
+                message,levels = f"Ramp failed: {err}",None
         else:
-            if set_voltage_psub > voltage_psub:
-                self.ramp_down(inst_psub,set_voltage_psub,voltage_psub,step,delay,psub_name)
-
-            else:
-                self.ramp_up(inst_psub,set_voltage_psub,voltage_psub,step,delay,psub_name)
-
-
-
-        print(" ")
-
-        print("Voltage ramp completed.")
-        self.lab_status.setText(" Voltage ramp completed. ")
-        inst_pwell.write("voltage_set = smu.source.level")
-        inst_pwell.write("print(voltage_set)")
-        responsev_pwell_last = inst_pwell.read()
-        responsev_pwell_last = float(responsev_pwell_last)
-
-        inst_pwell.write("smu.measure.read()")
-        inst_pwell.write("print(smu.measure.read())")
-        response_well_last = inst_pwell.read()
-        response_well_last= float(response_well_last)*1000 # Convert in mA
-
-        inst_psub.write("voltage_set = smu.source.level")
-        inst_psub.write("print(voltage_set)")
-        responsev_psub_last = inst_psub.read()
-        responsev_psub_last = float(responsev_psub_last)
-
-        inst_psub.write("smu.measure.read()")
-        inst_psub.write("print(smu.measure.read())")
-        response_sub_last = inst_psub.read()
-        response_sub_last= float(response_sub_last)*1000 # Convert in mA
-
-
-        # inst_psub.write("voltage_set = smu.source.level")
-        # inst_psub.write("print(voltage_set)")
-        # responsev_psub_end = inst_psub.read()
-        print("Current values:")
-        print(f"Pwell: Voltage: {responsev_pwell_last:.1f} V, current: {response_well_last:.2e} mA")
-        print(f"abs(Psub-Pwell): Voltage: {responsev_psub_last:.1f} V, current: {response_sub_last:.2e} mA")
+            message,levels = station_control.run_ramps(self.receiver.acq,self.receiver.interlock,self.receiver.recorder,
+                                                       hv,pwell,psub,chip,step,delay)
+        self.rampDone.emit((message,levels))
 
-    def ramp_voltage_HV(self,inst, end_voltage, step, delay,tmp_meas):
+    def onRampDone(self,result):
         """
-        Ramps the voltage of a source meter either up or down.
-
-        Parameters:
-            resource_name (str): VISA resource name.
-            start_voltage (float): Starting voltage.
-            end_voltage (float): Ending voltage.
-            step (float): Step increment for voltage change.
-            delay (float): Delay between each step.
-            ramp_direction (str): 'up' for ramp up, 'down' for ramp down.
+        Method called with the Ramp Done signal of the thread of the ramps.
+        If the voltages were not allowed the voltages set are shown again.
         """
-        # # Configure the smu
-        # inst = conf_smu(resource_name)
-
-        # Safety: if HV is higher than 40V (set OVERPROTECTION voltage) or has a negative value it stops the program
-        if abs(end_voltage)>30:
-            print("WARNING: the HV set is higher than the Overprotection Voltage set!")
-            self.lab_status.setText(" WARNING: the HV set is higher than the Overprotection Voltage set! ")
-            self.ramp_HV.setValue(int(tmp_meas[0]))
-            return
-
+        message,levels = result
+        print(message)
+        self.lab_status.setText(f" {message.strip()} ")
+        if levels is not None:
+            self.ramp_HV.setValue(int(round(levels[0])))
+            self.ramp_pwell.setValue(int(round(levels[1])))
+            self.ramp_psub.setValue(int(round(levels[2])))
+        self.start_ramp.setEnabled(True)
 
-        if end_voltage < 0.:
-            print("HV cannot be negative!! ")
-            self.lab_status.setText(" HV cannot be negative!! ")
-            self.ramp_HV.setValue(int(tmp_meas[0]))
+    def stop_acq(self):
+        """
+        Method called when the Pause Acquisition Button is clicked: the
+        readings of the Keithleys are suspended or resumed, their sessions
+        stay open (the broken ones are reopened by Reconnect Keithleys).
+        """
+        acq = self.receiver.acq
+        if acq is None: # acquisition in another process
+            command = "pause_currents" if self.receiver.status.get("currents",True) else "resume_currents"
+            try:
+                self.receiver.status["currents"] = self.receiver.control.call(command)
+            except Exception as err: # monitor not answering
+                print("Command not sent to the monitor:",err)
+                return
+            self.show_currents_state(self.receiver.status["currents"])
             return
-
-        # Create buffer for saving data in smu
-        # inst.write("testDatabuffer = buffer.make(20000)")
-
-        # Check set voltage before ramping up/down
-        inst.write("voltage_set = smu.source.level")
-        inst.write("print(voltage_set)")
-        responsev = inst.read()
-        print("Current voltage set:", responsev,"V")
-
-        set_voltage = float(responsev)
-
-        # Do nothing if the voltage is already set at given value
-        if set_voltage == end_voltage:
-            print("Voltage is already set to ",end_voltage)
-
-        # Check if the HV is higher or lower than the set value and the ramp up or down. For each step of ramp up/down it prints set voltage and measured current
-        if set_voltage > end_voltage:
-            print("Ramping down to ", end_voltage,"V")
-            for volt in np.arange(set_voltage, end_voltage-step, -step):
-                if end_voltage!=0:
-                    if volt < end_voltage:
-                        break
-                inst.write("smu.source.level = "+str(volt))
-                time.sleep(delay)
-                inst.write("smu.measure.read()") # saving without append, it overwrites old values
-                inst.write("print(smu.measure.read())")
-                response = inst.read()
-                response = float(response)
-                print(f"Voltage: {volt:.1f} V, current: {response:.2e} A", end="\r")
-                print()
-                time.sleep(0.1)
+        if acq.currents:
+            acq.pause_currents()
         else:
-            print("Ramping up to ", end_voltage,"V")
-            for volt in np.arange(set_voltage, end_voltage + step, step):
-                if volt > end_voltage:
-                    break
-                inst.write("smu.source.level = "+str(volt))
-                time.sleep(delay)
-                inst.write("smu.measure.read()") # saving without append, it overwrites old values
-                inst.write("print(smu.measure.read())")
-                response = inst.read()
-                response = float(response)
-                print(f"Voltage: {volt:.1f} V, current: {response:.2e} A", end="\r")
-                print()
-                time.sleep(0.1)
-
-        print("Voltage ramp completed.")
-        self.lab_status.setText(" Voltage ramp completed.")
-
-
-
-    def start_ramps(self):
-            self.receiver.currents = False
-
-            time.sleep(2)
-
-            self.receiver.keithley2.write("voltage_set = smu.source.level")
-            self.receiver.keithley2.write("print(voltage_set)")
-            tmp_pwell = self.receiver.keithley2.read()
-            self.receiver.keithley1.write("voltage_set = smu.source.level")
-            self.receiver.keithley1.write("print(voltage_set)")
-            tmp_psub = self.receiver.keithley1.read()
-            self.receiver.keithley3.write("voltage_set = smu.source.level")
-            self.receiver.keithley3.write("print(voltage_set)")
-            tmp_HV = self.receiver.keithley3.read()
-            tmp_meas = [int(tmp_HV),-int(tmp_pwell),-int(tmp_psub)]
-
-            self.lab_status.setText(" Ramping... ")
-
-            # Call the ramp voltage function
-            if self.pwell == 0:
-                if self.psub == 0:
-                    self.lab_status.setText(" Starting ramp ")
-
-                    self.ramp_voltage_DC(self.receiver.keithley2,self.receiver.keithley1, 0, 0, self.step, self.delay,tmp_meas)
-                    time.sleep(0.5)
-
-                    self.ramp_voltage_HV(self.receiver.keithley3, self.HV, self.step, self.delay,tmp_meas)
-            else:
-                if self.HV == 0:
-                    self.lab_status.setText(" Starting ramp ")
+            acq.resume_currents()
+        self.show_currents_state(acq.currents)
+
+    def show_currents_state(self,currents):
+        """Shows if the Keithleys are read (Pause Acquisition button and colors of the currents)"""
+        self.stop_cur.setText("Pause Acquisition" if currents else "Resume Acquisition")
+        color = 'color: black' if currents else 'color: red'
+        self.last_IHV.setStyleSheet(color)
+        self.last_Ipsub.setStyleSheet(color)
+        self.last_Ipwell.setStyleSheet(color)
+
+    def reconnect(self):
+        """
+        Method called when the Reconnect Keithleys Button is clicked: the
+        sessions are checked on a thread and only the broken ones are
+        reopened, with their speed profile.
+        """
+        self.reconnect_button.setEnabled(False)
+        acq = self.receiver.acq
 
-                    self.ramp_voltage_HV(self.receiver.keithley3, 0, self.step, self.delay,tmp_meas)
-                    time.sleep(0.5)
-                    self.ramp_voltage_DC(self.receiver.keithley2,self.receiver.keithley1, self.pwell, self.psub, self.step, self.delay,tmp_meas)
+        def run():
+            try:
+                if acq is None: # acquisition in another process
+                    states = self.receiver.control.call("reconnect",timeout=120)
                 else:
-                    print("Cannot power both the DCC and HVC parts!!")
-                    self.lab_status.setText(" Cannot power both the DCC and HVC parts!! ")
-                    self.ramp_HV.setValue(tmp_meas[0])
-                    self.ramp_pwell.setValue(tmp_meas[1])
-                    self.ramp_psub.setValue(tmp_meas[2])
+                    states = station_control.reconnect(acq)
+            except Exception as err: # e.g. no VISA library
+                states = {"all": f"error: {err}"}
+            self.reconnectDone.emit(states)
 
-            self.receiver.currents = True
+        threading.Thread(target=run,name="reconnect",daemon=True).start()
 
+    def onRemoteStatus(self,status):
+        """Method called with the status of a monitor in another process (see station_control.py)"""
+        if "currents" in status:
+            self.show_currents_state(status["currents"])
+        self.show_interlock()
 
+    def onReconnectDone(self,states):
+        self.smu_state = ", ".join(f"{role} {state}" for role,state in states.items())
+        print("Keithleys: "+self.smu_state)
+        self.reconnect_button.setEnabled(True)
 
-
-
-    def stop_acq(self):
+    def onDataBatch(self,batch):
         """
-        Method called when the Stop Acquisition Button is clicked.
-        When the acquisition is stopped the button's label is changed to
-        Restart Acquisition.
+        Method called with the Data Batch signal of the Thread.
+        It takes a structured array of samples (see sample_bridge.py) and
+        appends each field to the corresponding data sublist.
+        It then updates the plots and the labels widgets once for the
+        whole batch, and acknowledges the batch to the bridge.
         """
-        # Stopping
-        if self.receiver.currents:
-            self.receiver.currents = False
-            self.stop_cur.setText("Restart Acquisition")
-            self.receiver.rm.close()
-            self.last_IHV.setStyleSheet('color: red')
-            self.last_Ipsub.setStyleSheet('color: red')
-            self.last_Ipwell.setStyleSheet('color: red')
-            self.stop_cur.setEnabled(False)
-            QTimer.singleShot(2000, lambda: self.stop_cur.setDisabled(False))
-
-
-        # Restarting
-        else:
-            self.receiver.currents = True
-            self.stop_cur.setText("Stop Acquisition")
-            self.receiver.rm,self.receiver.keithley1,self.receiver.keithley2,self.receiver.keithley3 =self.receiver.configure_keithleys()
-            self.last_IHV.setStyleSheet('color: black')
-            self.last_Ipsub.setStyleSheet('color: black')
-            self.last_Ipwell.setStyleSheet('color: black')
-            self.stop_cur.setEnabled(False)
-            QTimer.singleShot(2000, lambda: self.stop_cur.setDisabled(False))
-
+        try:
+            self.update_data(batch)
+        finally:
+            self.receiver.bridge.ack()
+        status = self.receiver.bridge.status()
+        if self.receiver.acq is not None:
+            status += f", malformed frames: {self.receiver.acq.parser.n_malformed}"
+            if hasattr(self.receiver.acq.parser,"n_lost"):
+                status += f", lost frames: {self.receiver.acq.parser.n_lost}"
+            links_down = self.receiver.acq.links_down()
+            if links_down:
+                status += ", "+", ".join(links_down)
+        if self.receiver.smu_scheduler is not None:
+            status += ", "+self.receiver.smu_scheduler.status()
+        if getattr(self.receiver,"control",None) is not None:
+            status += ", "+self.receiver.status_text()
+        if self.smu_state:
+            status += ", Keithleys: "+self.smu_state
+        if self.last_alarm:
+            status += ", last alarm: "+self.last_alarm
+        self.statusBar().showMessage(status)
+
+    def onStatsAlarm(self,alarm):
+        """
+        Method called with the Stats Alarm signal of the Thread: a spike
+        or a drift of a channel (see channel_stats.py). The statistics of
+        a current with an alarm are shown in orange for 10 s, or as long as
+        it drifts.
+        """
+        self.last_alarm = channel_stats.format_alarm(*alarm)
+        print(self.last_alarm)
+        if alarm[0] in self.stats_labels:
+            self.alarm_times[alarm[0]] = time.monotonic()
+            self.stats_labels[alarm[0]].setStyleSheet('color: orange')
 
-    def onDataChanged(self,a,b,c,d,e,f,g,h,i,j,k,l,m):
+    def draw_plots(self):
         """
-        Method called with the Data Changed signal of the Thread.
-        It takes 13 floats as inputs and distributes them to the
-        corresponding data sublist.
-        It also writes on the output data file if the active flag
-        is set to True.
-        It then updates the plots and the labels widgets.
+        Draws the plots. The time span of a plot is the one chosen with its
+        toolbar, or the whole run if the number of points shown is 0, or
+        else the last points. Long spans are drawn from the history pyramid
+        (mean line and min/max band), so the cost does not depend on the
+        length of the run. The plots are rendered by a worker thread (see
+        figure_renderer.py): here the data are only collected.
         """
-        # Number of points shown
-        N = min(self.N_show,len(self.data_full[0]))
+        if len(self.data_full) == 0:
+            return
+        for i,pl in enumerate(self.plots):
+            span = pl.span
+            if span is None and self.N_show == 0:
+                span = (self.data_full.first_time,self.data_full.last_time)
+            tier = None
+            if span is None:
+                data = self.data
+            else:
+                tier = self.receiver.pyramid.select(*span)
+                if tier is None:
+                    # Short span: the samples themselves
+                    data = self.data_full.time_range(*span)
+            if tier is None:
+                t = data["time"]
+            else:
+                width,buckets = tier
+                buckets = np.array(buckets) # the open buckets change meanwhile
+                t = buckets["time"]+width/2
+            if len(t) == 0:
+                continue
+
+            axes = []
+            for j in range(len(pl.data_indx)):
+                ax = {"title": pl.titles[j],"xlabel": pl.xlabs[j],"ylabel": pl.ylabs[j],
+                      "xlim": pl.span,"lines": [],"bands": [],"hlines": []}
+                for k, name in enumerate(pl.data_indx[j]):
+                    if tier is None:
+                        ax["lines"].append((t,data[name],pl.line_colors[j][k],pl.line_labels[j][k]))
+                    else:
+                        ax["lines"].append((t,buckets[name+"_mean"],pl.line_colors[j][k],pl.line_labels[j][k]))
+                        ax["bands"].append((t,buckets[name+"_min"],buckets[name+"_max"],pl.line_colors[j][k]))
+                if tier is not None:
+                    ax["title"] = "%s (%g s: mean, min/max)" % (pl.titles[j],width)
+                if i == 0:
+                    if j == 1:
+                        ax["hlines"].append((5,min(t)-.5,max(t)+.5,"red","Min for Peltier (T_cold-dew point)"))
+                axes.append(ax)
+            self.renderer.submit(i,{"size": tuple(pl.fig.get_size_inches()),"dpi": pl.fig.dpi,"axes": axes})
+
+    def onFrameRendered(self,frame):
+        """Method called with the Frame Rendered signal of the renderer: the image is shown"""
+        key,result = frame
+        self.plots[key].set_frame(result)
 
+    def update_data(self,batch):
         # Data distribution
-        t = self.data_full[0][-N:]
-        t.append(a)
-        self.data_full[0].append(a)
-
-        dp = self.data_full[1][-N:]
-        dp.append(b)
-        self.data_full[1].append(b)
-
-        tchip= self.data_full[2][-N:]
-        tchip.append(c)
-        self.data_full[2].append(c)
-
-        tcold = self.data_full[3][-N:]
-        tcold.append(d)
-        self.data_full[3].append(d)
-
-        thot= self.data_full[4][-N:]
-        thot.append(e)
-        self.data_full[4].append(e)
-
-        del_hc= self.data_full[5][-N:]
-        del_hc.append(f)
-        self.data_full[5].append(f)
-
-        del_cc= self.data_full[6][-N:]
-        del_cc.append(g)
-        self.data_full[6].append(g)
-
-        del_dc= self.data_full[7][-N:]
-        del_dc.append(h)
-        self.data_full[7].append(h)
-
-        del_ch= self.data_full[8][-N:]
-        del_ch.append(i)
-        self.data_full[8].append(i)
-
-        del_dh= self.data_full[9][-N:]
-        del_dh.append(j)
-        self.data_full[9].append(j)
-
-        i_hv= self.data_full[10][-N:]
-        i_hv.append(k)
-        self.data_full[10].append(k)
-
-        i_pwell= self.data_full[11][-N:]
-        i_pwell.append(l)
-        self.data_full[11].append(l)
-
-        i_psub= self.data_full[12][-N:]
-        i_psub.append(m)
-        self.data_full[12].append(m)
-
-        self.data[0] = t
-        self.data[1] = dp
-        self.data[2] = tchip
-        self.data[3] = tcold
-        self.data[4] = thot
-        self.data[5] = del_hc
-        self.data[6] = del_cc
-        self.data[7] = del_dc
-        self.data[8] = del_ch
-        self.data[9] = del_dh
-        self.data[10] = i_hv
-        self.data[11] = i_pwell
-        self.data[12] = i_psub
-
-        # Writing on the output data file
-        line = "{0} {1} {2} {3} {4} {5} {6} {7} {8} {9} {10} {11} {12}\n".format(a,b,c,d,e,f,g,h,i,j,k,l,m)
-        if self.receiver.output_data_file.closed:
-            print("Not saving data anymore: file closed")
-        else:
-            self.receiver.output_data_file.write(line)
+        self.data_full.append(batch)
+        # Number of points shown (0 means all of them, drawn from the history pyramid)
+        self.data = self.data_full.last(self.N_show+1 if self.N_show > 0 else 1)
 
         # Updating of the plots
-        for i,pl in enumerate(self.plots):
-            for j,ax in enumerate(pl.axes):
-                ax.cla()  # Clear the canvas.
-                ax.grid()
-                for k, ind in enumerate(pl.data_indx[j]):
-                    y_indx = ind
-                    ax.plot(self.data[0], self.data[y_indx],color= pl.line_colors[j][k],label=pl.line_labels[j][k])
-                ax.set_title(pl.titles[j])
-                ax.set_xlabel(pl.xlabs[j])
-                ax.set_ylabel(pl.ylabs[j])
-                if i == 0:
-                    if j == 1:
-                        ax.hlines(5,min(t)-.5,max(t)+.5,colors="red",label="Min for Peltier (T_cold-dew point)",linestyles="dashed")
-                ax.legend(loc = "upper left")
-            pl.fig.tight_layout()
-            pl.draw()
+        self.draw_plots()
 
         # Updating of the temperature and currents labels
-        t_ntc = " T_NTC = %.2f *C " % (self.data[2][-1])
-        ihv = " I_HV = %.2f uA  " % (self.data[10][-1])
-        ipwell = "I_pwell = %.4f mA  " % (self.data[11][-1])
-        ipsub = "I_psub = %.4f mA " % (self.data[12][-1])
+        unit = channels.SCHEMA.unit
+        t_ntc = " T_NTC = %.2f %s " % (self.data["T_NTC"][-1],unit("T_NTC"))
+        ihv = " I_HV = %.2f %s  " % (self.data["I_HV"][-1],unit("I_HV"))
+        ipwell = "I_pwell = %.4f %s  " % (self.data["I_pwell"][-1],unit("I_pwell"))
+        ipsub = "I_psub = %.4f %s " % (self.data["I_psub"][-1],unit("I_psub"))
         self.last_T_NTC.setText(t_ntc)
         self.last_IHV.setText(ihv)
         self.last_Ipwell.setText(ipwell)
         self.last_Ipsub.setText(ipsub)
 
-app = QtWidgets.QApplication(sys.argv)
-w = MainWindow()
-app.exec_()
+        # Updating of the statistics labels
+        for name,label in self.stats_labels.items():
+            st = self.receiver.stats.snapshot(name)
+            u = unit(name)
+            label.setText(" mean = %.4g, std = %.2g %s\n min/max = %.4g / %.4g %s\n slope = %+.2g %s/s, EWMA = %.4g %s "
+                          % (st["mean"],st["std"],u,st["min"],st["max"],u,st["slope"],u,st["ewma"],u))
+            if name in self.alarm_times and not st["drifting"] and time.monotonic()-self.alarm_times[name] > 10:
+                del self.alarm_times[name]
+                label.setStyleSheet("")
+
+class StationsWindow(QtWidgets.QMainWindow):
+    """
+    A subclass of QtWidgets.QMainWindow with one tab (a MainWindow) for each
+    station. All the stations are acquired by a single stations.StationScheduler
+    running on its own thread.
+
+    With the asyncio engine the stations are acquired by the tasks of
+    async_acquisition.py, all in the same event loop.
+
+    Parameters:
+    - station_list (list of stations.Station): the stations to acquire;
+    - engine (str): default = "threads", "threads" or "asyncio";
+    - bus, exporter, catalog, smu_period: default = None, None, True,
+    smu_scheduler.SMU_PERIOD, see GetData;
+    """
+    def __init__(self, station_list, *args, engine="threads", bus=None, exporter=None, catalog=True, smu_period=smu_scheduler.SMU_PERIOD, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.setWindowTitle("C & T monitor - %d stations" % len(station_list))
+
+        self.queue = Queue()
+        self.receivers = []
+        self.windows = []
+        tabs = QTabWidget()
+        for st in station_list:
+            receiver = GetData(self.queue, acq=st.open(), bus=bus, exporter=exporter, catalog=catalog, smu_period=smu_period)
+            window = MainWindow(station=st, receiver=receiver)
+            tabs.addTab(window, st.name)
+            self.receivers.append(receiver)
+            self.windows.append(window)
+        self.setCentralWidget(tabs)
+
+        # Shared acquisition thread
+        self.scheduler = stations.StationScheduler([r.acq for r in self.receivers])
+        if engine == "asyncio":
+            engines = [async_acquisition.AsyncAcquisition(r.acq) for r in self.receivers]
+            self.thread = threading.Thread(target=asyncio.run,args=(async_acquisition.run_engines(engines),))
+        else:
+            self.thread = threading.Thread(target=self.scheduler.run)
+        self.thread.start()
+
+        self.show()
+
+    def closeEvent(self, event):
+        """Stops the acquisition of all the stations and waits for the thread"""
+        print('Closing the application...')
+        self.scheduler.stop()
+        for receiver in self.receivers:
+            if receiver.smu_scheduler is not None:
+                receiver.smu_scheduler.stop()
+            if receiver.supervisor is not None:
+                receiver.supervisor.stop()
+            if receiver.interlock is not None:
+                receiver.interlock.close()
+        self.thread.join()
+        for receiver in self.receivers:
+            receiver.pyramid.close()
+            if receiver.bus is not None:
+                receiver.bus.close()
+        for window in self.windows:
+            window.data_full.close()
+
+
+if __name__ == '__main__':
+    # Parse arguments from terminal
+    parser = argparse.ArgumentParser(description="Temperatures and currents monitor.")
+    parser.add_argument('--attach', default=None, help="HOST:PORT of a running headless_monitor.py to attach to.")
+    parser.add_argument('--control', type=int, default=None, help="With --attach, port of the commands of the headless monitor (its --control), to control the instruments.")
+    parser.add_argument('--split', action='store_true', help="Acquire in a child headless_monitor.py process, the GUI reads its samples on shared memory and sends it the commands (see station_control.py).")
+    parser.add_argument('--stations', default=None, help="JSON file with the stations to acquire (see stations.py).")
+    parser.add_argument('--binary', action='store_true', help="The Arduino sends binary frames (see binary_frames.py).")
+    parser.add_argument('--engine', choices=["threads","asyncio"], default="threads", help="Acquisition engine (default is threads).")
+    parser.add_argument('--bus', nargs='?', const="ctmon", default=None, help="Publish the samples on shared memory named PREFIX-station (default prefix is ctmon, see sample_bus.py).")
+    parser.add_argument('--metrics', type=int, nargs='?', const=metrics_exporter.METRICS_PORT, default=None, help="TCP port of the OpenMetrics endpoint on localhost (default is %d)." % metrics_exporter.METRICS_PORT)
+    parser.add_argument('--no-catalog', action='store_true', help="Do not add the runs to the catalog of the data directory (see run_catalog.py).")
+    args,qt_args = parser.parse_known_args()
+
+    if args.split and (args.attach is not None or args.stations is not None):
+        parser.error("--split acquires the default station, it cannot be used with --attach or --stations")
+
+    attach = None
+    if args.attach is not None:
+        host,port = args.attach.rsplit(":",1)
+        attach = (host,int(port))
+
+    exporter = None
+    if args.metrics is not None and attach is None and not args.split: # otherwise the headless monitor exports the metrics
+        exporter = metrics_exporter.MetricsExporter(args.metrics)
+
+    app = QtWidgets.QApplication(sys.argv[:1]+qt_args)
+    remote = None
+    if attach is not None:
+        control = station_control.ControlClient(attach[0],args.control) if args.control is not None else None
+        remote = RemoteData(*attach, control=control)
+    elif args.split:
+        # The samples are also served on TCP, to attach again if the GUI is closed by a crash
+        prefix = args.bus or f"ctmon-{os.getpid()}"
+        serve_port,control_port = station_control.free_port(),station_control.free_port()
+        options = ["--bus",prefix,"--control",str(control_port),"--serve",str(serve_port),
+                   "--engine",args.engine,"--chip",stations.CHIPS[0]]
+        options += ["--binary"]*args.binary+["--no-catalog"]*args.no_catalog
+        if args.metrics is not None:
+            options += ["--metrics",str(args.metrics)]
+        log = os.path.join(tempfile.gettempdir(),f"{prefix}-acquisition.log")
+        process = station_control.start_monitor(options,log)
+        print(f"Acquisition in process {process.pid}, output on {log}")
+        print(f"If the GUI is closed by a crash, attach again with: --attach localhost:{serve_port} --control {control_port}")
+        remote = RemoteData(bus=sample_bus.bus_name(prefix), control=station_control.ControlClient("localhost",control_port), process=process)
+    if args.stations is not None:
+        w = StationsWindow(stations.load_stations(args.stations), engine=args.engine, bus=args.bus, exporter=exporter, catalog=not args.no_catalog)
+    else:
+        w = MainWindow(remote=remote, engine=args.engine, binary=args.binary, bus=args.bus, exporter=exporter, catalog=not args.no_catalog)
+    if exporter is not None:
+        exporter.start()
+        print("Metrics on http://localhost:%d/metrics" % args.metrics)
+    app.exec_()
+    if exporter is not None:
+        exporter.close()